@@ -7,11 +7,12 @@ from contextlib import contextmanager
 from sqlalchemy.orm import scoped_session
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import create_engine
-from . import utils
+from . import utils, logqueue
 
 config = {}
 session = None
 logger = None
+_local_config = None
 
 
 def init_app(local_config=None):
@@ -21,14 +22,17 @@ def init_app(local_config=None):
     :return None
     """
     
-    global logger, session
+    global logger, session, _local_config
     if session is not None: # the app was already instantiated
         return
 
+    _local_config = local_config
     config.update(utils.load_config())
     if local_config:
         config.update(local_config)
     
+    logqueue.configure(json_lines=config.get('LOGGING_JSON'),
+                       rate_limit=config.get('LOGGING_RATE_LIMIT'))
     logger = utils.setup_logging(__file__, 'app', config['LOGGING_LEVEL'])
     engine = create_engine(config.get('SQLALCHEMY_URL', 'sqlite://'),
                            echo=config.get('SQLALCHEMY_ECHO', False))
@@ -38,6 +42,21 @@ def init_app(local_config=None):
     session.configure(bind=engine)
 
 
+def reload_config():
+    """Reloads config.py and local_config.py if they were modified (the
+    database connection is kept)
+    
+    :return True if the configuration was reloaded
+    """
+    if session is None or not utils.config_changed():
+        return False
+
+    config.update(utils.load_config())
+    if _local_config:
+        config.update(_local_config)
+    return True
+
+
 def close_app():
     """Closes the app"""
     global logger, session
@@ -0,0 +1,100 @@
+"""
+Content-addressed store of command output
+
+The output of the eb-deploy commands can be megabytes long; instead of
+sending it through RabbitMQ (and into Deployment.msg) it is written here,
+under its sha256, and the messages carry the digest and a short tail. The
+webapp serves the blobs at /output/<digest>.
+
+    <BLOB_STORE_PATH>/<first two hex digits>/<remaining 62 hex digits>
+"""
+
+import os
+import re
+import errno
+import hashlib
+import tempfile
+
+DIGEST = re.compile(r'^[0-9a-f]{64}$')
+
+
+def get_path(root, digest):
+    """
+    :param root: BLOB_STORE_PATH
+    :param digest: sha256 hex digest
+    :return: path of the blob
+    """
+    if not DIGEST.match(digest or ''):
+        raise ValueError('Invalid digest: {0!r}'.format(digest))
+    return os.path.join(root, digest[:2], digest[2:])
+
+
+def put(root, data):
+    """
+    Stores the data (once; identical data share the blob)
+
+    :param root: BLOB_STORE_PATH
+    :param data: str
+    :return: sha256 hex digest of the data
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    digest = hashlib.sha256(data).hexdigest()
+    path = get_path(root, digest)
+    if os.path.exists(path):
+        return digest
+
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+    return digest
+
+
+def open_blob(root, digest):
+    """
+    :param root: BLOB_STORE_PATH
+    :param digest: sha256 hex digest
+    :return: file object (raises ValueError for an invalid digest and
+        IOError if there is no such blob)
+    """
+    return open(get_path(root, digest), 'rb')
+
+
+def tail(text, size):
+    """
+    :return: the last size characters of the text, marked as truncated
+    """
+    text = text or ''
+    if len(text) <= size:
+        return text
+    return '...' + text[-size:]
+
+
+def offload(root, result, tail_size=2000):
+    """
+    Stores the whole output of an osutils.cmd result
+
+    :param root: BLOB_STORE_PATH
+    :param result: object with the cmd, out, err and retcode attributes
+    :param tail_size: how much of stdout and stderr to keep in the summary
+    :return: (summary, digest)
+    """
+    digest = put(root, str(result))
+    summary = 'command: {0}, retcode: {1}, stderr: {2}, stdout: {3}'.format(
+        result.cmd, result.retcode, tail(result.err, tail_size),
+        tail(result.out, tail_size))
+    return summary, digest
@@ -0,0 +1,115 @@
+"""
+Serialisation of the RabbitMQ messages
+
+Bodies are JSON; ujson is used when it is installed (codec-requirements.txt),
+otherwise the standard library. Bodies of at least
+MESSAGE_COMPRESS_THRESHOLD bytes (e.g. status messages carrying the whole
+stdout of eb-deploy) are zlib compressed. The format is described by the
+AMQP properties of the message:
+
+    content_type        application/json
+    content_encoding    zlib (or not set)
+    headers             {'x-envelope': <version>}
+
+Messages without properties (published by older code, or by hand) are
+plain JSON; messages with an envelope version newer than ENVELOPE_VERSION
+are refused rather than misread.
+"""
+
+import json
+import zlib
+import pika
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+CONTENT_TYPE = 'application/json'
+ZLIB = 'zlib'
+ENVELOPE_HEADER = 'x-envelope'
+ENVELOPE_VERSION = 1
+
+
+def dumps(message):
+    """
+    :param message: anything that can be serialised to JSON
+    :return: str
+    """
+    if ujson is not None:
+        return ujson.dumps(message, double_precision=15)
+    return json.dumps(message)
+
+
+def loads(body):
+    """
+    :param body: JSON text
+    :return: the decoded message
+    """
+    if ujson is not None:
+        return ujson.loads(body)
+    return json.loads(body)
+
+
+def get_properties(content_encoding=None, headers=None, **kwargs):
+    """
+    :param content_encoding: None or ZLIB
+    :param headers: dict of application headers (the envelope header is
+        added)
+    :param kwargs: other pika.BasicProperties (e.g. delivery_mode)
+    :return: pika.BasicProperties describing the body
+    """
+    headers = dict(headers or {})
+    headers[ENVELOPE_HEADER] = ENVELOPE_VERSION
+    return pika.BasicProperties(content_type=CONTENT_TYPE,
+                                content_encoding=content_encoding,
+                                headers=headers,
+                                **kwargs)
+
+
+def encode(message, compress_threshold=16*1024, compress_level=6, **kwargs):
+    """
+    Serialises the message
+
+    :param message: anything that can be serialised to JSON, or an already
+        serialised str (which is never compressed)
+    :param compress_threshold: compress bodies of at least this many bytes
+        (0 or None never compresses)
+    :param compress_level: zlib compression level
+    :param kwargs: other pika.BasicProperties
+    :return: (body, pika.BasicProperties)
+    """
+    if isinstance(message, basestring):
+        return message, get_properties(**kwargs)
+
+    body = dumps(message)
+    if compress_threshold and len(body) >= compress_threshold:
+        return zlib.compress(body, compress_level), get_properties(ZLIB, **kwargs)
+    return body, get_properties(**kwargs)
+
+
+def decode(body, properties=None):
+    """
+    Deserialises the body of a message
+
+    :param body: str
+    :param properties: pika.BasicProperties of the message, or None
+    :return: the decoded message
+    """
+    headers = getattr(properties, 'headers', None)
+    version = headers.get(ENVELOPE_HEADER, 0) if isinstance(headers, dict) else 0
+    if version > ENVELOPE_VERSION:
+        raise ValueError('Unsupported envelope version: {0}'.format(version))
+
+    encoding = getattr(properties, 'content_encoding', None)
+    if isinstance(encoding, basestring):
+        if encoding == ZLIB:
+            body = zlib.decompress(body)
+        else:
+            raise ValueError('Unsupported content encoding: {0}'.format(encoding))
+
+    content_type = getattr(properties, 'content_type', None)
+    if isinstance(content_type, basestring) and content_type != CONTENT_TYPE:
+        raise ValueError('Unsupported content type: {0}'.format(content_type))
+
+    return loads(body)
@@ -1,24 +1,246 @@
-from . import app
-from .models import KeyValue
+from . import app, storage
+from .models import Deployment
 from .pipeline.deploy import create_executioner
+from datetime import datetime, timedelta
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import func, or_
+import argparse
+import gzip
+import json
+import os
+import threading
 import time
 
-def cleanup_environments():
+def get_expired_environments(now=None):
+    """Returns the (application, environment, key) of the environments that
+    were last used more than AFTER_DEPLOY_CLEANUP_TIME ago (one index range
+    scan of the 'last-used' timestamps)."""
+    cutoff = (now or time.time()) - app.config.get('AFTER_DEPLOY_CLEANUP_TIME', 50*60)
+    with app.session_scope() as session:
+        keys = storage.scan_below(session, storage.LAST_USED, cutoff)
+    out = []
+    for key in keys:
+        appl, env = key.split('.', 1)
+        out.append((appl, env, key))
+    return out
+
+
+def find_testing_environments(appl):
+    """Returns the names of the (AWS) testing environments of the application
+    as reported by eb-deploy's find-env-by-attr."""
+    x = create_executioner({'application': appl, 'environment': 'testing'})
+    r = x.cmd("./find-env-by-attr url testing")
+    names = []
+    for line in r.out.splitlines():
+        parts = line.split()
+        if len(parts) > 4:
+            names.append(parts[4])
+    return names
+
+
+def _interleave(groups):
+    """Round-robin over the lists in groups, so that consecutive items come
+    from different groups."""
+    out = []
+    groups = [list(g) for g in groups]
+    while any(groups):
+        for g in groups:
+            if g:
+                out.append(g.pop(0))
+    return out
+
+
+def cleanup_environments(now=None):
     """Will terminate any testing environments that are older than
     AFTER_DEPLOY_CLEANUP_TIME (for the application that was deployed)
-    """            
+
+    Applications are probed concurrently (CLEANUP_PROBE_CONCURRENCY) and
+    the environments terminated concurrently (CLEANUP_TERMINATE_CONCURRENCY),
+    but with at most CLEANUP_TERMINATE_PER_APPLICATION terminations running
+    for any one application. The 'last-used' timer of an application is only
+    removed when all of its environments were terminated, otherwise the next
+    run will try again.
+
+    :return: dictionary application -> {'terminated': [names],
+                                        'failed': {name: error}}
+    """
+    expired = get_expired_environments(now)
+    if not expired:
+        return {}
+
+    keys = {}
+    for appl, env, key in expired:
+        keys.setdefault(appl, []).append(key)
+
+    def probe(appl):
+        try:
+            return appl, find_testing_environments(appl), None
+        except Exception as e:
+            return appl, [], e
+
+    pool = ThreadPool(min(len(keys), app.config.get('CLEANUP_PROBE_CONCURRENCY', 4)))
+    try:
+        probes = pool.map(probe, sorted(keys))
+    finally:
+        pool.close()
+
+    results = {}
+    tasks = []
+    limits = {}
+    per_app = app.config.get('CLEANUP_TERMINATE_PER_APPLICATION', 2)
+    for appl, names, error in probes:
+        results[appl] = {'terminated': [], 'failed': {}}
+        if error is not None:
+            app.logger.warning('Cannot list environments of {0}: {1}'.format(appl, error))
+            results[appl]['failed']['find-env-by-attr'] = str(error)
+            continue
+        limits[appl] = threading.BoundedSemaphore(per_app)
+        tasks.append([(appl, name) for name in names])
+
+    def terminate(task):
+        appl, name = task
+        with limits[appl]:
+            try:
+                x = create_executioner({'application': appl, 'environment': 'testing'})
+                x.cmd('eb terminate --force --nohang {0}'.format(name))
+                return appl, name, None
+            except Exception as e:
+                return appl, name, e
+
+    tasks = _interleave(tasks)
+    if tasks:
+        pool = ThreadPool(min(len(tasks), app.config.get('CLEANUP_TERMINATE_CONCURRENCY', 8)))
+        try:
+            terminated = pool.map(terminate, tasks)
+        finally:
+            pool.close()
+    else:
+        terminated = []
+
+    for appl, name, error in terminated:
+        if error is None:
+            results[appl]['terminated'].append(name)
+        else:
+            results[appl]['failed'][name] = str(error)
+
+    with app.session_scope() as session:
+        done = [k for appl in results if not results[appl]['failed']
+                for k in keys[appl]]
+        if done:
+            storage.delete(session, storage.LAST_USED, done)
+
+    for appl, r in sorted(results.items()):
+        app.logger.info('Cleanup of {0}: terminated {1}, failed {2}'.format(
+            appl, r['terminated'], r['failed']))
+
+    return results
+
+
+def get_retention(application):
+    """Returns the retention policy of the application, ie. a dictionary
+    with the number of 'versions' and 'days' of history to keep."""
+    policies = app.config.get('DEPLOYMENT_RETENTION', {})
+    policy = dict(policies.get('default', {'versions': 50, 'days': 90}))
+    policy.update(policies.get(application, {}))
+    return policy
+
+
+def archive_deployments(now=None):
+    """Moves the Deployment rows that are outside of the retention policy
+    (see DEPLOYMENT_RETENTION) into a gzipped JSON lines file in ARCHIVE_PATH,
+    one batch at a time. The rows of the newest 'versions' distinct versions
+    and the currently deployed version are never archived.
+
+    A batch is written (and synced, gzip trailer included) to the archive
+    before it is deleted from the database; if the job dies in between, the
+    batch will be archived again by the next run.
+
+    :return: number of archived rows
+    """
+    now = now or datetime.utcnow()
+    batch_size = app.config.get('ARCHIVE_BATCH_SIZE', 500)
+    archive_path = app.config.get('ARCHIVE_PATH')
+    if not os.path.isdir(archive_path):
+        os.makedirs(archive_path)
+    archive = os.path.join(archive_path,
+                           'deployment-{0}.jsonl.gz'.format(now.strftime('%Y%m%d')))
+
     with app.session_scope() as session:
-        for u in session.query(KeyValue).filter(filter(KeyValue.column.ilike("%last-used"))).all():
-            appl, env, k = u.key.split('.')
-            if time.time() + 1 - float(u.value) > app.config.get('AFTER_DEPLOY_CLEANUP_TIME', 50*60):
-                x = create_executioner({'application': appl, 'environment': env})
-                r = x.cmd("./find-env-by-attr url testing")
-                to_terminate = []
-                for env in r.out.split():
-                    parts = env.split()
-                    to_terminate.append(parts[4])
-                for x in to_terminate:
-                    x.cmd('eb terminate --force --nohang {0}'.format(x))
-                session.delete(u)
+        environments = session.query(Deployment.application,
+                                     Deployment.environment).distinct().all()
+
+    archived = 0
+    for appl, env in environments:
+        policy = get_retention(appl)
+        cutoff = now - timedelta(days=policy['days'])
+
+        with app.session_scope() as session:
+            # the last N versions (a version can have several rows)
+            versions = session.query(Deployment.version).filter(
+                Deployment.application == appl,
+                Deployment.environment == env
+            ).group_by(Deployment.version).order_by(func.max(Deployment.id).desc())\
+                .limit(policy['versions'] + 1).all()
+
+        if len(versions) <= policy['versions']:
+            continue
+        keep = [v for v, in versions[:policy['versions']]]
+
+        while True:
+            with app.session_scope() as session:
+                batch = session.query(Deployment).filter(
+                    Deployment.application == appl,
+                    Deployment.environment == env,
+                    ~Deployment.version.in_(keep),
+                    Deployment.date_last_modified < cutoff,
+                    or_(Deployment.deployed == None, Deployment.deployed == False)
+                ).order_by(Deployment.id).limit(batch_size).all()
+
+                if not batch:
+                    break
+
+                raw = open(archive, 'ab')
+                try:
+                    f = gzip.GzipFile(fileobj=raw, mode='ab')
+                    for d in batch:
+                        row = d.toJSON()
+                        row['id'] = d.id
+                        f.write(json.dumps(row) + '\n')
+                    # close() writes the trailer (into raw, which stays open)
+                    f.close()
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                finally:
+                    raw.close()
+
+                session.query(Deployment).filter(
+                    Deployment.id.in_([d.id for d in batch])
+                ).delete(synchronize_session=False)
+                archived += len(batch)
+
+    return archived
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Periodic maintenance jobs.')
+    parser.add_argument('--cleanup-environments',
+                        dest='cleanup_environments',
+                        action='store_true',
+                        help='Terminate the unused testing environments')
+    parser.add_argument('--archive-deployments',
+                        dest='archive_deployments',
+                        action='store_true',
+                        help='Archive the deployment history that is outside '
+                             'of the retention policy')
+    args = parser.parse_args()
+
+    app.init_app()
+    if args.cleanup_environments:
+        cleanup_environments()
+    if args.archive_deployments:
+        n = archive_deployments()
+        app.logger.info('Archived {0} deployments'.format(n))
 
 
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Fan-out deploy groups
+
+A push to a repository with a DEPLOY_FANOUT policy is deployed to several
+environments at once (GithubDeploy); the messages of the targets share a
+group id. The group (its targets, the repository and the version) is kept in
+the storage, the progress of each target is the Deployment that carries the
+group id, so the status of the group is aggregated from the database:
+
+    deployed        every target is deployed
+    in progress     some targets are still pending
+    failed          nothing is pending, but some targets failed (or were
+                    superseded by a newer request)
+
+With tested=True a target only counts as deployed once the integration tests
+passed (the rollouts, ADSDeploy/rollout.py, wait for them).
+"""
+
+import time
+
+from . import storage
+from .models import Deployment
+
+STATES = ('pending', 'deployed', 'failed', 'superseded')
+
+
+def target_key(target):
+    """
+    :param target: dict with the application and the environment
+    :return: '<application>.<environment>'
+    """
+    return '{0}.{1}'.format(target['application'], target['environment'])
+
+
+def create(session, group_id, targets, **info):
+    """
+    Records a new group
+
+    :param session: SQLAlchemy session
+    :param group_id: id shared by the messages of the group
+    :param targets: list of dicts with the application and the environment
+    :param info: other values to keep, e.g. the url and the version
+    """
+    group = dict(info, targets=[target_key(t) for t in targets], created=time.time())
+    storage.put(session, storage.DEPLOY_GROUP, group_id, group)
+
+
+def target_state(deployment, tested=False):
+    """
+    :param deployment: Deployment of the target, or None
+    :param tested: the integration tests must have passed too
+    :return: one of STATES
+    """
+    if deployment is None:
+        return 'pending'
+    if deployment.status == 'superseded':
+        return 'superseded'
+    if deployment.deployed is None:
+        return 'pending'
+    if not deployment.deployed:
+        return 'failed'
+    if tested and deployment.tested is None:
+        return 'pending'
+    if tested and not deployment.tested:
+        return 'failed'
+    return 'deployed'
+
+
+def status(session, group_id, tested=False):
+    """
+    :param session: SQLAlchemy session
+    :param group_id: id of the group
+    :param tested: the targets must have passed the integration tests
+    :return: dict with the group, its status, the number of targets in each
+        state and the state of every target; None if there is no such group
+    """
+    group = storage.get(session, storage.DEPLOY_GROUP, group_id)
+    if group is None:
+        return None
+
+    deployments = {}
+    for deployment in session.query(Deployment)\
+            .filter(Deployment.group_id == group_id).order_by(Deployment.id):
+        key = '{0}.{1}'.format(deployment.application, deployment.environment)
+        deployments[key] = deployment
+
+    counts = dict.fromkeys(STATES, 0)
+    environments = []
+    for key in group['targets']:
+        deployment = deployments.get(key)
+        state = target_state(deployment, tested)
+        counts[state] += 1
+        environments.append({
+            'target': key,
+            'state': state,
+            'version': deployment.version if deployment else None,
+            'msg': deployment.msg if deployment else None
+        })
+
+    if counts['pending']:
+        overall = 'in progress'
+    elif counts['deployed'] == len(environments):
+        overall = 'deployed'
+    else:
+        overall = 'failed'
+
+    group.pop('targets')
+    return dict(group, group_id=group_id, status=overall, counts=counts,
+                environments=environments)
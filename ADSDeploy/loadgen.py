@@ -0,0 +1,223 @@
+"""
+Load generator for capacity testing of the pipeline
+
+Replays recorded payloads (a JSON lines file, one message per line) into a
+queue of the pipeline at a target rate, from several connections, and
+reports what was achieved:
+
+    throughput      messages per second that were published
+    latency_ms      percentiles of the time basic_publish took (including the
+                    broker's confirmation, unless confirm_delivery is off)
+    queue_depth     (seconds since start, messages in the queue), sampled
+                    every sample_interval seconds
+
+Without a duration or a number of messages every payload is sent once;
+otherwise the payloads are sent in a loop.
+
+    python run.py --load-test payloads.jsonl --rate 50 --concurrency 4 --duration 60
+"""
+
+import math
+import json
+import time
+import threading
+
+import pika
+
+from ADSDeploy.pipeline import generic
+
+
+def read_payloads(path):
+    """
+    :param path: JSON lines file
+    :return: list of the messages (blank lines are skipped)
+    """
+    out = []
+    with open(path, 'r') as f:
+        for n, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                out.append(json.loads(line))
+            except ValueError as e:
+                raise ValueError('{0}:{1}: {2}'.format(path, n, e))
+    if not out:
+        raise ValueError('No payloads in {0}'.format(path))
+    return out
+
+
+def percentile(values, p):
+    """
+    :param values: sorted list
+    :param p: percentile, 0-100
+    :return: the value at the percentile (nearest rank), None if no values
+    """
+    if not values:
+        return None
+    k = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[max(0, min(k, len(values) - 1))]
+
+
+class LoadGenerator(object):
+    """
+    Publishes the payloads from concurrency threads, each with its own
+    connection; the threads share one schedule, so the total rate is the
+    target rate
+    """
+
+    def __init__(self, payloads, url, routing_key, exchange=None, rate=0,
+                 concurrency=1, duration=None, messages=None,
+                 confirm_delivery=True, sample_interval=1.0):
+        """
+        :param payloads: list of messages
+        :param url: RABBITMQ_URL
+        :param routing_key: where the messages are sent (also the queue
+            whose depth is sampled)
+        :param exchange: EXCHANGE
+        :param rate: messages per second, 0 for as fast as possible
+        :param concurrency: number of publishing connections
+        :param duration: seconds to publish for
+        :param messages: number of messages to publish
+        :param confirm_delivery: wait for the broker's confirmation of
+            each message
+        :param sample_interval: seconds between the queue depth samples
+        """
+        self.payloads = payloads
+        self.url = url
+        self.routing_key = routing_key
+        self.exchange = exchange
+        self.rate = rate
+        self.concurrency = max(1, concurrency)
+        self.duration = duration
+        self.messages = messages
+        if not duration and not messages:
+            self.messages = len(payloads)
+        self.confirm_delivery = confirm_delivery
+        self.sample_interval = sample_interval
+
+        self.lock = threading.Lock()
+        self.done = threading.Event()
+        self.start = None
+        self.scheduled = 0
+        self.errors = 0
+        self.latencies = []
+        self.depths = []
+
+    def make_worker(self, confirm_delivery=False):
+        """
+        :return: RabbitMQWorker connected to RabbitMQ
+        """
+        worker = generic.RabbitMQWorker({'publish': self.routing_key,
+                                         'exchange': self.exchange})
+        worker.connect(self.url, confirm_delivery=confirm_delivery)
+        return worker
+
+    def next_slot(self):
+        """
+        :return: (number of the message, when to send it), None when done
+        """
+        with self.lock:
+            i = self.scheduled
+            if self.messages and i >= self.messages:
+                return None
+            when = self.start + float(i) / self.rate if self.rate else time.time()
+            if self.duration and when - self.start >= self.duration:
+                return None
+            self.scheduled += 1
+        return i, when
+
+    def publisher(self):
+        worker = self.make_worker(self.confirm_delivery)
+        try:
+            while not self.done.is_set():
+                slot = self.next_slot()
+                if slot is None:
+                    break
+                i, when = slot
+                delay = when - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+                body, properties = worker.encode(self.payloads[i % len(self.payloads)])
+                sent = time.time()
+                try:
+                    ok = worker.channel.basic_publish(exchange=self.exchange,
+                                                      routing_key=self.routing_key,
+                                                      body=body,
+                                                      properties=properties)
+                except pika.exceptions.AMQPError as e:
+                    worker.logger.warning('Cannot publish: {0!r}'.format(e))
+                    ok = False
+                latency = time.time() - sent
+                with self.lock:
+                    if ok is False:
+                        self.errors += 1
+                    else:
+                        self.latencies.append(latency)
+        finally:
+            worker.connection.close()
+
+    def sample(self, worker):
+        """
+        Records the number of messages in the queue
+        """
+        frame = worker.channel.queue_declare(queue=self.routing_key, passive=True)
+        self.depths.append((round(time.time() - self.start, 3),
+                            frame.method.message_count))
+
+    def monitor(self):
+        worker = self.make_worker()
+        try:
+            self.sample(worker)
+            while not self.done.wait(self.sample_interval):
+                self.sample(worker)
+            self.sample(worker)
+        finally:
+            worker.connection.close()
+
+    def run(self):
+        """
+        Publishes the messages
+
+        :return: the report, see report()
+        """
+        self.start = time.time()
+        monitor = threading.Thread(target=self.monitor, name='loadgen-monitor')
+        monitor.daemon = True
+        monitor.start()
+
+        threads = []
+        for n in range(self.concurrency):
+            t = threading.Thread(target=self.publisher, name='loadgen-{0}'.format(n))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        try:
+            for t in threads:
+                # join() with a timeout, so that Ctrl-C stops the test
+                while t.is_alive():
+                    t.join(1)
+        finally:
+            elapsed = time.time() - self.start
+            self.done.set()
+            monitor.join()
+        return self.report(elapsed)
+
+    def report(self, elapsed):
+        """
+        :param elapsed: seconds the test took
+        :return: dict with the sent messages, the errors, the throughput,
+            the latency percentiles and the queue depth samples
+        """
+        latencies = sorted(self.latencies)
+        return {
+            'sent': len(latencies),
+            'errors': self.errors,
+            'elapsed_s': round(elapsed, 3),
+            'throughput': round(len(latencies) / elapsed, 2) if elapsed else 0,
+            'latency_ms': dict(
+                (name, round(percentile(latencies, p) * 1000, 3) if latencies else None)
+                for name, p in (('p50', 50), ('p90', 90), ('p99', 99), ('max', 100))),
+            'queue_depth': self.depths
+        }
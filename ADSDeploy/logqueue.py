@@ -0,0 +1,266 @@
+"""
+Non-blocking logging of the workers
+
+The loggers created by utils.setup_logging() do not write to their files;
+they put the records into a queue (QueueHandler) and return. One writer
+thread (QueueListener) per process tree takes them from the queue and writes
+<logs>/<logger name>.log. The queue is a multiprocessing.Queue, so the
+worker processes forked by the pipeline send their records to the writer of
+the parent instead of competing for the file locks.
+
+Two options (see configure(), set from LOGGING_JSON and LOGGING_RATE_LIMIT
+by app.init_app):
+
+    json        write JSON lines instead of text
+    rate_limit  maximum number of DEBUG records per second from one line of
+                code; the excess is dropped and counted, the count is added
+                to the next record that passes
+
+The standard library of Python 2.7 has neither QueueHandler nor
+QueueListener; the classes below follow the ones of Python 3.
+"""
+
+import os
+import copy
+import json
+import time
+import atexit
+import logging
+import threading
+import traceback
+import multiprocessing
+
+from cloghandler import ConcurrentRotatingFileHandler
+
+LOGFMT = '%(levelname)s\t%(process)d [%(asctime)s]:\t%(message)s'
+DATEFMT = '%m/%d/%Y %H:%M:%S'
+
+options = {
+    'json': False,
+    'rate_limit': 0
+}
+
+_lock = threading.Lock()
+_listener = None
+
+
+def configure(json_lines=None, rate_limit=None):
+    """
+    Changes the options of all the loggers (also of the existing ones)
+
+    :param json_lines: write JSON lines
+    :param rate_limit: DEBUG records per second and line of code, 0 for
+        no limit
+    """
+    if json_lines is not None:
+        options['json'] = bool(json_lines)
+    if rate_limit is not None:
+        options['rate_limit'] = rate_limit
+
+
+class QueueHandler(logging.Handler):
+    """
+    Puts the records into a queue
+    """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def prepare(self, record):
+        """
+        Formats the message and the traceback, so that the record can be
+        pickled (the arguments may not be)
+        """
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    """
+    Passes the records of the queue to the handler, in a thread
+    """
+
+    _sentinel = None
+
+    def __init__(self, queue, handler):
+        self.queue = queue
+        self.handler = handler
+        self._thread = None
+
+    def start(self):
+        self._thread = t = threading.Thread(target=self._monitor, name='log-writer')
+        t.daemon = True
+        t.start()
+
+    def _monitor(self):
+        while True:
+            try:
+                record = self.queue.get()
+            except (EOFError, IOError):
+                # the process is exiting
+                return
+            if record is self._sentinel:
+                return
+            self.handler.handle(record)
+
+    def stop(self):
+        """
+        Writes the records that are in the queue and stops the thread
+        """
+        if self._thread is not None:
+            self.queue.put_nowait(self._sentinel)
+            self._thread.join()
+            self._thread = None
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per record
+    """
+
+    def format(self, record):
+        out = {
+            'time': self.formatTime(record, DATEFMT),
+            'timestamp': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'pid': record.process,
+            'message': record.getMessage()
+        }
+        if record.exc_text:
+            out['exception'] = record.exc_text
+        return json.dumps(out)
+
+
+class RotatingFileHandler(ConcurrentRotatingFileHandler):
+    """
+    ConcurrentRotatingFileHandler that can be closed twice (logging.shutdown()
+    closes all the handlers again at exit)
+    """
+
+    def close(self):
+        if self.stream_lock is not None:
+            ConcurrentRotatingFileHandler.close(self)
+
+
+class FileDispatcher(logging.Handler):
+    """
+    Writes the records into <directory>/<logger name>.log (rotated files)
+    """
+
+    def __init__(self, directory):
+        logging.Handler.__init__(self)
+        self.directory = directory
+        self.text = logging.Formatter(fmt=LOGFMT, datefmt=DATEFMT)
+        self.json = JsonFormatter()
+        self.files = {}
+
+    def get_file(self, name):
+        handler = self.files.get(name)
+        if handler is None:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            handler = self.files[name] = RotatingFileHandler(
+                filename=os.path.join(self.directory, '{0}.log'.format(name)),
+                maxBytes=2097152,
+                backupCount=5,
+                mode='a',
+                encoding='UTF-8')  # 2MB file
+        return handler
+
+    def emit(self, record):
+        handler = self.get_file(record.name)
+        handler.setFormatter(self.json if options['json'] else self.text)
+        handler.handle(record)
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        logging.Handler.close(self)
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drops the DEBUG records of a line of code beyond options['rate_limit']
+    per second
+    """
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        limit = options['rate_limit']
+        if not limit or record.levelno > logging.DEBUG:
+            return True
+
+        key = (record.pathname, record.lineno)
+        now = time.time()
+        with self.lock:
+            tokens, updated, dropped = self.buckets.get(key, (limit, now, 0))
+            tokens = min(limit, tokens + (now - updated) * limit)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now, dropped + 1)
+                return False
+            self.buckets[key] = (tokens - 1, now, 0)
+
+        if dropped:
+            record.msg = '{0} ({1} similar messages suppressed)'.format(
+                record.getMessage(), dropped)
+            record.args = None
+        return True
+
+
+rate_limit_filter = RateLimitFilter()
+
+
+def get_listener(directory):
+    """
+    :param directory: where the log files are written
+    :return: the QueueListener of this process tree (started on first use)
+    """
+    global _listener
+    with _lock:
+        if _listener is None:
+            _listener = QueueListener(multiprocessing.Queue(), FileDispatcher(directory))
+            _listener.pid = os.getpid()
+            _listener.start()
+            atexit.register(stop)
+    return _listener
+
+
+def get_handler(directory):
+    """
+    :param directory: where the log files are written
+    :return: a new QueueHandler (rate limited) feeding the writer
+    """
+    handler = QueueHandler(get_listener(directory).queue)
+    handler.addFilter(rate_limit_filter)
+    return handler
+
+
+def stop():
+    """
+    Flushes the queue (in the process that owns the writer)
+    """
+    global _listener
+    with _lock:
+        listener, _listener = _listener, None
+    if listener is not None and listener.pid == os.getpid():
+        listener.stop()
+        listener.handler.close()
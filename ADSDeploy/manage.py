@@ -1,34 +1,130 @@
+"""
+Bootstraps/syncs the deployments with the Elastic Beanstalk environments
+
+All the environments are fetched with one (paginated) describe_environments
+call and compared, in memory, with the Deployments of the versions they
+run; only the differences are written, in one transaction:
+
+    new environment         a Deployment is inserted
+    new version             a Deployment is inserted
+    known version           its Deployment is updated (e.g. after a rollback)
+    health changed          the Deployment of the version is updated
+    healthy version         the other versions are no longer deployed
+
+Running it again without changes on AWS writes nothing. The status
+documents of the changed environments (ADSDeploy/statusdoc.py) are refreshed
+in the same transaction.
+
+    python ADSDeploy/manage.py
+"""
+
 import os
 import sys
 PROJECT_HOME = os.path.abspath(
     os.path.join(os.path.dirname(__file__), '..'))
 sys.path.append(PROJECT_HOME)
-import boto3
 
-from ADSDeploy import app
+from ADSDeploy import app, statusdoc
 from ADSDeploy.models import Deployment
 
-app.init_app()
-client = boto3.client('elasticbeanstalk')
-
-for app in client.describe_applications()['Applications']:
-    app_name = app['ApplicationName']
-    
-    list_of_services = client.describe_environments(ApplicationName=app_name)
-    for service in list_of_services['Environments']:
-
-        name = service['CNAME'].split('.')[0].replace('-{0}'.format(app_name), '')
-        version = ':'.join(service['VersionLabel'].split(':')[1:])
-    
-        with app.session_scope() as session:
-            deployment = Deployment(
-                application=app_name,
-                environment=name,
-                deployed=service.get('Health', '') == 'Green',
-                tested=False,
-                msg='AWS bootstrapped',
-                version=version
-            )
-    
-            session.add(deployment)
-            session.commit()
+
+def describe_environments(client):
+    """
+    :param client: boto3 elasticbeanstalk client
+    :return: list of all the (live) environments, of all the applications
+    """
+    out = []
+    kwargs = {'IncludeDeleted': False}
+    while True:
+        response = client.describe_environments(**kwargs)
+        out.extend(response['Environments'])
+        if not response.get('NextToken'):
+            return out
+        kwargs['NextToken'] = response['NextToken']
+
+
+def environment_state(service):
+    """
+    :param service: environment, as described by describe_environments
+    :return: dict with the application, environment, version and deployed
+        columns of its Deployment
+    """
+    application = service['ApplicationName']
+    return {
+        'application': application,
+        'environment': service['CNAME'].split('.')[0].replace('-{0}'.format(application), ''),
+        'version': ':'.join(service.get('VersionLabel', '').split(':')[1:]),
+        'deployed': service.get('Health', '') == 'Green'
+    }
+
+
+def known_deployments(session, environments):
+    """
+    :param session: SQLAlchemy session
+    :param environments: list of environment_state()
+    :return: (dict (application, environment, version) -> its Deployment,
+        dict (application, environment) -> list of the deployed Deployments)
+    """
+    by_version = {}
+    versions = set(e['version'] for e in environments)
+    if versions:
+        for d in session.query(Deployment).filter(Deployment.version.in_(versions))\
+                .order_by(Deployment.id):
+            # the newest one, if there are duplicates
+            by_version[(d.application, d.environment, d.version)] = d
+    deployed = {}
+    for d in session.query(Deployment).filter(Deployment.deployed == True):
+        deployed.setdefault((d.application, d.environment), []).append(d)
+    return by_version, deployed
+
+
+def sync_environments(client):
+    """
+    Writes the changes of the environments to the database, in one
+    transaction. The Deployment of the version that runs is updated (or
+    inserted if there is none, the pipeline also keeps one row per
+    version) and, when it is healthy, the other versions of the
+    environment are no longer deployed (as the DatabaseWriterWorker does)
+
+    :param client: boto3 elasticbeanstalk client
+    :return: (number of inserted deployments, number of updated ones)
+    """
+    environments = [environment_state(s) for s in describe_environments(client)]
+
+    with app.session_scope() as session:
+        by_version, deployed = known_deployments(session, environments)
+        inserts, updates = [], {}
+        changed = set()
+        for state in environments:
+            key = (state['application'], state['environment'])
+            deployment = by_version.get(key + (state['version'],))
+            if deployment is None:
+                state.update(tested=False, msg='AWS bootstrapped')
+                inserts.append(state)
+                changed.add(key)
+            elif deployment.deployed != state['deployed']:
+                updates[deployment.id] = {'id': deployment.id, 'deployed': state['deployed']}
+                changed.add(key)
+
+            if state['deployed']:
+                for other in deployed.get(key, []):
+                    if other.version != state['version']:
+                        updates[other.id] = {'id': other.id, 'deployed': False}
+                        changed.add(key)
+
+        if inserts:
+            session.bulk_insert_mappings(Deployment, inserts)
+        if updates:
+            session.bulk_update_mappings(Deployment, updates.values())
+
+        for application, environment in sorted(changed):
+            statusdoc.refresh(session, application, environment)
+    return len(inserts), len(updates)
+
+
+if __name__ == '__main__':
+    import boto3
+
+    app.init_app()
+    inserted, updated = sync_environments(boto3.client('elasticbeanstalk'))
+    print 'Inserted {0} deployments, updated {1}'.format(inserted, updated)
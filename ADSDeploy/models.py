@@ -3,28 +3,43 @@
 Database models
 """
 
+import json
+
 from datetime import datetime
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime
+from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, \
+    Float, Index
 
 Base = declarative_base()
 
 
 class KeyValue(Base):
     """
-    Example model, it stores key/value pairs - a persistent configuration
+    Persistent key/value pairs, grouped into namespaces (e.g. the 'ui'
+    storage of the widgets, the 'last-used' timestamps of the environments).
+    Numbers are kept in their own column, so that they can be compared in
+    SQL; everything else is stored as (JSON) text. Use it through
+    ADSDeploy.storage.
     """
     __tablename__ = 'storage'
 
+    namespace = Column(String(64), primary_key=True, default='', server_default='')
     key = Column(String(255), primary_key=True)
     value = Column(Text)
+    number = Column(Float)
+
+    # range scans of the numbers of one namespace (e.g. expired timestamps)
+    __table_args__ = (
+        Index('ix_storage_namespace_number', 'namespace', 'number'),
+    )
 
     def toJSON(self):
         """
         Convert to JSON
         :return: dict
         """
-        return {'key': self.key, 'value': self.value}
+        return {'key': self.key,
+                'value': self.value if self.number is None else self.number}
 
 
 class Deployment(Base):
@@ -48,6 +63,15 @@ class Deployment(Base):
     tested = Column(Boolean, nullable=True)
     msg = Column(String)
     status = Column(String)
+    output = Column(String(64))  # digest of the full output (ADSDeploy.blobs)
+    group_id = Column(String(32))  # fan-out deploy group (ADSDeploy.groups)
+
+    # history of one environment, newest first (StatusView, HistoryView)
+    __table_args__ = (
+        Index('ix_deployment_application_environment_id',
+              'application', 'environment', 'id'),
+        Index('ix_deployment_group_id', 'group_id'),
+    )
 
     def toJSON(self):
         """
@@ -63,7 +87,9 @@ class Deployment(Base):
             'deployed': self.deployed,
             'tested': self.tested,
             'msg': self.msg,
-            'status': self.status
+            'status': self.status,
+            'output': self.output,
+            'group_id': self.group_id
         }
 
     def __repr__(self):
@@ -80,7 +106,60 @@ class Deployment(Base):
             '\tdeployed: {}'.format(self.deployed),
             '\ttested: {}'.format(self.tested),
             '\tmsg: {}'.format(self.msg),
-            '\tstatus: {}'.format(self.status)
+            '\tstatus: {}'.format(self.status),
+            '\toutput: {}'.format(self.output),
+            '\tgroup_id: {}'.format(self.group_id)
         ]
 
         return '<Deployment (\n{}\n)>'.format(', \n'.join(_repr))
+
+
+class Rollout(Base):
+    """
+    A version deployed to waves of environments, one wave after the other
+    (see ADSDeploy.rollout). The state machine lives here, so that a
+    restarted TaskMaster resumes the rollouts where they were.
+    """
+    __tablename__ = 'rollout'
+
+    id = Column(String(32), primary_key=True)
+    version = Column(String)
+    waves = Column(Text)  # JSON: list of lists of '<application>.<environment>'
+    wave = Column(Integer, nullable=False, default=0)  # index of the current wave
+    state = Column(String(16), nullable=False)
+    on_failure = Column(String(16))  # 'stop' or 'rollback'
+    group_id = Column(String(32))  # deploy group of the current wave (or of the rollback)
+    previous = Column(Text)  # JSON: target -> version before the rollout
+    msg = Column(String)
+    wave_started = Column(DateTime)
+    date_created = Column(DateTime, nullable=False, default=datetime.utcnow)
+    date_last_modified = Column(
+        DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        onupdate=datetime.utcnow
+    )
+
+    # the TaskMaster polls the active rollouts
+    __table_args__ = (
+        Index('ix_rollout_state', 'state'),
+    )
+
+    def toJSON(self):
+        """
+        Convert to JSON
+        :return: dict
+        """
+        return {
+            'id': self.id,
+            'version': self.version,
+            'waves': json.loads(self.waves or '[]'),
+            'wave': self.wave,
+            'state': self.state,
+            'on_failure': self.on_failure,
+            'group_id': self.group_id,
+            'previous': json.loads(self.previous or '{}'),
+            'msg': self.msg,
+            'date_created': self.date_created.isoformat(),
+            'date_last_modified': self.date_last_modified.isoformat()
+        }
@@ -3,8 +3,19 @@ import threading
 import subprocess
 import signal
 
+class CommandError(Exception):
+    """Raised when a command fails; the result (cmd, out, err, retcode,
+    timed_out) is available as .result"""
+
+    def __init__(self, result):
+        super(CommandError, self).__init__(dict(cmd=result.cmd, out=result.out,
+                                                err=result.err, retcode=result.retcode))
+        self.result = result
+
+
 def cmd(cmd, inputv=None, cwd=None, max_wait=None):
-    """Runs a command in the console and returns back the STDOUT/STDERR"""
+    """Runs a command in the console and returns back the STDOUT/STDERR;
+    it is killed after max_wait seconds (the result is then timed_out)"""
     try:
         p = subprocess.Popen(cmd, shell=True,
             stdin=subprocess.PIPE,
@@ -18,11 +29,14 @@ def cmd(cmd, inputv=None, cwd=None, max_wait=None):
         raise e
     
     timer = None
+    killed = []
     if max_wait:
         def run(pro):
+            killed.append(True)
             os.killpg(os.getpgid(pro.pid), signal.SIGTERM)
         timer = threading.Timer(max_wait, run, args=[p])
-        
+        timer.daemon = True
+        timer.start()
     
     if inputv:
         p.communicate(inputv)
@@ -44,13 +58,14 @@ def cmd(cmd, inputv=None, cwd=None, max_wait=None):
     setattr(out, 'out', p.stdout.read())
     setattr(out, 'err', p.stderr.read())
     setattr(out, 'retcode', retcode)
+    setattr(out, 'timed_out', bool(killed))
 
     p.stdout.close()
     p.stderr.close()
     p.stdin.close()
     
     if retcode:
-        raise Exception(dict(cmd=cmd, out=out.out, err=out.err, retcode=out.retcode))
+        raise CommandError(out)
     
     return out
 
@@ -65,4 +80,5 @@ class Executioner(object):
         """Will always run the command with activated python virtualenv
         and inside the specified folder."""
         
-        return cmd("bash -c \"source {0} && {1}\"".format(self.pyenv, command), inputv, cwd=self.root)
\ No newline at end of file
+        return cmd("bash -c \"source {0} && {1}\"".format(self.pyenv, command), inputv,
+                   cwd=self.root, max_wait=self.max_wait)
\ No newline at end of file
@@ -2,9 +2,10 @@
 Database Writer
 """
 
-from .. import app
+from .. import app, statusdoc
 from generic import RabbitMQWorker
 from ..models import Deployment
+from .deploy import remember_known_good, forget_known_good
 from sqlalchemy.orm.exc import NoResultFound
 
 
@@ -36,7 +37,10 @@ class DatabaseWriterWorker(RabbitMQWorker):
             'version',
             'deployed',
             'tested',
-            'msg'
+            'msg',
+            'status',
+            'output',
+            'group_id'
         ]
 
         result = dict(msg)
@@ -69,7 +73,15 @@ class DatabaseWriterWorker(RabbitMQWorker):
                                   'for a record: {} [{}]'.format(error, msg))
                 raise
 
+            # a deploy group (fan-out, rollout) is a new attempt: the results
+            # of the previous deployment of this version do not count
+            if result.get('group_id') and result['group_id'] != deployment.group_id:
+                deployment.deployed = None
+                deployment.tested = None
+                deployment.status = None
+
             # New deployment?
+            other_deployments = []
             if not deployment.deployed and result.get('deployed', False):
                 other_deployments = session.query(Deployment).filter(
                     Deployment.application == result['application'],
@@ -85,6 +97,16 @@ class DatabaseWriterWorker(RabbitMQWorker):
                 except KeyError:
                     continue
 
+            # a version to roll back to (Rollback), or not anymore (it failed
+            # when it was deployed again; replacing it by a newer version
+            # does not make it bad)
+            if result.get('deployed') is False or result.get('tested') is False:
+                forget_known_good(session, deployment.application,
+                                  deployment.environment, deployment.version)
+            elif deployment.deployed and deployment.tested:
+                remember_known_good(session, deployment.application,
+                                    deployment.environment, deployment.version)
+
             # Commit to the database or roll back
             try:
                 session.add(deployment)
@@ -95,6 +117,11 @@ class DatabaseWriterWorker(RabbitMQWorker):
                     session.add(other)
                     session.commit()
 
+                # the precomputed status of the environment (/status/documents)
+                statusdoc.refresh(session, deployment.application,
+                                  deployment.environment)
+                session.commit()
+
             except Exception as err:
                 self.logger.warning('Rolling back db entry: {}'.format(err))
                 session.rollback()
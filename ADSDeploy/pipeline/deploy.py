@@ -1,8 +1,11 @@
 from ADSDeploy.pipeline.generic import RabbitMQWorker
-from ADSDeploy import osutils, app
-from ADSDeploy.models import KeyValue
+from ADSDeploy import osutils, app, storage, blobs, utils, groups
+from ADSDeploy.models import Deployment
 import os
+import fnmatch
+import tempfile
 import time
+import uuid
 import threading
 
 
@@ -36,6 +39,147 @@ def is_timedout(payload, timestamp_key='timestamp'):
     return False
 
 
+def offload_output(payload, result):
+    """Stores the full output of the command in the blob store; the payload
+    gets its digest ('output') and a summary with the tail of the output."""
+    summary, digest = blobs.offload(app.config.get('BLOB_STORE_PATH'), result,
+                                    app.config.get('BLOB_TAIL_SIZE', 2000))
+    payload['output'] = digest
+    return summary
+
+
+def is_transient(result):
+    """True if the command failed for a reason that may go away when it is
+    run again: it was killed after MAX_WAIT_TIME, or its output reports a
+    lost connection (one of DEPLOY_TRANSIENT_ERRORS)."""
+    if getattr(result, 'timed_out', False):
+        return True
+    output = '{0}\n{1}'.format(result.out or '', result.err or '')
+    return any(e in output for e in app.config.get('DEPLOY_TRANSIENT_ERRORS', []))
+
+
+def register_request(payload):
+    """Marks the payload as the newest deploy (or rollback) request for its
+    environment (unless it already has an id, i.e. it was registered before)."""
+    if 'request_id' in payload or payload.get('action', 'deploy') not in ('deploy', 'rollback'):
+        return
+    payload['request_id'] = uuid.uuid4().hex
+    key = '{0}.{1}'.format(payload['application'], payload['environment'])
+    with app.session_scope() as session:
+        storage.put(session, storage.REQUESTED, key, payload['request_id'])
+
+
+def is_superseded(payload):
+    """True if a newer deploy request arrived for the same environment."""
+    if 'request_id' not in payload:
+        return False
+    key = '{0}.{1}'.format(payload['application'], payload['environment'])
+    with app.session_scope() as session:
+        latest = storage.get(session, storage.REQUESTED, key)
+    return latest is not None and latest != payload['request_id']
+
+
+def skip_superseded(worker, payload):
+    """Records the 'superseded' status if the payload is stale; returns
+    True when the caller should drop it."""
+    if not is_superseded(payload):
+        return False
+    payload['status'] = 'superseded'
+    payload['msg'] = '{0}-{1}: {2} superseded by a newer request'.format(
+        payload['environment'], payload['application'], payload.get('version'))
+    worker.logger.info(payload['msg'])
+    worker.publish(payload, topic=worker.params['status'])
+    return True
+
+
+def lock_environment(worker, payload):
+    """Takes the lock of the environment, so that only one deploy (or
+    rollback) of it runs at a time. If another one holds it, the payload is
+    parked in the worker's delay queue for DEPLOY_LOCK_RETRY_DELAY seconds.
+
+    :return: the token for unlock_environment(), None if it was held
+    """
+    key = '{0}.{1}'.format(payload['application'], payload['environment'])
+    with app.session_scope() as session:
+        token = storage.acquire(session, storage.DEPLOY_LOCK, key,
+                                app.config.get('MAX_WAIT_TIME', 30*60) + 60)
+    if token is None:
+        worker.logger.info('{0}-{1} is being deployed, retrying later'.format(
+            payload['environment'], payload['application']))
+        worker.delay(payload, app.config.get('DEPLOY_LOCK_RETRY_DELAY', 60))
+    return token
+
+
+def unlock_environment(payload, token):
+    """Releases the lock taken by lock_environment()."""
+    key = '{0}.{1}'.format(payload['application'], payload['environment'])
+    with app.session_scope() as session:
+        storage.release(session, storage.DEPLOY_LOCK, key, token)
+
+
+def known_good_versions(session, application, environment):
+    """Returns the versions of the environment that were deployed and passed
+    the integration tests, newest first (ROLLBACK_KNOWN_GOOD_SIZE of them).
+    They are cached in the storage (see remember_known_good); without the
+    cache they come from the history of the environment (the newest rows of
+    the (application, environment, id) index)."""
+    key = '{0}.{1}'.format(application, environment)
+    versions = storage.get(session, storage.KNOWN_GOOD, key)
+    if versions is None:
+        versions = []
+        for (version,) in session.query(Deployment.version).filter(
+                Deployment.application == application,
+                Deployment.environment == environment,
+                Deployment.tested == True).order_by(Deployment.id.desc()):
+            if version not in versions:
+                versions.append(version)
+            if len(versions) >= app.config.get('ROLLBACK_KNOWN_GOOD_SIZE', 5):
+                break
+        if versions:
+            storage.put(session, storage.KNOWN_GOOD, key, versions)
+    return versions
+
+
+def remember_known_good(session, application, environment, version):
+    """Puts the version on top of the cached known good versions."""
+    versions = [v for v in known_good_versions(session, application, environment)
+                if v != version]
+    versions.insert(0, version)
+    storage.put(session, storage.KNOWN_GOOD, '{0}.{1}'.format(application, environment),
+                versions[:app.config.get('ROLLBACK_KNOWN_GOOD_SIZE', 5)])
+
+
+def forget_known_good(session, application, environment, version):
+    """Removes the version from the cached known good versions (it failed
+    to deploy, or failed the tests, when it was deployed again)."""
+    key = '{0}.{1}'.format(application, environment)
+    versions = storage.get(session, storage.KNOWN_GOOD, key)
+    if versions and version in versions:
+        storage.put(session, storage.KNOWN_GOOD, key,
+                    [v for v in versions if v != version])
+
+
+def active_version(session, application, environment):
+    """Returns the version the environment runs (its newest deployed one)."""
+    deployment = session.query(Deployment.version).filter(
+        Deployment.application == application,
+        Deployment.environment == environment,
+        Deployment.deployed == True).order_by(Deployment.id.desc()).first()
+    return deployment.version if deployment else None
+
+
+def fanout_targets(url, recipes):
+    """Returns the recipes that a push to the repository deploys to,
+    according to its DEPLOY_FANOUT policy (None if it has no policy)."""
+    patterns = app.config.get('DEPLOY_FANOUT', {}).get(url)
+    if not patterns:
+        return None
+    if type(recipes) == dict:
+        recipes = [recipes]
+    return [r for r in recipes
+            if any(fnmatch.fnmatchcase(groups.target_key(r), p) for p in patterns)]
+
+
 class ProjectMapper:
     """Finds the application name inside eb-deploy or from the config."""
     def __init__(self, root, data):
@@ -80,8 +224,28 @@ class GithubDeploy(RabbitMQWorker):
     and triggers deployment (if the information matches eb-deploy
     recipes). It is living in a separate queue so that it can be
     triggered manually.
+
+    Webhooks (payloads with the GitHub 'delivery' id) are de-duplicated
+    and debounced: a redelivery of the same version is ignored, and the
+    payload is parked in the 'delay' queue for GITHUB_DEBOUNCE_WINDOW; when
+    it comes back, it is only deployed if no newer push for the same
+    repository and environment arrived in the meantime.
     """
-      
+
+    def is_duplicate(self, delivery, version):
+        """Records the delivery; returns True if it was seen before."""
+        now = time.time()
+        key = '{0}:{1}'.format(delivery, version)
+        with app.session_scope() as session:
+            expired = storage.scan_below(session, storage.GITHUB_DELIVERY,
+                now - app.config.get('GITHUB_DELIVERY_TTL', 7*24*60*60))
+            if expired:
+                storage.delete(session, storage.GITHUB_DELIVERY, expired)
+            if storage.get(session, storage.GITHUB_DELIVERY, key) is not None:
+                return True
+            storage.put(session, storage.GITHUB_DELIVERY, key, now)
+        return False
+
     def process_payload(self, payload, 
         channel=None, 
         method_frame=None, 
@@ -94,6 +258,14 @@ class GithubDeploy(RabbitMQWorker):
         
         url = payload['url']
         version = payload.get('tag', payload.get('commit', 'HEAD'))
+        delivery = payload.get('delivery')
+        token = payload.get('debounce')
+        original = dict(payload)
+
+        if delivery and token is None \
+                and self.is_duplicate(delivery, payload.get('tag') or payload.get('commit')):
+            self.logger.info('Ignoring redelivery {0} of {1}'.format(delivery, url))
+            return
         
         if 'github' in url:
             url = '/'.join(url.split('/')[-2:])
@@ -104,34 +276,86 @@ class GithubDeploy(RabbitMQWorker):
         data = resolver.get(url)
         if not data:
             payload['msg'] = 'Cannot find app-name for url: {0}'.format(url)
-            self.publish_to_error_queue(payload)
+            self.publish_to_error_queue(payload, retry=False)
             return
+
+        targets = None
+        if 'application' not in payload:
+            targets = fanout_targets(url, data)
+        if targets is not None:
+            if not targets or len(targets) > app.config.get('DEPLOY_FANOUT_MAX_TARGETS', 10):
+                payload['msg'] = 'The fan-out policy of {0} matches {1} recipes: {2}'\
+                    .format(url, len(targets), data)
+                self.publish_to_error_queue(payload, retry=False)
+                return
         elif type(data) == list:
             # we have to decide which application will be started
             if 'application' in payload:
                 alternatives = filter(lambda x: x['application'] == payload['application'], data)
                 if len(alternatives) == 1:
-                    payload = alternatives[0]
+                    targets = alternatives
                 else:
                     raise Exception('We cant decide what to deploy, options: {0}'.format(data))
             else:
                 alternatives = filter(lambda x: x['application'] == 'sandbox', data)
                 if len(alternatives) == 1:
-                    payload = alternatives[0]
+                    targets = alternatives
                 else:
                     raise Exception('We cant decide what to deploy, options: {0}'.format(data))
                     
         elif type(data) == dict:
-            payload = data
-        
-        payload['version'] = version
-        self.publish(payload)
+            targets = [data]
+
+        targets = [dict(t) for t in targets]
+        for target in targets:
+            target['version'] = version
+            target['priority'] = utils.get_priority(
+                target,
+                app.config.get('DEPLOY_PRIORITIES', {}),
+                app.config.get('QUEUE_MAX_PRIORITY'))
 
+        if delivery:
+            key = '{0}|{1}'.format(url, ','.join(groups.target_key(t) for t in targets))
+            window = app.config.get('GITHUB_DEBOUNCE_WINDOW', 0)
+            if token is None and window > 0 and self.params.get('delay'):
+                token = '{0}:{1}'.format(delivery, version)
+                with app.session_scope() as session:
+                    storage.put(session, storage.GITHUB_LATEST, key, token)
+                original['debounce'] = token
+                self.delay(original, window)
+                return
+            elif token is not None:
+                with app.session_scope() as session:
+                    if storage.get(session, storage.GITHUB_LATEST, key) != token:
+                        self.logger.info('Skipping {0}@{1}, superseded by a newer push'
+                                         .format(url, version))
+                        return
+                    storage.delete(session, storage.GITHUB_LATEST, [key])
+
+        if len(targets) == 1:
+            self.publish(targets[0])
+            return
+
+        # fan-out: one message per target, the Deploy workers run them in
+        # parallel (up to their concurrency)
+        group_id = uuid.uuid4().hex
+        with app.session_scope() as session:
+            groups.create(session, group_id, targets, url=url, version=version)
+        self.logger.info('Deploying {0}@{1} to {2} (group {3})'.format(
+            url, version, ', '.join(groups.target_key(t) for t in targets), group_id))
+        with self.publish_batch():
+            for target in targets:
+                target['group_id'] = group_id
+                self.publish(target)
 
 
 class BeforeDeploy(RabbitMQWorker):
     """Checks the environment before running the deployment. If the environment
     is in the 'pending' state, it will keep waiting MAX_WAIT_TIME.
+
+    Every new deploy request is registered as the newest one of its
+    environment; requests that were superseded by a newer one (while waiting
+    here or in the deploy queue) are dropped with the status 'superseded'.
     """
     
     def process_payload(self, payload, 
@@ -142,16 +366,21 @@ class BeforeDeploy(RabbitMQWorker):
         Receives information about the environment that
         is about to de deployed
         """
-        
+
+        register_request(payload)
+        if skip_superseded(self, payload):
+            return
+
         if is_timedout(payload, timestamp_key='init_timestamp'):
             payload['err'] = 'timeout'
             payload['msg'] = 'BeforeDeploy: waiting too long for the environment to come up'
             payload['deployed'] = False
 
-            self.publish(payload, topic=self.params['status'])
-
-            return self.publish_to_error_queue(payload,
-                                               header_frame=header_frame)
+            with self.publish_batch():
+                self.publish(payload, topic=self.params['status'])
+                return self.publish_to_error_queue(payload,
+                                                   header_frame=header_frame,
+                                                   retry=False)
             
         x = create_executioner(payload)
         
@@ -179,12 +408,19 @@ class BeforeDeploy(RabbitMQWorker):
         
         if action == 'deploy':
             payload['msg'] = 'OK to deploy'
-            self.publish(payload, topic='ads.deploy.deploy')
-            self.publish(payload, topic=self.params['status'])
+            with self.publish_batch():
+                self.publish(payload, topic='ads.deploy.deploy')
+                self.publish(payload, topic=self.params['status'])
         elif action.startswith('restart'):
             payload['msg'] = 'Deploy to be restarted'
-            self.publish(payload, topic='ads.deploy.restart')
-            self.publish(payload, topic=self.params['status'])
+            with self.publish_batch():
+                self.publish(payload, topic='ads.deploy.restart')
+                self.publish(payload, topic=self.params['status'])
+        elif action == 'rollback':
+            payload['msg'] = 'OK to roll back'
+            with self.publish_batch():
+                self.publish(payload, topic='ads.deploy.rollback')
+                self.publish(payload, topic=self.params['status'])
         else:
             raise Exception('Unknown action {0}'.format(action))
 
@@ -202,28 +438,147 @@ class Deploy(RabbitMQWorker):
         method_frame=None, 
         header_frame=None):
         """Runs the actual deployment. It calls the eb-deploy safe-deploy.sh."""
-        
+
+        if skip_superseded(self, payload):
+            return
+
+        token = lock_environment(self, payload)
+        if token is None:
+            return
+        try:
+            self.deploy(payload, header_frame)
+        finally:
+            unlock_environment(payload, token)
+
+    def deploy(self, payload, header_frame=None):
+        """Runs safe-deploy.sh (the environment is locked)."""
         x = create_executioner(payload)
         payload['msg'] = '{0}-{1} deployment starts'\
             .format(payload['environment'], payload['application'])
         self.publish(payload, topic=self.params['status'])
 
         # this will run for a few minutes!
-        r = x.cmd('./safe-deploy.sh {0} > /tmp/deploy.{0}.{1}'
-                  .format(payload['environment'], payload['application']))
+        fd, log = tempfile.mkstemp(prefix='deploy.{0}.{1}.'.format(
+            payload['environment'], payload['application']))
+        os.close(fd)
+        try:
+            r = x.cmd('./safe-deploy.sh {0} > {1}'.format(payload['environment'], log))
+        except osutils.CommandError as e:
+            r = e.result
+        try:
+            if not r.out and r.retcode != 0:
+                with open(log) as f:
+                    r.out = f.read()
+        finally:
+            os.remove(log)
         if r.retcode == 0:
             payload['deployed'] = True
             payload['msg'] = 'deployed'
-            self.publish(payload)
-            self.publish(payload, topic=self.params['status'])
+            with self.publish_batch():
+                self.publish(payload)
+                self.publish(payload, topic=self.params['status'])
         else:
             payload['err'] = 'deployment failed'
             payload['deployed'] = False
-            payload['msg'] = 'deployment failed; command: {0}, reason: {1}, ' \
-                             'stdout: {2}'.format(r.command, r.err, r.out)
+            payload['msg'] = 'deployment failed; {0}'.format(offload_output(payload, r))
+
+            with self.publish_batch():
+                # a broken build fails again, only a timeout or a lost
+                # connection is worth a retry
+                self.publish_to_error_queue(payload, header_frame=header_frame,
+                                            retry=is_transient(r))
+                self.publish(payload, topic=self.params['status'])
+
+
+class Rollback(RabbitMQWorker):
+    """
+    Returns the environment to a version that was already deployed and
+    tested: by default the newest known good one that is not the active
+    version. The application version exists in Elastic Beanstalk already, so
+    it is swapped in (ROLLBACK_COMMAND) instead of being built and deployed
+    by safe-deploy.sh, and it skips the integration tests (it passed them).
+    A requested version that never passed the tests is deployed normally.
+    """
+
+    def process_payload(self, payload,
+        channel=None,
+        method_frame=None,
+        header_frame=None):
+        """Swaps the version of the environment."""
 
-            self.publish_to_error_queue(payload, header_frame=header_frame)
-            self.publish(payload, topic=self.params['status'])
+        if skip_superseded(self, payload):
+            return
+
+        token = lock_environment(self, payload)
+        if token is None:
+            return
+        try:
+            self.rollback(payload, header_frame)
+        finally:
+            unlock_environment(payload, token)
+
+    def rollback(self, payload, header_frame=None):
+        """Finds the version and swaps it in (the environment is locked)."""
+        with app.session_scope() as session:
+            good = known_good_versions(session, payload['application'],
+                                       payload['environment'])
+            active = active_version(session, payload['application'],
+                                    payload['environment'])
+
+        version = payload.get('version')
+        if version and version not in good:
+            self.logger.info('{0} was not tested in {1}-{2}, deploying it'.format(
+                version, payload['environment'], payload['application']))
+            payload['action'] = 'deploy'
+            payload['msg'] = 'rollback to an untested version, deploying it'
+            with self.publish_batch():
+                self.publish(payload, topic='ads.deploy.deploy')
+                self.publish(payload, topic=self.params['status'])
+            return
+
+        if not version:
+            candidates = [v for v in good if v != active]
+            if not candidates:
+                payload['err'] = 'nothing to roll back to'
+                payload['msg'] = '{0}-{1}: no known good version other than {2}'.format(
+                    payload['environment'], payload['application'], active)
+                with self.publish_batch():
+                    self.publish_to_error_queue(payload, header_frame=header_frame,
+                                                retry=False)
+                    self.publish(payload, topic=self.params['status'])
+                return
+            version = payload['version'] = candidates[0]
+
+        x = create_executioner(payload)
+        payload['msg'] = '{0}-{1} rollback from {2} to {3} starts'.format(
+            payload['environment'], payload['application'], active, version)
+        self.publish(payload, topic=self.params['status'])
+
+        command = app.config.get('ROLLBACK_COMMAND',
+                                 'eb deploy {environment}-{application} '
+                                 '--version {environment}:{version}')
+        try:
+            r = x.cmd(command.format(application=payload['application'],
+                                     environment=payload['environment'],
+                                     version=version))
+        except osutils.CommandError as e:
+            r = e.result
+
+        if r.retcode == 0:
+            payload['deployed'] = True
+            payload['tested'] = True
+            payload['msg'] = 'rolled back to {0}'.format(version)
+            with self.publish_batch():
+                self.publish(payload)
+                self.publish(payload, topic=self.params['status'])
+        else:
+            payload['err'] = 'rollback failed'
+            payload['deployed'] = False
+            payload['msg'] = 'rollback failed; {0}'.format(offload_output(payload, r))
+            with self.publish_batch():
+                self.publish_to_error_queue(payload, header_frame=header_frame,
+                                            retry=is_transient(r))
+                self.publish(payload, topic=self.params['status'])
 
 
 class Restart(RabbitMQWorker):
@@ -247,21 +602,28 @@ class Restart(RabbitMQWorker):
         self.publish(payload, topic=self.params['status'])
         
         r = None
-        if action == 'restart-soft':
-            r = x.cmd('./restart-soft {0}'.format(payload['environment']))
-        elif action == 'restart-hard':
-            r = x.cmd('./restart-hard {0}'.format(payload['environment']))
-        else:
-            self.publish_to_error_queue(payload)
+        try:
+            if action == 'restart-soft':
+                r = x.cmd('./restart-soft {0}'.format(payload['environment']))
+            elif action == 'restart-hard':
+                r = x.cmd('./restart-hard {0}'.format(payload['environment']))
+            else:
+                payload['err'] = 'Unknown action {0}'.format(action)
+        except osutils.CommandError as e:
+            r = e.result
             
         if r and r.retcode == 0:
             payload['msg'] = 'restart succeeded'
-            self.publish(payload)
-            self.publish(payload, topic=self.params['status'])
+            with self.publish_batch():
+                self.publish(payload)
+                self.publish(payload, topic=self.params['status'])
         else:
-            payload['msg'] = str(r)
-            self.publish_to_error_queue(payload, header_frame=header_frame)
-            self.publish(payload, topic=self.params['status'])
+            payload['msg'] = offload_output(payload, r) if r else payload.get('err', str(r))
+            with self.publish_batch():
+                # an unknown action will not get better by retrying
+                self.publish_to_error_queue(payload, header_frame=header_frame,
+                                            retry=r is not None)
+                self.publish(payload, topic=self.params['status'])
         
             
 class AfterDeploy(RabbitMQWorker):
@@ -275,12 +637,6 @@ class AfterDeploy(RabbitMQWorker):
         """Runs the cleanup after the deployment happened."""
         
         # reset the timer
-        key = '{0}.{1}.last-used'.format(payload['application'], payload['environment'])
-        now = time.time()
+        key = '{0}.{1}'.format(payload['application'], payload['environment'])
         with app.session_scope() as session:
-            u = session.query(KeyValue).filter_by(key=key).first()
-            if u is not None:
-                u.value = now
-            u = KeyValue(key=key, value=now)
-            session.add(u)
-            session.commit()
+            storage.put(session, storage.LAST_USED, key, time.time())
@@ -1,9 +1,133 @@
+"""Generic handling of error states
+
+The workers send the messages they failed to process to the error queue
+(RabbitMQWorker.publish_to_error_queue); the headers tell where the message
+failed and how many times it was already retried. The ErrorHandler sends it
+back to its queue through one of the retry queues:
+
+    <queue>.retry.<attempt>     holds the message for retry_delay(attempt)
+                                seconds, then dead-letters it to <queue>
+
+After RETRY_MAX_ATTEMPTS (or when retrying cannot help) the message is
+moved to the PARKING_LOT_QUEUE, where it waits for an operator:
+
+    python run.py --inspect-parking-lot
+    python run.py --replay-parking-lot
+"""
+
+from ADSDeploy import app, codec
 from ADSDeploy.pipeline import generic
 
-"""Generic handling of error states
 
-TODO: improve this worker"""
-        
+def retry_queue(queue, attempt):
+    """
+    :param queue: name of the queue the message failed in
+    :param attempt: number of the retry (1, 2...)
+    :return: name of the retry queue
+    """
+    return '{0}.retry.{1}'.format(queue, attempt)
+
+
+def retry_delay(attempt):
+    """
+    :param attempt: number of the retry (1, 2...)
+    :return: seconds the message waits before the retry
+    """
+    return app.config.get('RETRY_BASE_DELAY', 30) * \
+        app.config.get('RETRY_BACKOFF_FACTOR', 4) ** (attempt - 1)
+
+
 class ErrorHandler(generic.RabbitMQWorker):
-    def process_payload(self, msg):
-        pass
+    """
+    Retries the failed messages with exponential backoff, parks the ones
+    that keep failing
+    """
+
+    def process_payload(self, msg,
+                        channel=None,
+                        method_frame=None,
+                        header_frame=None):
+        headers = dict(getattr(header_frame, 'headers', None) or {})
+        origin = headers.get(generic.ORIGIN_HEADER)
+        attempt = generic.get_attempt(header_frame)
+        retry = headers.get(generic.RETRY_HEADER, True)
+
+        if origin and retry and attempt < app.config.get('RETRY_MAX_ATTEMPTS', 3):
+            headers[generic.ATTEMPT_HEADER] = attempt + 1
+            self.logger.info('Retrying a message of {0} in {1}s (attempt {2}): {3}'.format(
+                origin, retry_delay(attempt + 1), attempt + 1,
+                headers.get(generic.ERROR_HEADER)))
+            self.publish(msg, topic=retry_queue(origin, attempt + 1), headers=headers)
+        else:
+            self.logger.warning('Parking a message of {0} after {1} retries: {2}'.format(
+                origin, attempt, headers.get(generic.ERROR_HEADER)))
+            self.publish(msg, topic=app.config.get('PARKING_LOT_QUEUE',
+                                                   'ads.deploy.parking_lot'),
+                         headers=headers)
+
+
+def inspect_parking_lot(worker, limit=None):
+    """
+    Reads the parked messages without removing them
+
+    :param worker: RabbitMQWorker connected to RabbitMQ
+    :param limit: maximum number of messages
+    :return: list of (headers, message)
+    """
+    queue = app.config.get('PARKING_LOT_QUEUE', 'ads.deploy.parking_lot')
+    channel = worker.connection.channel()
+    out = []
+    try:
+        while limit is None or len(out) < limit:
+            method, properties, body = channel.basic_get(queue=queue)
+            if method is None:
+                break
+            out.append((dict(properties.headers or {}),
+                        codec.decode(body, properties)))
+    finally:
+        # nothing was acknowledged, the messages return to the queue
+        channel.close()
+    return out
+
+
+def replay_parking_lot(worker, limit=None):
+    """
+    Sends the parked messages back to the queues they failed in, with their
+    retries reset; messages of unknown origin stay parked. A message is only
+    removed from the parking lot once RabbitMQ confirmed that it was routed
+    to a queue; otherwise it goes back to the parking lot and the replay
+    stops (e.g. the queue does not exist anymore)
+
+    :param worker: RabbitMQWorker connected to RabbitMQ
+    :param limit: maximum number of messages
+    :return: number of replayed messages
+    """
+    queue = app.config.get('PARKING_LOT_QUEUE', 'ads.deploy.parking_lot')
+    channel = worker.connection.channel()
+    channel.confirm_delivery()
+    n = 0
+    try:
+        while limit is None or n < limit:
+            method, properties, body = channel.basic_get(queue=queue)
+            if method is None:
+                break
+            headers = dict(properties.headers or {})
+            origin = headers.pop(generic.ORIGIN_HEADER, None)
+            if not origin:
+                continue
+            for h in (generic.WORKER_HEADER, generic.ATTEMPT_HEADER,
+                      generic.RETRY_HEADER, generic.ERROR_HEADER, 'x-death'):
+                headers.pop(h, None)
+            properties.headers = headers
+            if not channel.basic_publish(exchange=app.config.get('EXCHANGE'),
+                                         routing_key=origin,
+                                         body=body,
+                                         properties=properties,
+                                         mandatory=True):
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=True)
+                break
+            channel.basic_ack(delivery_tag=method.delivery_tag)
+            n += 1
+    finally:
+        channel.close()
+    return n
@@ -1,13 +1,38 @@
 """
 Generic worker template
 """
-from .. import utils, app
+from .. import utils, app, codec
+from multiprocessing.pool import ThreadPool
+import collections
+import contextlib
+import Queue
 import pika
+import random
 import sys
-import json
+import threading
+import time
 import traceback
 
 
+# headers of the messages sent to the error queue (see errors.ErrorHandler)
+ORIGIN_HEADER = 'x-origin'
+WORKER_HEADER = 'x-worker'
+ATTEMPT_HEADER = 'x-attempt'
+RETRY_HEADER = 'x-retry'
+ERROR_HEADER = 'x-error'
+
+
+def get_attempt(properties):
+    """
+    :param properties: pika.BasicProperties of a message (or None)
+    :return: how many times the message was already retried
+    """
+    headers = getattr(properties, 'headers', None)
+    if not isinstance(headers, dict):
+        return 0
+    return int(headers.get(ATTEMPT_HEADER) or 0)
+
+
 class RabbitMQWorker(object):
     """
     Base worker class. Defines the plumbing to communicate with rabbitMQ
@@ -33,7 +58,11 @@ class RabbitMQWorker(object):
         self.channel = None
         self.fwd_topic = None
         self.fwd_exchange = None
+        self._batch = None
+        self._tx_channels = {}
         app.init_app()
+        self._publish_buffer = collections.deque(
+            maxlen=app.config.get('PUBLISH_BUFFER_SIZE', 1000))
         
         if 'publish' in self.params and self.params['publish']:
             self.publish_topic = self.params['publish']
@@ -58,6 +87,7 @@ class RabbitMQWorker(object):
         """
 
         try:
+            self._tx_channels = {}
             self.connection = pika.BlockingConnection(pika.URLParameters(url))
             self.channel = self.connection.channel()
             if confirm_delivery:
@@ -89,16 +119,22 @@ class RabbitMQWorker(object):
             raise Exception(sys.exc_info())
 
     def publish_to_error_queue(self, message, exchange=None, routing_key=None,
-                               **kwargs):
+                               retry=True, error=None, **kwargs):
         """
-        Publishes messages to the error queue. Prefixes the message with the
-        worker that passed on the message.
+        Publishes messages to the error queue. The headers of the message
+        say which worker (and queue) it failed in and how many times it was
+        already retried; the ErrorHandler uses them to retry the message
+        later or to park it.
 
         :param message: message received from the queue
         :param exchange: name of the exchange that contains the error queue
         :param routing_key: routing key for the error queue
-        :param kwargs: extra keywords that may be needed
-        :return: no return1
+        :param retry: False if retrying cannot help (e.g. an unknown
+            application)
+        :param error: description of the failure
+        :param kwargs: extra keywords that may be needed (header_frame: the
+            properties of the received message)
+        :return: no return
         """
         if not exchange:
             exchange = self.params.get('exchange', 'ads-deploy')
@@ -106,7 +142,47 @@ class RabbitMQWorker(object):
         if not routing_key:
             routing_key = self.params.get('error', 'ads.deploy.error')
 
-        self.publish(message, topic=routing_key, properties=kwargs['header_frame'])
+        headers = {
+            ORIGIN_HEADER: self.params.get('subscribe'),
+            WORKER_HEADER: self.__class__.__name__,
+            ATTEMPT_HEADER: get_attempt(kwargs.get('header_frame')),
+            RETRY_HEADER: retry
+        }
+        if error is None and isinstance(message, dict):
+            error = message.get('err') or message.get('msg')
+        if error:
+            headers[ERROR_HEADER] = unicode(error)[:1000]
+
+        self.publish(message, topic=routing_key, headers=headers)
+
+    def delay(self, message, seconds):
+        """
+        Publishes the message into the worker's delay queue (params['delay']);
+        it returns to the worker's queue after the given number of seconds
+
+        :param message: dict or an already serialised str
+        :param seconds: how long it waits
+        """
+        body, properties = self.encode(message, delivery_mode=2,
+                                       expiration=str(int(seconds * 1000)))
+        self.channel.basic_publish(exchange=self.exchange,
+                                   routing_key=self.params['delay'],
+                                   body=body,
+                                   properties=properties)
+
+    def encode(self, message, **kwargs):
+        """
+        Serialises the message (see ADSDeploy.codec)
+
+        :param message: dict or an already serialised str
+        :param kwargs: other pika.BasicProperties
+        :return: (body, pika.BasicProperties)
+        """
+        return codec.encode(
+            message,
+            compress_threshold=app.config.get('MESSAGE_COMPRESS_THRESHOLD', 16*1024),
+            compress_level=app.config.get('MESSAGE_COMPRESS_LEVEL', 6),
+            **kwargs)
 
     def forward(self, message, topic=None, **kwargs):
         """
@@ -124,13 +200,17 @@ class RabbitMQWorker(object):
                                     self.fwd_exchange,
                                     topic or self.fwd_topic))
         
-        if not isinstance(message, basestring):
-            message = json.dumps(message)
+        body, properties = self.encode(message)
+        if self._batch is not None:
+            self._batch.append(('forward', self.fwd_exchange,
+                                topic or self.fwd_topic, body, properties))
+            return
         self.fwd_channel.basic_publish(exchange=self.fwd_exchange,
                                    routing_key=topic or self.fwd_topic,
-                                   body=message)
+                                   body=body,
+                                   properties=properties)
 
-    def publish(self, message, topic=None, **kwargs):
+    def publish(self, message, topic=None, headers=None, priority=None, **kwargs):
         """
         Publishes messages to the queue. Uses the generic template for the
         relevant worker, which is defined in the pipeline settings module.
@@ -138,6 +218,9 @@ class RabbitMQWorker(object):
         :param message: message to be publishes
         :param topic: String (the routing key) - overrides this worker's 
                routing key
+        :param headers: dict of message headers
+        :param priority: priority of the message; by default the 'priority'
+            of the message (see utils.get_priority)
         :param kwargs: extra keywords that may be needed
         :return: no return
         """
@@ -154,11 +237,180 @@ class RabbitMQWorker(object):
                                     self.exchange,
                                     topic or self.publish_topic))
         
-        if not isinstance(message, basestring):
-            message = json.dumps(message)
-        self.channel.basic_publish(exchange=self.exchange,
-                                   routing_key=topic or self.publish_topic,
-                                   body=message)
+        if priority is None and isinstance(message, dict):
+            priority = message.get('priority')
+        body, properties = self.encode(message, headers=headers, priority=priority)
+        record = (self.exchange, topic or self.publish_topic, body, properties)
+        if self._batch is not None:
+            self._batch.append(('publish',) + record)
+            return
+        if self._publish_buffer:
+            # older messages are waiting, keep the order
+            self.buffer_message(*record)
+            try:
+                self.flush_publish_buffer()
+            except pika.exceptions.AMQPError as e:
+                self.logger.warning('Cannot publish ({0!r}), {1} messages buffered'
+                                    .format(e, len(self._publish_buffer)))
+            return
+
+        try:
+            self.channel.basic_publish(exchange=record[0],
+                                       routing_key=record[1],
+                                       body=body,
+                                       properties=properties)
+        except pika.exceptions.AMQPError as e:
+            self.logger.warning('Cannot publish ({0!r}), buffering the message'.format(e))
+            self.buffer_message(*record)
+
+    @contextlib.contextmanager
+    def publish_batch(self):
+        """
+        Collects the messages published (and forwarded) inside the block
+        and sends them together when it exits, in one transaction per
+        connection: the broker has all of them once the single tx.commit
+        round-trip returns. The messages are sent even if the block raises.
+
+            with self.publish_batch():
+                self.publish(payload)
+                self.publish(payload, topic=self.params['status'])
+
+        If the transaction fails, the published messages go to the publish
+        buffer (see flush_publish_buffer()) and the forwarded ones raise.
+        """
+        if self._batch is not None:
+            # nested: the outer block sends everything
+            yield
+            return
+
+        self._batch = []
+        try:
+            yield
+        finally:
+            batch, self._batch = self._batch, None
+            self.send_batch([r[1:] for r in batch if r[0] == 'publish'])
+            self.send_batch([r[1:] for r in batch if r[0] == 'forward'], forward=True)
+
+    def _get_tx_channel(self, forward=False):
+        """
+        :return: channel in transaction mode on the main (or the forwarding)
+            connection; it is opened on first use
+        """
+        key = 'forward' if forward else 'publish'
+        channel = self._tx_channels.get(key)
+        if channel is None or not channel.is_open:
+            connection = self.fwd_connection if forward else self.connection
+            channel = connection.channel()
+            channel.tx_select()
+            self._tx_channels[key] = channel
+        return channel
+
+    def send_batch(self, records, forward=False):
+        """
+        Publishes the messages in one transaction
+
+        :param records: list of (exchange, routing_key, body, properties)
+        :param forward: send over the forwarding connection
+        :return: no return
+        """
+        if not records:
+            return
+        if not forward and self._publish_buffer:
+            # older messages are waiting, keep the order
+            for record in records:
+                self.buffer_message(*record)
+            try:
+                self.flush_publish_buffer()
+            except pika.exceptions.AMQPError as e:
+                self.logger.warning('Cannot publish ({0!r}), {1} messages buffered'
+                                    .format(e, len(self._publish_buffer)))
+            return
+
+        try:
+            channel = self._get_tx_channel(forward)
+            for exchange, routing_key, body, properties in records:
+                channel.basic_publish(exchange=exchange,
+                                      routing_key=routing_key,
+                                      body=body,
+                                      properties=properties)
+            channel.tx_commit()
+        except pika.exceptions.AMQPError as e:
+            self._tx_channels.pop('forward' if forward else 'publish', None)
+            if forward:
+                self.logger.error('Cannot forward {0} messages: {1!r}'.format(len(records), e))
+                raise
+            self.logger.warning('Cannot publish {0} messages ({1!r}), buffering them'
+                                .format(len(records), e))
+            for record in records:
+                self.buffer_message(*record)
+
+    def buffer_message(self, exchange, routing_key, body, properties):
+        """
+        Keeps a message that could not be published; it is published by
+        flush_publish_buffer(). When the buffer is full (PUBLISH_BUFFER_SIZE)
+        the oldest message is dropped.
+
+        :param exchange: name of the exchange
+        :param routing_key: routing key
+        :param body: encoded message
+        :param properties: pika.BasicProperties
+        :return: no return
+        """
+        if len(self._publish_buffer) == self._publish_buffer.maxlen:
+            self.logger.error('Publish buffer is full, dropping a message for {0}: {1!r}'
+                              .format(self._publish_buffer[0][1],
+                                      self._publish_buffer[0][2][:200]))
+        self._publish_buffer.append((exchange, routing_key, body, properties))
+
+    def flush_publish_buffer(self):
+        """
+        Publishes the buffered messages, in order, over a channel with
+        publisher confirms; a message leaves the buffer only once the broker
+        confirmed it.
+
+        :return: number of published messages
+        """
+        if not self._publish_buffer:
+            return 0
+
+        channel = self.connection.channel()
+        channel.confirm_delivery()
+        n = 0
+        try:
+            while self._publish_buffer:
+                exchange, routing_key, body, properties = self._publish_buffer[0]
+                if not channel.basic_publish(exchange=exchange,
+                                             routing_key=routing_key,
+                                             body=body,
+                                             properties=properties):
+                    self.logger.warning('Broker refused a buffered message for {0}, '
+                                        '{1} messages left'.format(
+                                            routing_key, len(self._publish_buffer)))
+                    break
+                self._publish_buffer.popleft()
+                n += 1
+        finally:
+            if channel.is_open:
+                channel.close()
+        self.logger.info('Published {0} buffered messages'.format(n))
+        return n
+
+    def ack(self, delivery_tag):
+        """
+        Acknowledges a message. If the connection is gone, the broker will
+        redeliver the message (to this worker after it reconnects, or to
+        another one) and it is processed again.
+
+        :param delivery_tag: delivery tag of the message
+        :return: True if the message was acknowledged
+        """
+        try:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+            return True
+        except pika.exceptions.AMQPError as e:
+            self.logger.warning('Cannot acknowledge message {0} ({1!r}), it will '
+                                'be redelivered'.format(delivery_tag, e))
+            return False
 
     def subscribe(self, callback, **kwargs):
         """
@@ -203,7 +455,20 @@ class RabbitMQWorker(object):
         """
 
         self.logger.debug('Obtaining message from queue')
-        message = json.loads(body)
+        try:
+            message = codec.decode(body, header_frame)
+        except Exception as e:
+            # e.g. an unsupported envelope/encoding: processing it again
+            # cannot help, it waits (as it is) for an operator
+            self.logger.error('Parking an undecodable message: {0!r}'.format(e))
+            self.channel.basic_publish(
+                exchange=self.exchange,
+                routing_key=app.config.get('PARKING_LOT_QUEUE', 'ads.deploy.parking_lot'),
+                body=body,
+                properties=header_frame)
+            self.ack(method_frame.delivery_tag)
+            return
+
         try:
             self.logger.debug('Running on message')
             self.results = self.process_payload(message, 
@@ -218,19 +483,232 @@ class RabbitMQWorker(object):
                                 '{0} ({1})'.format(e.message,
                                                    traceback.format_exc()))
 
-            self.publish_to_error_queue(json.dumps(
-                {self.__class__.__name__: message}),
-                header_frame=header_frame
-            )
+            self.publish_to_error_queue(message,
+                                        header_frame=header_frame,
+                                        error=e.message or repr(e))
 
         # Send delivery acknowledgement
-        self.channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        self.ack(method_frame.delivery_tag)
+
+    def reconnect_wait(self, delay):
+        """
+        Sleeps before the next connection attempt
+
+        :param delay: the previous delay (0 after a successful connection)
+        :return: the new delay; it doubles up to RABBITMQ_RECONNECT_MAX_BACKOFF
+            and the actual sleep is jittered so that the workers do not
+            reconnect all at once
+        """
+        delay = min(max(delay * 2, 1),
+                    app.config.get('RABBITMQ_RECONNECT_MAX_BACKOFF', 30))
+        self.logger.info('Reconnecting to RabbitMQ in {0}s'.format(delay))
+        time.sleep(delay * random.uniform(0.5, 1))
+        return delay
 
     def run(self):
         """
         Wrapper function that both connects the worker to the RabbitMQ instance
-        and starts it consuming messages.
+        and starts it consuming messages. When the connection is lost, the
+        worker reconnects (with backoff), publishes the messages that were
+        buffered meanwhile and resumes consuming.
         :return: no return
         """
-        self.connect(self.params['RABBITMQ_URL'])
-        self.subscribe(self.on_message)
+        if self.params.get('TEST_RUN', False):
+            self.connect(self.params['RABBITMQ_URL'])
+            self.subscribe(self.on_message)
+            return
+
+        delay = 0
+        while True:
+            try:
+                self.connect(self.params['RABBITMQ_URL'])
+            except Exception:
+                delay = self.reconnect_wait(delay)
+                continue
+
+            delay = 0
+            try:
+                self.flush_publish_buffer()
+                self.subscribe(self.on_message)
+                return
+            except pika.exceptions.AMQPError as e:
+                self.logger.warning('Lost the connection to RabbitMQ: {0!r}'.format(e))
+                try:
+                    self.connection.close()
+                except Exception:
+                    pass
+                delay = self.reconnect_wait(delay)
+
+
+class _ChannelProxy(object):
+    """
+    Channel of the AsyncRabbitMQWorker: calls made from the handler threads
+    (publish, basic_ack...) are handed over to the ioloop thread, which owns
+    the connection (see AsyncWorkerMixin._poll)
+    """
+
+    def __init__(self, worker, channel):
+        self._worker = worker
+        self._channel = channel
+
+    def __getattr__(self, name):
+        attr = getattr(self._channel, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            if threading.current_thread() is self._worker._ioloop_thread:
+                return attr(*args, **kwargs)
+            self._worker._calls.put((self._channel, name, args, kwargs))
+        return call
+
+
+class AsyncWorkerMixin(object):
+    """
+    Consumes with a pika.SelectConnection: the ioloop owns the connection
+    (and keeps the heartbeats going) while up to 'max_inflight' messages are
+    processed concurrently by a thread pool. process_payload() and
+    on_message() run unchanged in the pool; whatever they do with the
+    channel (publishing, acknowledging) is executed by the ioloop thread.
+
+    Use it with make_async(), or set 'engine': 'async' in the worker's
+    parameters (see config.WORKERS).
+
+    When the connection is lost the worker reconnects; messages published
+    meanwhile are published on the new channel, acknowledgements of
+    messages received on the old one are dropped (the broker redelivers
+    those messages).
+    """
+
+    def run(self):
+        """
+        Connects to the RabbitMQ instance and consumes, reconnecting when
+        the connection is lost, until stop() is called
+        """
+        if self.params.get('TEST_RUN', False) or self.params.get('forwarding'):
+            # consuming one message / forwarding needs the blocking connection
+            return super(AsyncWorkerMixin, self).run()
+
+        self.max_inflight = int(self.params.get('max_inflight', 4))
+        self._calls = Queue.Queue()
+        self._pool = ThreadPool(self.max_inflight)
+        self._ioloop_thread = threading.current_thread()
+        self._stopped = False
+
+        delay = 0
+        try:
+            while not self._stopped:
+                self._closing = False
+                self._consuming = False
+                self.connection = pika.SelectConnection(
+                    pika.URLParameters(self.params['RABBITMQ_URL']),
+                    on_open_callback=self._on_connection_open,
+                    on_open_error_callback=self._on_connection_error,
+                    stop_ioloop_on_close=True)
+                self.connection.ioloop.start()
+
+                if self._stopped:
+                    break
+                if self._consuming:
+                    delay = 0
+                delay = self.reconnect_wait(delay)
+        finally:
+            self._pool.close()
+
+    @contextlib.contextmanager
+    def publish_batch(self):
+        """
+        Publishing does not wait for the broker here (the ioloop sends the
+        messages), there is nothing to batch
+        """
+        yield
+
+    def stop(self):
+        """
+        Closes the connection (it can be called from any thread); the
+        messages being processed are not acknowledged
+        """
+        self._stopped = True
+        self._calls.put((None, 'close', (), {}))
+
+    def _on_connection_error(self, connection, error=None):
+        self.logger.error('Cannot connect to RabbitMQ: {0}'.format(error))
+        connection.ioloop.stop()
+
+    def _on_connection_open(self, connection):
+        connection.channel(on_open_callback=self._on_channel_open)
+
+    def _on_channel_open(self, channel):
+        self.channel = _ChannelProxy(self, channel)
+        channel.add_on_close_callback(self._on_channel_closed)
+        channel.basic_qos(self._on_qos_ok, prefetch_count=self.max_inflight)
+
+    def _on_channel_closed(self, channel, reply_code=None, reply_text=None):
+        self.logger.warning('Channel closed: {0} {1}'.format(reply_code, reply_text))
+        self._closing = True
+        if not (self.connection.is_closing or self.connection.is_closed):
+            self.connection.close()
+
+    def _on_qos_ok(self, frame):
+        self.subscribe_topic = self.params['subscribe']
+        self.channel._channel.basic_consume(self._on_delivery,
+                                            queue=self.subscribe_topic)
+        self.logger.debug('Worker consuming from queue: {0} ({1} in flight)'
+                          .format(self.subscribe_topic, self.max_inflight))
+        self._consuming = True
+        self._poll()
+
+    def _on_delivery(self, channel, method_frame, header_frame, body):
+        self._pool.apply_async(self._handle, (method_frame, header_frame, body))
+
+    def _handle(self, method_frame, header_frame, body):
+        """Runs in the pool"""
+        try:
+            self.on_message(self.channel, method_frame, header_frame, body)
+        except Exception:
+            # do not let a failing message occupy a slot forever
+            self.logger.error('Rejecting message: {0}'.format(traceback.format_exc()))
+            self.channel.basic_reject(delivery_tag=method_frame.delivery_tag,
+                                      requeue=False)
+
+    def _poll(self):
+        """Executes the channel calls of the handlers, on the ioloop thread"""
+        current = self.channel._channel
+        while True:
+            try:
+                channel, name, args, kwargs = self._calls.get_nowait()
+            except Queue.Empty:
+                break
+            if channel is None:
+                # stop()
+                self._closing = True
+                self.connection.close()
+                return
+            if channel is not current:
+                if name != 'basic_publish':
+                    # the delivery tags belong to the old channel
+                    self.logger.debug('Dropping {0} from a closed channel'.format(name))
+                    continue
+                channel = current
+            try:
+                getattr(channel, name)(*args, **kwargs)
+            except Exception:
+                self.logger.error('Channel call failed: {0}'.format(traceback.format_exc()))
+        if not self._closing:
+            self.connection.add_timeout(self.params.get('poll_interval', 0.05), self._poll)
+
+
+class AsyncRabbitMQWorker(AsyncWorkerMixin, RabbitMQWorker):
+    """
+    Base class of the workers that process messages concurrently
+    """
+
+
+def make_async(cls):
+    """
+    :param cls: subclass of RabbitMQWorker
+    :return: subclass of cls that consumes with AsyncWorkerMixin
+    """
+    if issubclass(cls, AsyncWorkerMixin):
+        return cls
+    return type(cls.__name__, (AsyncWorkerMixin, cls), {})
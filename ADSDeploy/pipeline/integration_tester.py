@@ -6,10 +6,11 @@ carries out integration tests
 
 import os
 import git
+import time
 import shutil
 import subprocess
 
-from .. import app
+from .. import app, storage
 from ..utils import ChangeDirectory
 from generic import RabbitMQWorker
 from collections import OrderedDict
@@ -111,8 +112,83 @@ class IntegrationTestWorker(RabbitMQWorker):
 
         return msg
 
+    @staticmethod
+    def adsrex_commit():
+        """
+        :return: the commit of the adsrex branch (without cloning it), None
+            if it cannot be found
+        """
+        try:
+            out = git.cmd.Git().ls_remote(ADS_REX_URL, 'refs/heads/{}'.format(ADS_REX_BRANCH))
+        except Exception:
+            return None
+        return out.split()[0] if out else None
+
+    @staticmethod
+    def result_ttl(msg):
+        """
+        :param msg: payload with the 'application' and 'environment'
+        :return: seconds a passed test run of the version is reused, from
+            TEST_RESULT_TTL['<application>.<environment>'] (or
+            ['<application>'], or ['default']); 0 disables the cache
+        """
+        ttls = app.config.get('TEST_RESULT_TTL', {})
+        application = msg.get('application')
+        for key in ('{0}.{1}'.format(application, msg.get('environment')),
+                    application, 'default'):
+            if key in ttls:
+                return ttls[key] or 0
+        return 0
+
+    def cache_key(self, msg):
+        """
+        :param msg: payload
+        :return: key of the test result of the version, None if it must not
+            be cached (no version, the cache is disabled, adsrex is unknown)
+        """
+        if not msg.get('version') or not self.result_ttl(msg):
+            return None
+        commit = self.adsrex_commit()
+        if commit is None:
+            return None
+        # the versions are tags of the repository of each service (the
+        # environment), so the same version string is another build elsewhere
+        return '|'.join([msg['application'], msg.get('environment', ''), msg['version'],
+                         commit, ADS_REX_LOCAL_CONFIG['API_BASE']])
+
+    @staticmethod
+    def cached_result(key):
+        """
+        :param key: cache_key()
+        :return: the verdict (dict) if it did not expire, else None
+        """
+        with app.session_scope() as session:
+            expires = storage.get(session, storage.TEST_RESULT_EXPIRY, key)
+            if expires is None or expires <= time.time():
+                return None
+            return storage.get(session, storage.TEST_RESULT, key)
+
+    @staticmethod
+    def cache_result(key, verdict, ttl):
+        """
+        Stores the verdict for ttl seconds (and removes the expired ones)
+        """
+        now = time.time()
+        with app.session_scope() as session:
+            expired = storage.scan_below(session, storage.TEST_RESULT_EXPIRY, now)
+            if expired:
+                storage.delete(session, storage.TEST_RESULT, expired)
+                storage.delete(session, storage.TEST_RESULT_EXPIRY, expired)
+            storage.put(session, storage.TEST_RESULT, key, verdict)
+            storage.put(session, storage.TEST_RESULT_EXPIRY, key, now + ttl)
+
     def process_payload(self, msg, **kwargs):
         """
+        Runs the tests, unless this version already passed them against the
+        same adsrex commit and API_BASE (within TEST_RESULT_TTL); only the
+        passed runs are cached, a failure may have been caused by the test
+        environment
+
         :param msg: payload, example:
             {'foo': '....',
             'bar': ['.....']}
@@ -121,7 +197,21 @@ class IntegrationTestWorker(RabbitMQWorker):
 
         # do something with the payload
         msg = dict(msg)
-        result = self.run_test(msg=msg)
+        key = self.cache_key(msg)
+        cached = self.cached_result(key) if key else None
+        if cached is not None:
+            msg[ADS_REX_PASS_KEYWORD] = cached[ADS_REX_PASS_KEYWORD]
+            msg['msg'] = 'tests skipped, {0} passed them on {1}'.format(
+                msg['version'], cached['date'])
+            self.logger.info('{0}: cached test result'.format(key))
+            result = msg
+        else:
+            result = self.run_test(msg=msg)
+            if key and result[ADS_REX_PASS_KEYWORD]:
+                self.cache_result(key, {
+                    ADS_REX_PASS_KEYWORD: True,
+                    'date': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+                }, self.result_ttl(msg))
 
         if not msg.get('application', None):
             self.logger.error('Application keyword was not specified.')
@@ -130,5 +220,6 @@ class IntegrationTestWorker(RabbitMQWorker):
         # publish the results into the queue
         self.logger.info('Publishing to queue: {}'.format(self.publish_topic))
 
-        self.publish(result)
-        self.publish(result, topic=self.params['status'])
+        with self.publish_batch():
+            self.publish(result)
+            self.publish(result, topic=self.params['status'])
@@ -8,12 +8,13 @@ Pipeline to extract full text documents. It carries out the following:
 """
 
 
-from ADSDeploy import app
+from ADSDeploy import app, rollout
 from ADSDeploy.pipeline import generic, deploy, db_writer, integration_tester, workers, errors
 from ADSDeploy.utils import setup_logging
 from copy import deepcopy
 import multiprocessing
 import os
+import pika
 import signal
 import sys
 import threading
@@ -58,6 +59,8 @@ class TaskMaster(Singleton):
         self.rabbitmq_routes = deepcopy(rabbitmq_routes)
         self.workers = deepcopy(workers)
         self.running = False
+        self.publisher = None
+        self.rollouts = None
 
     def quit(self, os_signal, frame):
         """
@@ -82,6 +85,32 @@ class TaskMaster(Singleton):
             self.running = False
             sys.exit(0)
 
+    def declare_queue(self, channel, qname, durable=True, arguments=None,
+                      routing_key=None):
+        """
+        Declares a queue and binds it to the exchange
+
+        :param channel: pika channel
+        :param qname: name of the queue (and its routing key)
+        :param durable: if the queue survives a restart of the broker
+        :param arguments: queue arguments (x-max-priority, dead letters...);
+            RabbitMQ refuses to re-declare an existing queue with others
+        :param routing_key: of the binding (default: the name of the queue)
+        :return: no return
+        """
+        channel.queue_declare(
+                    queue=qname,
+                    passive=False,
+                    exclusive=False,
+                    durable=durable,
+                    auto_delete=False,
+                    arguments=arguments)
+        # make sure messages are properly routed
+        channel.queue_bind(
+            queue=qname,
+            exchange=self.exchange,
+            routing_key=routing_key or qname)
+
     def initialize_rabbitmq(self):
         """
         Sets up the correct routes, exchanges, and bindings on the RabbitMQ
@@ -92,6 +121,10 @@ class TaskMaster(Singleton):
 
         w = generic.RabbitMQWorker()
         w.connect(self.rabbitmq_url)
+
+        # the queues of the workers deliver the higher priorities first
+        max_priority = app.config.get('QUEUE_MAX_PRIORITY')
+        arguments = {'x-max-priority': max_priority} if max_priority else None
         
         # make sure the exchange is there
         w.channel.exchange_declare(
@@ -107,54 +140,47 @@ class TaskMaster(Singleton):
             for qname, qvals in self.rabbitmq_routes.items():
                 if qname not in queues:
                     queues[qname] = qvals.has_key('durable') and qvals['durable']
-                w.channel.queue_declare(
-                            queue=qname, 
-                            passive=False, 
-                            durable=queues[qname], 
-                            exclusive=False, 
-                            auto_delete=False)
-                # make sure messages are properly routed
-                w.channel.queue_bind(
-                    queue=qname, 
-                    exchange=self.exchange, 
-                    routing_key=qvals['routing_key'] or qname)
+                self.declare_queue(w.channel, qname, queues[qname], arguments,
+                                   routing_key=qvals.get('routing_key'))
             
         for worker in self.workers.values():
             if worker.get('subscribe', None):
                 qname = worker['subscribe']
                 if qname not in queues:
                     queues[qname] = worker.has_key('durable') and worker['durable']
-                    
-                w.channel.queue_declare(
-                            queue=worker['subscribe'],
-                            durable = queues[qname], 
-                            passive=False,  
-                            exclusive=False, 
-                            auto_delete=False)
-                
-                # make sure messages are properly routed
-                w.channel.queue_bind(
-                    queue=qname, 
-                    exchange=self.exchange, 
-                    routing_key=qname)
+                self.declare_queue(w.channel, qname, queues[qname], arguments)
                 
+            if worker.get('delay', None):
+                # messages wait here (for their expiration) and then
+                # return to the worker's queue
+                qname = worker['delay']
+                queues[qname] = True
+                self.declare_queue(w.channel, qname, arguments={
+                    'x-dead-letter-exchange': self.exchange,
+                    'x-dead-letter-routing-key': worker['subscribe']
+                })
+
+            if worker.get('subscribe', None) and worker.get('error', None):
+                # failed messages wait here (see errors.ErrorHandler) and
+                # then return to the worker's queue
+                for attempt in range(1, app.config.get('RETRY_MAX_ATTEMPTS', 3) + 1):
+                    qname = errors.retry_queue(worker['subscribe'], attempt)
+                    queues[qname] = True
+                    self.declare_queue(w.channel, qname, arguments={
+                        'x-message-ttl': int(errors.retry_delay(attempt) * 1000),
+                        'x-dead-letter-exchange': self.exchange,
+                        'x-dead-letter-routing-key': worker['subscribe']
+                    })
+
             if worker.get('publish', None):
                 qname = worker['publish']
                 if qname not in queues:
                     queues[qname] = worker.has_key('durable') and worker['durable']
+                self.declare_queue(w.channel, qname, queues[qname], arguments)
 
-                w.channel.queue_declare(
-                            queue=worker['publish'], 
-                            passive=False,  
-                            exclusive=False,
-                            durable=queues[qname], 
-                            auto_delete=False)
-                
-                # make sure messages are properly routed
-                w.channel.queue_bind(
-                    queue=qname, 
-                    exchange=self.exchange, 
-                    routing_key=qname)
+        # messages that failed RETRY_MAX_ATTEMPTS times
+        self.declare_queue(
+            w.channel, app.config.get('PARKING_LOT_QUEUE', 'ads.deploy.parking_lot'))
         
         w.connection.close()
 
@@ -175,6 +201,20 @@ class TaskMaster(Singleton):
         while self.running:
 
             time.sleep(poll_interval)
+            try:
+                if app.reload_config():
+                    logger.info('Configuration reloaded (changes of WORKERS '
+                                'and QUEUES need a restart of the pipeline)')
+            except Exception as e:
+                logger.error('Cannot reload the configuration: {0}'.format(e))
+
+            # the rollouts run eb commands, they must not hold up the workers
+            if self.rollouts is None or not self.rollouts.is_alive():
+                self.rollouts = threading.Thread(target=self.rollout_loop,
+                                                 args=(poll_interval,))
+                self.rollouts.daemon = True
+                self.rollouts.start()
+
             for worker, params in self.workers.iteritems():
                 for active in params['active']:
                     if not active['proc'].is_alive():
@@ -198,6 +238,63 @@ class TaskMaster(Singleton):
 
             self.start_workers(verbose=False, extra_params=extra_params)
 
+    def rollout_loop(self, poll_interval=60):
+        """
+        Advances the rollouts every poll_interval (in its own thread, see
+        poll_loop)
+
+        :param poll_interval: how often to advance them
+        :return: no return
+        """
+        while self.running:
+            try:
+                self.advance_rollouts()
+            except Exception as e:
+                logger.error('Cannot advance the rollouts: {0!r}'.format(e))
+            time.sleep(poll_interval)
+
+    def advance_rollouts(self):
+        """
+        Moves the active rollouts (see ADSDeploy/rollout.py) to their next
+        state; the deploy requests of their waves go to ROLLOUT_QUEUE
+
+        :return: no return
+        """
+        rollout.tick(self.publish_rollout, logger=logger)
+
+    def publish_rollout(self, payload):
+        """
+        Sends a deploy request of a rollout to ROLLOUT_QUEUE and waits for the
+        broker to confirm it. Unlike RabbitMQWorker.publish it does not buffer
+        the message when it cannot be sent: it raises, so that the step of
+        the rollout is rolled back and retried by the next tick.
+
+        :param payload: deploy request (dict)
+        :return: no return
+        """
+        if self.publisher is None or not self.publisher.connection.is_open:
+            self.publisher = generic.RabbitMQWorker({
+                'exchange': self.exchange,
+                'publish': app.config.get('ROLLOUT_QUEUE', 'ads.deploy.before_deploy')
+            })
+            self.publisher.connect(self.rabbitmq_url, confirm_delivery=True)
+
+        body, properties = self.publisher.encode(payload, delivery_mode=2,
+                                                 priority=payload.get('priority'))
+        try:
+            confirmed = self.publisher.channel.basic_publish(
+                exchange=self.exchange,
+                routing_key=self.publisher.publish_topic,
+                body=body,
+                properties=properties,
+                mandatory=True)
+        except pika.exceptions.AMQPError:
+            self.publisher = None
+            raise
+        if not confirmed:
+            raise IOError('The broker did not confirm the deploy request of {0}-{1}'
+                          .format(payload.get('environment'), payload.get('application')))
+
     def start_workers(self, verbose=True, extra_params=False):
         """
         Starts the workers and the relevant number of them wanted by the user,
@@ -223,7 +320,10 @@ class TaskMaster(Singleton):
             
             conc = params.get('concurrency', 1)
             while len(params['active']) < conc:
-                w = eval('{0}'.format(worker))(params)
+                cls = eval('{0}'.format(worker))
+                if params.get('engine') == 'async':
+                    cls = generic.make_async(cls)
+                w = cls(params)
                 
                 # decide if we want to run it multiprocessing
                 if conc > 1:
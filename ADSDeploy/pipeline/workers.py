@@ -4,4 +4,4 @@ Place holder for all workers
 """
 from .integration_tester import IntegrationTestWorker
 from .db_writer import DatabaseWriterWorker
-from .deploy import BeforeDeploy, Deploy, Restart, GithubDeploy
\ No newline at end of file
+from .deploy import BeforeDeploy, Deploy, Restart, Rollback, GithubDeploy
\ No newline at end of file
@@ -0,0 +1,289 @@
+"""
+Staged rollouts
+
+A rollout deploys one version to ordered waves of environments: the
+environments of a wave are deployed in parallel (as a deploy group, see
+ADSDeploy/groups.py), the next wave starts when every environment of the
+current one is deployed, passed the integration tests (IntegrationTestWorker)
+and is healthy (Ready and Green). The first wave is the canary.
+
+    pending         created, the first wave was not started yet
+    running         the current wave is being deployed
+    succeeded       every wave passed
+    rolling back    a wave failed; the environments the rollout changed are
+                    being deployed with their previous versions
+    rolled back     the rollback finished
+    failed          a wave failed (and on_failure was 'stop'), or the
+                    rollback failed
+
+A wave fails when one of its environments fails to deploy, fails the tests,
+is superseded by a newer request, is not healthy, or when the wave takes more
+than ROLLOUT_WAVE_TIMEOUT seconds. The state is kept in the database
+(models.Rollout); the TaskMaster advances the active rollouts (tick()) every
+POLL_INTERVAL, so a restarted TaskMaster resumes them.
+"""
+
+import json
+import uuid
+from datetime import datetime
+
+from sqlalchemy import func
+
+from . import app, groups, utils
+from .models import Deployment, Rollout
+
+ACTIVE = ('pending', 'running', 'rolling back')
+ON_FAILURE = ('stop', 'rollback')
+
+
+def create(session, version, waves, on_failure=None):
+    """
+    Records a new rollout (the TaskMaster starts it)
+
+    :param session: SQLAlchemy session
+    :param version: version to deploy
+    :param waves: list of lists of '<application>.<environment>'
+    :param on_failure: 'stop' or 'rollback' (default: ROLLOUT_ON_FAILURE)
+    :return: models.Rollout; raises ValueError if the waves are invalid
+    """
+    on_failure = on_failure or app.config.get('ROLLOUT_ON_FAILURE', 'rollback')
+    if on_failure not in ON_FAILURE:
+        raise ValueError('on_failure must be one of {0}'.format(', '.join(ON_FAILURE)))
+    if not version:
+        raise ValueError('Missing version')
+    if not isinstance(waves, list) or not waves:
+        raise ValueError('waves must be a non-empty list of lists of environments')
+    seen = set()
+    for wave in waves:
+        if not isinstance(wave, list) or not wave:
+            raise ValueError('Every wave must be a non-empty list of environments')
+        for target in wave:
+            if not isinstance(target, basestring) or len(target.split('.', 1)) != 2:
+                raise ValueError('Invalid environment {0!r}, must be '
+                                 '<application>.<environment>'.format(target))
+            if target in seen:
+                raise ValueError('{0} is in several waves'.format(target))
+            seen.add(target)
+
+    rollout = Rollout(id=uuid.uuid4().hex, version=version, waves=json.dumps(waves),
+                      wave=0, state='pending', on_failure=on_failure,
+                      previous='{}')
+    session.add(rollout)
+    session.flush()
+    return rollout
+
+
+def make_payload(target, version, group_id, rollout_id):
+    """
+    :return: deploy request of the target, for BeforeDeploy
+    """
+    application, environment = target.split('.', 1)
+    payload = {
+        'application': application,
+        'environment': environment,
+        'version': version,
+        'action': 'deploy',
+        'group_id': group_id,
+        'rollout_id': rollout_id
+    }
+    payload['priority'] = utils.get_priority(
+        payload,
+        app.config.get('DEPLOY_PRIORITIES', {}),
+        app.config.get('QUEUE_MAX_PRIORITY'))
+    return payload
+
+
+def deployed_versions(session, targets):
+    """
+    :param targets: list of '<application>.<environment>'
+    :return: dict target -> version of its latest successful deployment
+    """
+    latest = session.query(func.max(Deployment.id)) \
+        .filter(Deployment.deployed == True) \
+        .group_by(Deployment.application, Deployment.environment)
+    out = {}
+    for d in session.query(Deployment).filter(Deployment.id.in_(latest)):
+        key = '{0}.{1}'.format(d.application, d.environment)
+        if key in targets:
+            out[key] = d.version
+    return out
+
+
+def probe_health(target):
+    """
+    Asks eb-deploy about the environment (the command is killed after
+    ROLLOUT_PROBE_TIMEOUT seconds)
+
+    :param target: '<application>.<environment>'
+    :return: True if the environment is Ready and Green
+    """
+    from .pipeline.deploy import create_executioner
+
+    application, environment = target.split('.', 1)
+    try:
+        x = create_executioner({'application': application, 'environment': environment})
+        x.max_wait = app.config.get('ROLLOUT_PROBE_TIMEOUT', 60)
+        r = x.cmd('./find-env-by-attr url {0}'.format(environment))
+    except Exception:
+        # no recipe, eb-deploy failed (CommandError)...
+        return False
+    for line in (r.out or '').splitlines():
+        parts = line.split()
+        if len(parts) > 3:
+            return parts[0] == 'Ready' and parts[3] == 'Green'
+    return False
+
+
+def start_group(session, rollout, targets, versions, publish, **info):
+    """
+    Publishes the deploy requests of the targets as one group
+
+    :param versions: dict target -> version to deploy
+    """
+    group_id = uuid.uuid4().hex
+    groups.create(session, group_id,
+                  [dict(zip(('application', 'environment'), t.split('.', 1)))
+                   for t in targets],
+                  rollout_id=rollout.id, **info)
+    for target in targets:
+        publish(make_payload(target, versions[target], group_id, rollout.id))
+    rollout.group_id = group_id
+    rollout.wave_started = datetime.utcnow()
+
+
+def start_wave(session, rollout, n, publish):
+    """
+    Deploys the n-th wave (and remembers the versions it replaces)
+    """
+    targets = json.loads(rollout.waves)[n]
+    previous = json.loads(rollout.previous or '{}')
+    previous.update(deployed_versions(session, targets))
+    rollout.previous = json.dumps(previous)
+
+    start_group(session, rollout, targets, dict.fromkeys(targets, rollout.version),
+                publish, version=rollout.version, wave=n)
+    rollout.wave = n
+    rollout.state = 'running'
+    rollout.msg = 'Deploying wave {0}: {1}'.format(n, ', '.join(targets))
+
+
+def fail(session, rollout, reason, publish):
+    """
+    Stops the rollout, or rolls back the environments it changed
+    """
+    waves = json.loads(rollout.waves)
+    previous = json.loads(rollout.previous or '{}')
+    changed = [t for wave in waves[:rollout.wave + 1] for t in wave
+               if previous.get(t) and previous[t] != rollout.version]
+
+    if rollout.on_failure == 'rollback' and changed:
+        start_group(session, rollout, changed, previous, publish, rollback=True)
+        rollout.state = 'rolling back'
+        rollout.msg = '{0}; rolling back {1}'.format(reason, ', '.join(changed))
+    else:
+        rollout.state = 'failed'
+        rollout.msg = reason
+
+
+def describe_failure(status):
+    """
+    :param status: groups.status()
+    :return: which targets failed, for the msg of the rollout
+    """
+    return ', '.join('{0} {1}'.format(e['target'], e['state'])
+                     for e in status['environments']
+                     if e['state'] not in ('deployed', 'pending'))
+
+
+def step(session, rollout, publish, probe=probe_health):
+    """
+    Moves the rollout to its next state, if it can
+
+    :param session: SQLAlchemy session
+    :param rollout: models.Rollout
+    :param publish: function that sends a deploy request (dict)
+    :param probe: function target -> True if the environment is healthy;
+        None if the health of the wave cannot be checked now (the rollout
+        then waits for the next tick)
+    """
+    if rollout.state == 'pending':
+        start_wave(session, rollout, 0, publish)
+        return
+
+    timeout = app.config.get('ROLLOUT_WAVE_TIMEOUT', 60 * 60)
+    timed_out = rollout.wave_started is not None and \
+        (datetime.utcnow() - rollout.wave_started).total_seconds() > timeout
+
+    if rollout.state == 'running':
+        status = groups.status(session, rollout.group_id, tested=True)
+        if status['status'] == 'in progress':
+            if timed_out:
+                fail(session, rollout, 'Wave {0} timed out'.format(rollout.wave), publish)
+        elif status['status'] == 'failed':
+            fail(session, rollout, 'Wave {0} failed: {1}'.format(
+                rollout.wave, describe_failure(status)), publish)
+        elif probe is not None:
+            waves = json.loads(rollout.waves)
+            unhealthy = [t for t in waves[rollout.wave] if not probe(t)]
+            if unhealthy:
+                fail(session, rollout, 'Wave {0} is not healthy: {1}'.format(
+                    rollout.wave, ', '.join(unhealthy)), publish)
+            elif rollout.wave + 1 < len(waves):
+                start_wave(session, rollout, rollout.wave + 1, publish)
+            else:
+                rollout.state = 'succeeded'
+                rollout.msg = '{0} deployed to {1} waves'.format(rollout.version, len(waves))
+
+    elif rollout.state == 'rolling back':
+        status = groups.status(session, rollout.group_id)
+        if status['status'] == 'deployed':
+            rollout.state = 'rolled back'
+            rollout.msg = '{0}; rolled back'.format(rollout.msg)
+        elif status['status'] == 'failed' or timed_out:
+            rollout.state = 'failed'
+            rollout.msg = '{0}; the rollback failed: {1}'.format(
+                rollout.msg, describe_failure(status) or 'timeout')
+
+
+def tick(publish, probe=probe_health, logger=None):
+    """
+    Advances all the active rollouts, each in its own transaction (the
+    requests are published before the new state is committed: a crash in
+    between re-publishes them, rather than losing them). publish must raise
+    when a request is not sent; the step is then rolled back and retried by
+    the next tick. The health of one
+    wave at most is checked per tick; the other waves waiting for it are
+    checked in the next ticks.
+
+    :param publish: function that sends a deploy request (dict), and raises
+        if it cannot (e.g. TaskMaster.publish_rollout)
+    :param probe: function target -> True if the environment is healthy
+    :param logger: where to log the transitions
+    :return: list of (rollout id, new state) of the rollouts that changed
+    """
+    with app.session_scope() as session:
+        ids = [r for (r,) in session.query(Rollout.id)
+               .filter(Rollout.state.in_(ACTIVE)).order_by(Rollout.date_created)]
+
+    changed = []
+    probed = []
+
+    def probe_once(target):
+        probed.append(target)
+        return probe(target)
+
+    for rollout_id in ids:
+        try:
+            with app.session_scope() as session:
+                rollout = session.query(Rollout).get(rollout_id)
+                before = (rollout.state, rollout.wave)
+                step(session, rollout, publish, None if probed else probe_once)
+                if (rollout.state, rollout.wave) != before:
+                    changed.append((rollout.id, rollout.state))
+                    if logger:
+                        logger.info('Rollout {0}: {1}'.format(rollout.id, rollout.msg))
+        except Exception as e:
+            # the others can still advance; this one is retried next time
+            if logger:
+                logger.error('Cannot advance the rollout {0}: {1!r}'.format(rollout_id, e))
+    return changed
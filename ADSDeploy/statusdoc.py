@@ -0,0 +1,136 @@
+"""
+Materialised status documents
+
+The DatabaseWriterWorker refreshes the status document of an environment
+every time it writes one of its deployments, so that reading the status of
+all the environments is one query (GET /status/documents) instead of
+walking the history of each of them:
+
+    application, environment
+    version             the active version (newest deployed one), or None
+    active              all the deployed versions (more than one is an issue)
+    deployed, tested, status, msg, date_last_modified
+                        of the active deployment
+    previous_versions   the STATUS_HISTORY_LIMIT newest other versions,
+                        oldest first
+    history_cursor      None, or the cursor of /history/<application>/
+                        <environment> that returns the older versions
+    last_test           version, result (tested) and date of the newest
+                        deployment that was tested
+    updated             when the document was written (timestamp)
+    revision            value of the revision counter when it was written
+
+Every refresh takes the next value of one revision counter, so a client
+that has seen revision X only needs the documents with a greater revision
+(changes_since). A refresh only reads the newest rows of the environment
+from the (application, environment, id) index.
+"""
+
+import time
+
+from . import app, storage
+from .models import Deployment
+
+COUNTER = 'status'
+
+
+def document_key(application, environment):
+    """
+    :return: '<application>.<environment>'
+    """
+    return '{0}.{1}'.format(application, environment)
+
+
+def build(session, application, environment, limit=None):
+    """
+    Computes the status document of the environment from its deployments
+
+    :param session: SQLAlchemy session
+    :param limit: number of previous versions (default: STATUS_HISTORY_LIMIT);
+        when there are more, the document gets a 'history_cursor'
+    :return: dict, None if the environment has no deployments
+    """
+    if limit is None:
+        limit = app.config.get('STATUS_HISTORY_LIMIT', 10)
+
+    query = session.query(Deployment).filter(
+        Deployment.application == application,
+        Deployment.environment == environment)
+    active = query.filter(Deployment.deployed == True)\
+        .order_by(Deployment.id.desc()).all()
+    # one extra row to know if there is more history than we keep
+    newest = query.order_by(Deployment.id.desc()).limit(limit + len(active) + 1).all()
+    if not newest:
+        return None
+    previous = [d for d in newest if d not in active]
+    cursor = None
+    if len(previous) > limit:
+        previous = previous[:limit]
+        cursor = previous[-1].id if previous else newest[0].id + 1
+    last_test = query.filter(Deployment.tested != None)\
+        .order_by(Deployment.id.desc()).first()
+
+    doc = {
+        'application': application,
+        'environment': environment,
+        'version': None,
+        'active': [d.version for d in active],
+        'deployed': False,
+        'tested': False,
+        'status': None,
+        'msg': None,
+        'date_last_modified': None,
+        'previous_versions': [d.version for d in reversed(previous)],
+        'history_cursor': cursor,
+        'last_test': None
+    }
+    if active:
+        current = active[0].toJSON()
+        doc.update((k, current[k]) for k in ('version', 'deployed', 'tested', 'status',
+                                             'msg', 'date_last_modified'))
+    if last_test is not None:
+        doc['last_test'] = {
+            'version': last_test.version,
+            'tested': last_test.tested,
+            'date': last_test.date_last_modified.isoformat()
+        }
+    return doc
+
+
+def refresh(session, application, environment):
+    """
+    Rewrites the status document of the environment (in the caller's
+    transaction) with the next revision
+
+    :param session: SQLAlchemy session
+    :return: the document, None if the environment has no deployments
+    """
+    session.flush()
+    doc = build(session, application, environment)
+    if doc is None:
+        return None
+    key = document_key(application, environment)
+    doc['revision'] = int(storage.increment(session, storage.COUNTERS, COUNTER))
+    doc['updated'] = time.time()
+    storage.put(session, storage.STATUS, key, doc)
+    storage.put(session, storage.STATUS_REVISION, key, doc['revision'])
+    return doc
+
+
+def revision(session):
+    """
+    :return: the revision of the newest document, 0 if there is none
+    """
+    return int(storage.get(session, storage.COUNTERS, COUNTER, 0))
+
+
+def changes_since(session, since=0):
+    """
+    :param session: SQLAlchemy session
+    :param since: revision the client has seen (0: everything)
+    :return: list of the documents written after that revision, sorted by
+        application and environment
+    """
+    keys = storage.scan_above(session, storage.STATUS_REVISION, since)
+    docs = storage.get_many(session, storage.STATUS, keys)
+    return [docs[k] for k in sorted(docs)]
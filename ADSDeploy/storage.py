@@ -0,0 +1,249 @@
+"""
+Namespaced key/value storage (models.KeyValue)
+
+Every key lives in a namespace; (namespace, key) is the primary key, so a
+lookup, a prefix scan of one namespace and a range scan over the numbers of
+one namespace are all index seeks. Values are typed: numbers (int, float)
+go into the numeric column, anything else is stored as JSON text; already
+encoded JSON can be stored and read as it is (put_raw, get_raw).
+
+All functions take the session to work with (app.session_scope() in the
+pipeline, db.session in the webapp); committing is left to the caller.
+
+    with app.session_scope() as session:
+        storage.put(session, storage.LAST_USED, 'sandbox.adsws', time.time())
+"""
+
+import json
+import time
+from numbers import Number
+from sqlalchemy.exc import IntegrityError
+from .models import KeyValue
+
+# namespaces used by the application
+LAST_USED = 'last-used'  # <application>.<environment> -> timestamp
+UI = 'ui'  # ServerSideStorage: anything the widgets want to keep
+GITHUB_DELIVERY = 'github-delivery'  # <delivery id>:<version> -> timestamp
+GITHUB_LATEST = 'github-latest'  # <url>|<application>.<environment> -> token
+REQUESTED = 'requested'  # <application>.<environment> -> id of the newest deploy request
+DEPLOY_GROUP = 'deploy-group'  # group id -> targets of a fan-out deploy (ADSDeploy.groups)
+KNOWN_GOOD = 'known-good'  # <application>.<environment> -> deployed and tested versions, newest first
+STATUS = 'status'  # <application>.<environment> -> status document (ADSDeploy.statusdoc)
+STATUS_REVISION = 'status-revision'  # <application>.<environment> -> revision of its document
+COUNTERS = 'counters'  # name -> number (increment)
+TEST_RESULT = 'test-result'  # <application>|<environment>|<version>|<adsrex commit>|<API_BASE> -> verdict
+TEST_RESULT_EXPIRY = 'test-result-expiry'  # same keys -> timestamp when the verdict expires
+DEPLOY_LOCK = 'deploy-lock'  # <application>.<environment> -> expiry of the running deploy's lock
+
+
+def encode(value):
+    """
+    Maps a python value onto the columns of KeyValue
+
+    :param value: number or anything that can be serialised to JSON
+    :return: dict with 'value' and 'number'
+    """
+    if isinstance(value, Number) and not isinstance(value, bool):
+        return {'value': None, 'number': float(value)}
+    return {'value': json.dumps(value), 'number': None}
+
+
+def decode(kv, default=None):
+    """
+    Reverse of encode()
+
+    :param kv: models.KeyValue or None
+    :param default: returned when there is no such row
+    """
+    if kv is None:
+        return default
+    if kv.number is not None:
+        return kv.number
+    if kv.value is None:
+        return None
+    return json.loads(kv.value)
+
+
+def _query(session, namespace):
+    return session.query(KeyValue).filter(KeyValue.namespace == namespace)
+
+
+def get(session, namespace, key, default=None):
+    """
+    :return: the decoded value stored under namespace/key, or default
+    """
+    return decode(_query(session, namespace).filter(KeyValue.key == key).first(),
+                  default)
+
+
+def get_raw(session, namespace, key):
+    """
+    :return: the stored text (without decoding it), or None
+    """
+    kv = _query(session, namespace).filter(KeyValue.key == key).first()
+    return kv.value if kv is not None else None
+
+
+def get_many(session, namespace, keys):
+    """
+    Fetches several keys with one query
+
+    :return: dict key -> decoded value (only for the keys that exist)
+    """
+    keys = list(keys)
+    if not keys:
+        return {}
+    return {kv.key: decode(kv) for kv in
+            _query(session, namespace).filter(KeyValue.key.in_(keys))}
+
+
+def scan_prefix(session, namespace, prefix):
+    """
+    Returns all keys of the namespace that start with the prefix; it is a
+    range condition on the primary key, so that it does not depend on the
+    collation/operator class of the index (as LIKE 'prefix%' would).
+
+    :return: dict key -> decoded value
+    """
+    query = _query(session, namespace).filter(KeyValue.key >= prefix)
+    if prefix:
+        query = query.filter(KeyValue.key < prefix[:-1] + unichr(ord(prefix[-1]) + 1))
+    return {kv.key: decode(kv) for kv in query if kv.key.startswith(prefix)}
+
+
+def scan_below(session, namespace, number):
+    """
+    Returns the keys of the namespace whose (numeric) value is lower than
+    the given number, e.g. the timestamps older than a cutoff
+
+    :return: dict key -> number
+    """
+    return {kv.key: kv.number for kv in
+            _query(session, namespace).filter(KeyValue.number < number)}
+
+
+def scan_above(session, namespace, number):
+    """
+    Returns the keys of the namespace whose (numeric) value is greater than
+    the given number, e.g. the revisions newer than the one a client has
+
+    :return: dict key -> number
+    """
+    return {kv.key: kv.number for kv in
+            _query(session, namespace).filter(KeyValue.number > number)}
+
+
+def increment(session, namespace, key, delta=1):
+    """
+    Adds delta to a number (that starts at 0) in one UPDATE statement, so
+    that concurrent writers do not lose increments
+
+    :return: the new value
+    """
+    updated = _query(session, namespace).filter(KeyValue.key == key)\
+        .update({'number': KeyValue.number + delta}, synchronize_session=False)
+    if not updated:
+        session.add(KeyValue(namespace=namespace, key=key, number=delta))
+        session.flush()
+    return get(session, namespace, key)
+
+
+def acquire(session, namespace, key, ttl):
+    """
+    Takes a lock: the key holds the time when it expires. A free or expired
+    lock is taken with one conditional UPDATE (or an INSERT, of which only
+    one of concurrent callers succeeds), so two callers cannot both get it.
+    It needs a transaction of its own (the one of a failed INSERT is rolled
+    back); commit it right away.
+
+    :param ttl: seconds after which the lock is free again (if the holder
+        died without releasing it)
+    :return: the expiry, to be passed to release(); None if the lock is held
+    """
+    now = time.time()
+    expires = now + ttl
+    taken = _query(session, namespace).filter(KeyValue.key == key, KeyValue.number < now)\
+        .update({'number': expires}, synchronize_session=False)
+    if taken:
+        return expires
+    if _query(session, namespace).filter(KeyValue.key == key).count():
+        return None
+    try:
+        session.add(KeyValue(namespace=namespace, key=key, number=expires))
+        session.flush()
+    except IntegrityError:
+        session.rollback()
+        return None
+    return expires
+
+
+def release(session, namespace, key, token):
+    """
+    Frees the lock taken by acquire() (unless it expired and was taken by
+    someone else)
+
+    :param token: what acquire() returned
+    :return: True if it was released
+    """
+    return bool(_query(session, namespace)
+                .filter(KeyValue.key == key, KeyValue.number == token)
+                .delete(synchronize_session=False))
+
+
+def put(session, namespace, key, value):
+    """
+    Stores the value (update, or insert when there is no such key yet; the
+    common case of an existing key costs one UPDATE statement)
+    """
+    _upsert(session, namespace, key, encode(value))
+
+
+def put_raw(session, namespace, key, text):
+    """
+    Stores already encoded (JSON) text as it is
+    """
+    _upsert(session, namespace, key, {'value': text, 'number': None})
+
+
+def _upsert(session, namespace, key, columns):
+    updated = _query(session, namespace).filter(KeyValue.key == key)\
+        .update(columns, synchronize_session=False)
+    if not updated:
+        session.add(KeyValue(namespace=namespace, key=key, **columns))
+        session.flush()
+
+
+def put_many(session, namespace, values):
+    """
+    Stores several values: one query to find the existing keys, then one
+    bulk update and one bulk insert
+
+    :param values: dict key -> value
+    """
+    if not values:
+        return
+    existing = set(k for (k,) in session.query(KeyValue.key).filter(
+        KeyValue.namespace == namespace,
+        KeyValue.key.in_(list(values))
+    ))
+    updates, inserts = [], []
+    for key, value in values.iteritems():
+        row = dict(encode(value), namespace=namespace, key=key)
+        (updates if key in existing else inserts).append(row)
+    if updates:
+        session.bulk_update_mappings(KeyValue, updates)
+    if inserts:
+        session.bulk_insert_mappings(KeyValue, inserts)
+
+
+def delete(session, namespace, keys):
+    """
+    Removes the keys from the namespace
+
+    :return: number of deleted rows
+    """
+    keys = list(keys)
+    if not keys:
+        return 0
+    return _query(session, namespace).filter(KeyValue.key.in_(keys))\
+        .delete(synchronize_session=False)
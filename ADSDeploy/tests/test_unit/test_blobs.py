@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the blob store. There is no communication.
+"""
+
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+from ADSDeploy import blobs
+
+
+class Result(object):
+    cmd = './safe-deploy.sh adsws'
+    retcode = 1
+    err = 'failed'
+    out = 'x' * 5000
+
+    def __str__(self):
+        return 'cmd: {0}\nout:{1}\nerr:{2}\nretcode:{3}'.format(
+            self.cmd, self.out, self.err, self.retcode)
+
+
+class TestBlobs(unittest.TestCase):
+    """
+    Test storing and reading blobs
+    """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_put_and_open(self):
+        """Blobs are stored under their digest, once"""
+        digest = blobs.put(self.root, 'some output')
+        self.assertEqual(digest, hashlib.sha256('some output').hexdigest())
+        self.assertEqual(blobs.put(self.root, 'some output'), digest)
+        self.assertEqual(blobs.put(self.root, u'some output'), digest)
+        self.assertEqual(os.listdir(os.path.join(self.root, digest[:2])), [digest[2:]])
+
+        with blobs.open_blob(self.root, digest) as f:
+            self.assertEqual(f.read(), 'some output')
+
+        self.assertRaises(IOError, blobs.open_blob, self.root, '0' * 64)
+        for digest in ('../../etc/passwd', 'A' * 64, '0' * 63, None):
+            self.assertRaises(ValueError, blobs.open_blob, self.root, digest)
+
+    def test_offload(self):
+        """The summary keeps only the tail of the output"""
+        self.assertEqual(blobs.tail('abc', 5), 'abc')
+        self.assertEqual(blobs.tail('abcdef', 3), '...def')
+        self.assertEqual(blobs.tail(None, 3), '')
+
+        summary, digest = blobs.offload(self.root, Result(), tail_size=100)
+        self.assertLess(len(summary), 300)
+        self.assertIn('retcode: 1', summary)
+        self.assertIn('stderr: failed', summary)
+        with blobs.open_blob(self.root, digest) as f:
+            self.assertEqual(f.read(), str(Result()))
+
+
+if __name__ == '__main__':
+    unittest.main()
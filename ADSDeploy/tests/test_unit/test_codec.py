@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the message codec. There is no communication.
+"""
+
+import json
+import mock
+import zlib
+import unittest
+
+from ADSDeploy import app, codec
+from ADSDeploy.pipeline.generic import RabbitMQWorker
+
+
+class TestCodec(unittest.TestCase):
+    """
+    Test encoding and decoding of the messages
+    """
+
+    def test_roundtrip(self):
+        """Messages come back as they were sent, with or without ujson"""
+        message = {'application': 'sandbox', 'version': u'v1.0.0', 'tested': None,
+                   'timestamp': 1460000000.25, 'msg': u'caf\xe9 http://x/y'}
+        for library in (codec.ujson, None):
+            with mock.patch.object(codec, 'ujson', library):
+                body, properties = codec.encode(message)
+                self.assertEqual(properties.content_type, 'application/json')
+                self.assertIsNone(properties.content_encoding)
+                self.assertEqual(properties.headers, {'x-envelope': 1})
+                self.assertEqual(json.loads(body), message)
+                self.assertEqual(codec.decode(body, properties), message)
+
+    def test_compression(self):
+        """Large bodies are compressed"""
+        message = {'msg': 'x' * 100}
+        body, properties = codec.encode(message, compress_threshold=50)
+        self.assertEqual(properties.content_encoding, 'zlib')
+        self.assertEqual(json.loads(zlib.decompress(body)), message)
+        self.assertEqual(codec.decode(body, properties), message)
+
+        body, properties = codec.encode(message, compress_threshold=0)
+        self.assertIsNone(properties.content_encoding)
+
+        # already serialised messages are passed as they are
+        body, properties = codec.encode(json.dumps(message), compress_threshold=50)
+        self.assertEqual(body, json.dumps(message))
+        self.assertIsNone(properties.content_encoding)
+
+    def test_legacy_and_unknown(self):
+        """Messages without properties are JSON, unknown formats are refused"""
+        self.assertEqual(codec.decode('{"a": 1}'), {'a': 1})
+        self.assertEqual(codec.decode('{"a": 1}', mock.Mock()), {'a': 1})
+
+        props = codec.get_properties()
+        props.headers = {'x-envelope': 2}
+        self.assertRaises(ValueError, codec.decode, '{}', props)
+
+        props = codec.get_properties('gzip')
+        self.assertRaises(ValueError, codec.decode, '{}', props)
+
+        props = codec.get_properties()
+        props.content_type = 'application/x-msgpack'
+        self.assertRaises(ValueError, codec.decode, '{}', props)
+
+    def test_worker(self):
+        """The worker publishes and consumes through the codec"""
+        app.init_app({'SQLALCHEMY_URL': 'sqlite://'})
+        try:
+            worker = RabbitMQWorker(params={'publish': 'out'})
+            worker.channel = mock.Mock()
+
+            app.config['MESSAGE_COMPRESS_THRESHOLD'] = 10
+            worker.publish({'msg': 'x' * 20})
+            kwargs = worker.channel.basic_publish.call_args[1]
+            self.assertEqual(kwargs['routing_key'], 'out')
+            self.assertEqual(kwargs['properties'].content_encoding, 'zlib')
+
+            worker.process_payload = mock.Mock(return_value=None)
+            worker.on_message(worker.channel, mock.Mock(delivery_tag=1),
+                              kwargs['properties'], kwargs['body'])
+            self.assertEqual(worker.process_payload.call_args[0][0], {'msg': 'x' * 20})
+            worker.channel.basic_ack.assert_called_with(delivery_tag=1)
+        finally:
+            app.close_app()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the periodic jobs (cronjobs). There is no communication.
+"""
+
+import gzip
+import json
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from datetime import datetime, timedelta
+from ADSDeploy import app, cronjobs, storage
+from ADSDeploy.models import Base, Deployment, KeyValue
+from mock import Mock
+
+
+class TestArchiveDeployments(unittest.TestCase):
+    """
+    Test the retention/archival of the deployment history
+    """
+    def create_app(self):
+        app.init_app({
+            'SQLALCHEMY_URL': 'sqlite://',
+            'SQLALCHEMY_ECHO': False,
+            'ARCHIVE_PATH': self.archive_path,
+            'ARCHIVE_BATCH_SIZE': 2,
+            'DEPLOYMENT_RETENTION': {
+                'default': {'versions': 3, 'days': 10},
+                'eb-deploy': {'versions': 1}
+            }
+        })
+        Base.metadata.bind = app.session.get_bind()
+        Base.metadata.create_all()
+        return app
+
+    def setUp(self):
+        self.archive_path = tempfile.mkdtemp()
+        self.app = self.create_app()
+
+    def tearDown(self):
+        Base.metadata.drop_all()
+        app.close_app()
+        shutil.rmtree(self.archive_path)
+
+    def add(self, application, environment, versions, age, deployed=None):
+        """Stubs deployments that were last modified age days ago"""
+        date = datetime.utcnow() - timedelta(days=age)
+        with self.app.session_scope() as session:
+            for version in versions:
+                session.add(Deployment(
+                    application=application,
+                    environment=environment,
+                    version=version,
+                    deployed=version == deployed,
+                    date_created=date,
+                    date_last_modified=date
+                ))
+
+    def versions(self, application, environment):
+        with self.app.session_scope() as session:
+            return [d.version for d in session.query(Deployment).filter(
+                Deployment.application == application,
+                Deployment.environment == environment
+            ).order_by(Deployment.id)]
+
+    def test_retention_policy(self):
+        """
+        The application policy overrides the default one
+        """
+        self.assertEqual(cronjobs.get_retention('sandbox'),
+                         {'versions': 3, 'days': 10})
+        self.assertEqual(cronjobs.get_retention('eb-deploy'),
+                         {'versions': 1, 'days': 10})
+
+    def test_archive_deployments(self):
+        """
+        Only rows that are neither among the last N versions, nor recent, nor
+        deployed are moved to the archive
+        """
+        self.add('sandbox', 'adsws', ['v{}'.format(i) for i in range(6)],
+                 age=20, deployed='v1')
+        self.add('sandbox', 'adsws', ['v6', 'v7'], age=1)
+        self.add('sandbox', 'graphics', ['g0', 'g1', 'g2', 'g1'], age=20)
+        self.add('eb-deploy', 'adsws', ['e0', 'e1', 'e2'], age=20)
+
+        n = cronjobs.archive_deployments()
+        self.assertEqual(n, 6)
+
+        self.assertEqual(self.versions('sandbox', 'adsws'),
+                         ['v1', 'v5', 'v6', 'v7'])
+        # 3 versions (in 4 rows) are kept
+        self.assertEqual(self.versions('sandbox', 'graphics'),
+                         ['g0', 'g1', 'g2', 'g1'])
+        self.assertEqual(self.versions('eb-deploy', 'adsws'), ['e2'])
+
+        archives = os.listdir(self.archive_path)
+        self.assertEqual(len(archives), 1)
+        with gzip.open(os.path.join(self.archive_path, archives[0])) as f:
+            rows = [json.loads(l) for l in f]
+        self.assertEqual(
+            sorted(r['version'] for r in rows),
+            ['e0', 'e1', 'v0', 'v2', 'v3', 'v4']
+        )
+        self.assertTrue(all('id' in r and 'date_created' in r for r in rows))
+
+        # nothing left to do
+        self.assertEqual(cronjobs.archive_deployments(), 0)
+
+        # another run appends a complete gzip member to the archive
+        self.add('eb-deploy', 'adsws', ['e3'], age=20)
+        self.assertEqual(cronjobs.archive_deployments(), 1)
+        self.assertEqual(self.versions('eb-deploy', 'adsws'), ['e3'])
+        with gzip.open(os.path.join(self.archive_path, archives[0])) as f:
+            self.assertEqual(json.loads(f.readlines()[-1])['version'], 'e2')
+
+
+
+class TestCleanupEnvironments(unittest.TestCase):
+    """
+    Test the termination of the unused testing environments
+    """
+    def create_app(self):
+        app.init_app({
+            'SQLALCHEMY_URL': 'sqlite://',
+            'SQLALCHEMY_ECHO': False,
+            'AFTER_DEPLOY_CLEANUP_TIME': 60,
+            'CLEANUP_PROBE_CONCURRENCY': 4,
+            'CLEANUP_TERMINATE_CONCURRENCY': 8,
+            'CLEANUP_TERMINATE_PER_APPLICATION': 2
+        })
+        Base.metadata.bind = app.session.get_bind()
+        Base.metadata.create_all()
+        return app
+
+    def setUp(self):
+        self.app = self.create_app()
+        now = time.time()
+        with self.app.session_scope() as session:
+            storage.put_many(session, storage.LAST_USED, {
+                'sandbox.adsws': now - 120,
+                'sandbox.graphics': now - 120,
+                'eb-deploy.adsws': now - 120,
+                'broken.adsws': now - 120,
+                'recent.adsws': now - 10
+            })
+            storage.put(session, storage.UI, 'foo', {})
+
+    def tearDown(self):
+        Base.metadata.drop_all()
+        app.close_app()
+
+    def test_expired_environments(self):
+        """
+        Only the expired timers are returned
+        """
+        self.assertEqual(
+            sorted(cronjobs.get_expired_environments()),
+            [('broken', 'adsws', 'broken.adsws'),
+             ('eb-deploy', 'adsws', 'eb-deploy.adsws'),
+             ('sandbox', 'adsws', 'sandbox.adsws'),
+             ('sandbox', 'graphics', 'sandbox.graphics')]
+        )
+
+    @mock.patch('ADSDeploy.cronjobs.create_executioner')
+    def test_cleanup_environments(self, mocked_executioner):
+        """
+        Every application is probed once, the environments are terminated in
+        parallel (but never more than the per-application limit) and only the
+        timers of the cleaned applications are removed
+        """
+        running = {}
+        peak = {}
+        lock = threading.Lock()
+
+        def cmd(appl, command):
+            if command.startswith('./find-env-by-attr'):
+                if appl == 'broken':
+                    raise Exception('AWS is down')
+                return Mock(retcode=0, out='\n'.join(
+                    'Ready {0}-{1}.elasticbeanstalk.com {1}:v1 Green {1}-{0}-{2}'
+                    .format(appl, 'testing', i) for i in range(4)
+                ))
+            name = command.split()[-1]
+            with lock:
+                running[appl] = running.get(appl, 0) + 1
+                peak[appl] = max(peak.get(appl, 0), running[appl])
+            time.sleep(0.05)
+            with lock:
+                running[appl] -= 1
+            if name == 'testing-eb-deploy-3':
+                raise Exception('cannot terminate')
+            return Mock(retcode=0, out='')
+
+        def executioner(payload):
+            x = Mock()
+            x.cmd.side_effect = lambda c: cmd(payload['application'], c)
+            return x
+
+        mocked_executioner.side_effect = executioner
+
+        results = cronjobs.cleanup_environments()
+
+        self.assertEqual(sorted(results.keys()), ['broken', 'eb-deploy', 'sandbox'])
+        self.assertEqual(
+            sorted(results['sandbox']['terminated']),
+            ['testing-sandbox-{}'.format(i) for i in range(4)]
+        )
+        self.assertEqual(results['sandbox']['failed'], {})
+        self.assertEqual(results['eb-deploy']['failed'].keys(),
+                         ['testing-eb-deploy-3'])
+        self.assertEqual(results['broken']['terminated'], [])
+        self.assertEqual(peak['sandbox'], 2)
+
+        # sandbox was probed once, although it had two timers
+        probes = [c for c in mocked_executioner.call_args_list
+                  if c[0][0]['application'] == 'sandbox']
+        self.assertEqual(len(probes), 1 + 4)
+
+        with self.app.session_scope() as session:
+            self.assertEqual(
+                sorted((k.namespace, k.key) for k in session.query(KeyValue)),
+                [('last-used', 'broken.adsws'), ('last-used', 'eb-deploy.adsws'),
+                 ('last-used', 'recent.adsws'), ('ui', 'foo')]
+            )
+
+
+if __name__ == '__main__':
+    unittest.main()
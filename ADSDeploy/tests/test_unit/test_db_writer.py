@@ -9,9 +9,10 @@ are tested in this suite. There is no communication.
 import unittest
 
 from datetime import datetime
-from ADSDeploy import app
+from ADSDeploy import app, statusdoc
 from ADSDeploy.models import Base, Deployment
 from ADSDeploy.pipeline.workers import DatabaseWriterWorker
+from ADSDeploy.pipeline.deploy import known_good_versions
 
 
 class TestDatabaseWriterWorker(unittest.TestCase):
@@ -186,5 +187,83 @@ class TestDatabaseWriterWorker(unittest.TestCase):
             ).one()
             self.assertFalse(deployment_1.deployed)
 
+    def test_worker_maintains_status_documents(self):
+        """
+        Every write refreshes the status document of the environment, with a
+        new revision
+        """
+        worker = DatabaseWriterWorker()
+        payload = {'application': 'staging', 'environment': 'adsws'}
+        worker.process_payload(dict(payload, version='v1', deployed=True, tested=True))
+        worker.process_payload(dict(payload, version='v2', deployed=True))
+        worker.process_payload(dict(payload, environment='solr', version='v1'))
+
+        with self.app.session_scope() as session:
+            self.assertEqual(statusdoc.revision(session), 3)
+            adsws, solr = statusdoc.changes_since(session)
+            self.assertEqual((adsws['version'], adsws['active'], adsws['previous_versions']),
+                             ('v2', ['v2'], ['v1']))
+            self.assertEqual(adsws['revision'], 2)
+            self.assertEqual(adsws['last_test']['version'], 'v1')
+            self.assertTrue(adsws['last_test']['tested'])
+            self.assertEqual((solr['version'], solr['previous_versions']), (None, ['v1']))
+
+        # only what changed after a revision
+        worker.process_payload(dict(payload, version='v2', tested=False))
+        with self.app.session_scope() as session:
+            changes = statusdoc.changes_since(session, 3)
+            self.assertEqual([d['environment'] for d in changes], ['adsws'])
+            self.assertEqual(changes[0]['last_test']['version'], 'v2')
+            self.assertFalse(changes[0]['tested'])
+            self.assertEqual(statusdoc.changes_since(session, 4), [])
+
+    def test_status_document_history(self):
+        """
+        The document keeps STATUS_HISTORY_LIMIT previous versions and says
+        where the older ones are
+        """
+        app.config['STATUS_HISTORY_LIMIT'] = 2
+        worker = DatabaseWriterWorker()
+        payload = {'application': 'staging', 'environment': 'adsws'}
+        for version in ('v1', 'v2'):
+            worker.process_payload(dict(payload, version=version))
+
+        with self.app.session_scope() as session:
+            doc, = statusdoc.changes_since(session)
+            self.assertEqual(doc['previous_versions'], ['v1', 'v2'])
+            self.assertIsNone(doc['history_cursor'])
+
+        worker.process_payload(dict(payload, version='v3'))
+        with self.app.session_scope() as session:
+            doc, = statusdoc.changes_since(session)
+            self.assertEqual(doc['previous_versions'], ['v2', 'v3'])
+            v2 = session.query(Deployment).filter(Deployment.version == 'v2').one()
+            self.assertEqual(doc['history_cursor'], v2.id)
+
+    def test_worker_maintains_known_good_versions(self):
+        """
+        A version that fails when it is deployed again is no longer a
+        version to roll back to; a replaced one still is
+        """
+        worker = DatabaseWriterWorker()
+        payload = {'application': 'staging', 'environment': 'adsws'}
+        worker.process_payload(dict(payload, version='v1', deployed=True, tested=True))
+        worker.process_payload(dict(payload, version='v2', deployed=True, tested=True))
+        with self.app.session_scope() as session:
+            self.assertEqual(known_good_versions(session, 'staging', 'adsws'), ['v2', 'v1'])
+
+        # v2 is deployed again (a new group), and fails the tests
+        worker.process_payload(dict(payload, version='v2', group_id='g1'))
+        worker.process_payload(dict(payload, version='v2', group_id='g1', deployed=True))
+        worker.process_payload(dict(payload, version='v2', group_id='g1', tested=False))
+        with self.app.session_scope() as session:
+            self.assertEqual(known_good_versions(session, 'staging', 'adsws'), ['v1'])
+
+        # and v1 fails to deploy
+        worker.process_payload(dict(payload, version='v1', group_id='g2', deployed=False))
+        with self.app.session_scope() as session:
+            self.assertEqual(known_good_versions(session, 'staging', 'adsws'), [])
+
+
 if __name__ == '__main__':
     unittest.main()
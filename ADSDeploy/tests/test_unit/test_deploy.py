@@ -8,16 +8,19 @@ are tested in this suite. There is no communication.
 
 import mock
 import time
+import shutil
+import tempfile
 import unittest
 import json
 import os
 
 from io import StringIO
 from mock import Mock
-from ADSDeploy import app
+from ADSDeploy import app, osutils, blobs, groups, storage
 from ADSDeploy.tests import test_base
-from ADSDeploy.models import Base, KeyValue
-from ADSDeploy.pipeline.deploy import Deploy, BeforeDeploy, AfterDeploy, GithubDeploy
+from ADSDeploy.models import Base, KeyValue, Deployment
+from ADSDeploy.pipeline.deploy import Deploy, BeforeDeploy, AfterDeploy, GithubDeploy, \
+    Rollback, is_superseded, known_good_versions, remember_known_good
 
 
 class TestWorkers(test_base.TestUnit):
@@ -25,6 +28,11 @@ class TestWorkers(test_base.TestUnit):
     Tests the GenericWorker's methods
     """
 
+    def setUp(self):
+        test_base.TestUnit.setUp(self)
+        # the messages carry the priorities of DEPLOY_PRIORITIES
+        app.config['QUEUE_MAX_PRIORITY'] = 10
+
     def tearDown(self):
         test_base.TestUnit.tearDown(self)
         Base.metadata.drop_all()
@@ -55,19 +63,145 @@ class TestWorkers(test_base.TestUnit):
         worker = BeforeDeploy(params={'status': 'ads.deploy.status'})
         worker.process_payload({'application': 'sandbox', 'environment': 'adsws'})
         worker.publish.assert_has_calls([
-            mock.call({'environment': 'adsws', 'application': 'sandbox', 'msg': 'OK to deploy'},topic='ads.deploy.deploy'),
-            mock.call({'environment': 'adsws', 'application': 'sandbox', 'msg': 'OK to deploy'},topic='ads.deploy.status')
+            mock.call({'environment': 'adsws', 'application': 'sandbox', 'msg': 'OK to deploy',
+                       'request_id': mock.ANY},topic='ads.deploy.deploy'),
+            mock.call({'environment': 'adsws', 'application': 'sandbox', 'msg': 'OK to deploy',
+                       'request_id': mock.ANY},topic='ads.deploy.status')
         ])
 
+    @mock.patch('ADSDeploy.pipeline.deploy.os.path.exists', return_value=True)
+    @mock.patch('ADSDeploy.pipeline.deploy.Deploy.publish')
+    @mock.patch('ADSDeploy.pipeline.deploy.BeforeDeploy.publish')
+    @mock.patch('ADSDeploy.osutils.Executioner.cmd',
+                return_value=Mock(**dict(retcode=0,
+                                         out='Ready adsws-sandbox.elasticbeanstalk.com adsws:v1.0.0:v1.0.2-17-g1b31375 Green adsws-sandbox')))
+    def test_superseded_requests(self, cmd, before_publish, deploy_publish, exists):
+        """Older requests for the same environment are dropped before deploying"""
+        before = BeforeDeploy(params={'status': 'ads.deploy.status'})
+        deploy = Deploy(params={'status': 'ads.deploy.status'})
+
+        first = {'application': 'sandbox', 'environment': 'adsws', 'version': 'v1'}
+        before.process_payload(first)
+        self.assertEqual(before_publish.call_args_list[0][1], {'topic': 'ads.deploy.deploy'})
+
+        # a newer version arrives (and another environment is unaffected)
+        second = {'application': 'sandbox', 'environment': 'adsws', 'version': 'v2'}
+        before.process_payload(second)
+        other = {'application': 'sandbox', 'environment': 'graphics', 'version': 'v1'}
+        before.process_payload(other)
+        self.assertNotEqual(first['request_id'], second['request_id'])
+
+        # the first one is dropped by Deploy, without running eb-deploy
+        cmd.reset_mock()
+        deploy.process_payload(dict(first))
+        self.assertFalse(cmd.called)
+        deploy_publish.assert_called_once_with(mock.ANY, topic='ads.deploy.status')
+        status = deploy_publish.call_args[0][0]
+        self.assertEqual(status['status'], 'superseded')
+        self.assertEqual(status['version'], 'v1')
+
+        # and by BeforeDeploy when it is re-checked
+        before_publish.reset_mock()
+        before.process_payload(dict(first))
+        before_publish.assert_called_once_with(mock.ANY, topic='ads.deploy.status')
+        self.assertEqual(before_publish.call_args[0][0]['status'], 'superseded')
+
+        # the newest one goes ahead
+        deploy_publish.reset_mock()
+        deploy.process_payload(dict(second))
+        self.assertTrue(cmd.called)
+        self.assertEqual(deploy_publish.call_args_list[-1][0][0]['msg'], 'deployed')
+
+        # restarts are not deploy requests
+        restart = {'application': 'sandbox', 'environment': 'adsws', 'action': 'restart-soft'}
+        before.process_payload(restart)
+        self.assertNotIn('request_id', restart)
+        self.assertFalse(is_superseded(dict(second)))
+
+    @mock.patch('ADSDeploy.pipeline.deploy.Deploy.publish_to_error_queue')
+    @mock.patch('ADSDeploy.pipeline.deploy.Deploy.publish')
+    @mock.patch('ADSDeploy.pipeline.deploy.create_executioner')
+    def test_deploy_failure_offloads_output(self, executioner, publish, error):
+        """The output of a failed deployment goes into the blob store"""
+        result = Mock(cmd='./safe-deploy.sh adsws', retcode=1, err='timeout',
+                      out='line\n' * 10000)
+        executioner.return_value.cmd.side_effect = osutils.CommandError(result)
+        app.config['BLOB_STORE_PATH'] = tempfile.mkdtemp()
+        app.config['BLOB_TAIL_SIZE'] = 100
+        try:
+            worker = Deploy(params={'status': 'ads.deploy.status'})
+            worker.process_payload({'application': 'sandbox', 'environment': 'adsws'})
+
+            payload = publish.call_args[0][0]
+            self.assertEqual(publish.call_args[1], {'topic': 'ads.deploy.status'})
+            self.assertFalse(payload['deployed'])
+            self.assertLess(len(payload['msg']), 400)
+            self.assertTrue(error.called)
+            with blobs.open_blob(app.config['BLOB_STORE_PATH'], payload['output']) as f:
+                self.assertEqual(f.read(), str(result))
+        finally:
+            shutil.rmtree(app.config['BLOB_STORE_PATH'])
+
+    @mock.patch('ADSDeploy.pipeline.deploy.Deploy.publish_to_error_queue')
+    @mock.patch('ADSDeploy.pipeline.deploy.Deploy.publish')
+    @mock.patch('ADSDeploy.pipeline.deploy.create_executioner')
+    def test_failed_deploy_is_parked(self, executioner, publish, error):
+        """A failed deploy is parked, only a timeout or a lost connection is
+        retried"""
+        app.config['BLOB_STORE_PATH'] = tempfile.mkdtemp()
+        app.config['DEPLOY_TRANSIENT_ERRORS'] = ['Connection reset by peer']
+        worker = Deploy(params={'status': 'ads.deploy.status'})
+        try:
+            for result, retry in [
+                    (Mock(retcode=1, out='ERROR: build failed', err='', timed_out=False), False),
+                    (Mock(retcode=-15, out='building', err='', timed_out=True), True),
+                    (Mock(retcode=1, out='', err='Connection reset by peer', timed_out=False), True)]:
+                executioner.return_value.cmd.side_effect = osutils.CommandError(result)
+                worker.process_payload({'application': 'sandbox', 'environment': 'adsws'})
+                self.assertEqual(error.call_args[1]['retry'], retry)
+                self.assertFalse(error.call_args[0][0]['deployed'])
+        finally:
+            shutil.rmtree(app.config['BLOB_STORE_PATH'])
+
+    @mock.patch('ADSDeploy.pipeline.deploy.Deploy.delay')
+    @mock.patch('ADSDeploy.pipeline.deploy.Deploy.publish')
+    @mock.patch('ADSDeploy.pipeline.deploy.create_executioner')
+    def test_deploy_one_at_a_time(self, executioner, publish, delay):
+        """A second deploy of the same environment waits in the delay queue"""
+        executioner.return_value.cmd.return_value = Mock(retcode=0, out='')
+        payload = {'application': 'sandbox', 'environment': 'adsws', 'version': 'v2'}
+        with app.session_scope() as session:
+            storage.acquire(session, storage.DEPLOY_LOCK, 'sandbox.adsws', 60)
+
+        worker = Deploy(params={'status': 'ads.deploy.status'})
+        worker.process_payload(dict(payload))
+        self.assertFalse(executioner.called)
+        delay.assert_called_once_with(payload, 60)
+
+        # another environment is not blocked
+        worker.process_payload(dict(payload, environment='solr'))
+        self.assertTrue(executioner.called)
+        command = executioner.return_value.cmd.call_args[0][0]
+        self.assertTrue(command.startswith('./safe-deploy.sh solr > '))
+        self.assertFalse(os.path.exists(command.split('> ')[1]))
+        with app.session_scope() as session:
+            self.assertIsNone(storage.get(session, storage.DEPLOY_LOCK, 'sandbox.solr'))
+
     def test_deploy_after_deploy(self):
         """Test after deploy"""
         worker = AfterDeploy()
         worker.process_payload({'application': 'sandbox', 'environment': 'adsws'})
         with app.session_scope() as sess:
             u = sess.query(KeyValue).first()
-            assert u.toJSON()['key'] == u'sandbox.adsws.last-used'
+            assert u.namespace == u'last-used'
+            assert u.toJSON()['key'] == u'sandbox.adsws'
             assert float(u.toJSON()['value']) < time.time() + 1
             assert float(u.toJSON()['value']) > time.time() - 1
+
+        # the timer is reset
+        worker.process_payload({'application': 'sandbox', 'environment': 'adsws'})
+        with app.session_scope() as sess:
+            self.assertEqual(sess.query(KeyValue).count(), 1)
             
     @mock.patch('ADSDeploy.pipeline.deploy.GithubDeploy.publish')
     
@@ -100,6 +234,7 @@ class TestWorkers(test_base.TestUnit):
                    {'environment': u'adsws', 
                     'application': u'eb-deploy', 
                     'version': 'v1.0.1', 
+                    'priority': 5,
                     'path': u'/dvt/workspace2/ADSDeploy/eb-deploy/production/eb-deploy/adsws'
                 })
                 worker.publish.reset_mock()
@@ -110,6 +245,7 @@ class TestWorkers(test_base.TestUnit):
                    {'environment': u'adsws', 
                     'application': u'eb-deploy', 
                     'version': 'v1.0.1', 
+                    'priority': 5,
                     'path': u'/dvt/workspace2/ADSDeploy/eb-deploy/production/eb-deploy/adsws'
                 })
                 worker.publish.reset_mock()
@@ -122,6 +258,7 @@ class TestWorkers(test_base.TestUnit):
                    {'environment': u'adsws', 
                     'application': u'sandbox', 
                     'version': 'v1.0.1', 
+                    'priority': 1,
                     'path': u'/dvt/workspace2/ADSDeploy/eb-deploy/sandbox/sandbox/adsws'
                 })
                 worker.publish.reset_mock()
@@ -132,10 +269,167 @@ class TestWorkers(test_base.TestUnit):
                    {'environment': u'adsws', 
                     'application': u'eb-deploy', 
                     'version': 'v1.0.1', 
+                    'priority': 5,
                     'path': u'/dvt/workspace2/ADSDeploy/eb-deploy/production/eb-deploy/adsws'
                 })
                 worker.publish.reset_mock()
-            
+
+    @mock.patch('ADSDeploy.pipeline.deploy.GithubDeploy.delay')
+    @mock.patch('ADSDeploy.pipeline.deploy.GithubDeploy.publish')
+    @mock.patch('ADSDeploy.pipeline.deploy.ProjectMapper.get',
+                side_effect=lambda url: {'application': 'sandbox', 'environment': 'adsws'})
+    def test_github_deploy_redelivery_and_debounce(self, mapper, publish, delay):
+        """Redeliveries are ignored, only the newest push of a burst is deployed."""
+        app.config['GITHUB_DEBOUNCE_WINDOW'] = 60
+        worker = GithubDeploy(params={'delay': 'ads.deploy.github_deploy.delay'})
+
+        first = {'url': 'https://github.com/adsabs/adsws', 'commit': 'aaaa',
+                 'tag': None, 'delivery': 'd1'}
+        second = {'url': 'https://github.com/adsabs/adsws', 'commit': 'bbbb',
+                  'tag': None, 'delivery': 'd2'}
+
+        # both are parked in the delay queue, the redelivery is dropped
+        worker.process_payload(dict(first))
+        worker.process_payload(dict(first))
+        worker.process_payload(dict(second))
+        self.assertFalse(publish.called)
+        self.assertEqual(delay.call_count, 2)
+        self.assertEqual(delay.call_args_list[0][0],
+                         (dict(first, debounce='d1:None'), 60))
+        parked = [c[0][0] for c in delay.call_args_list]
+
+        # when they come back, only the newest one is deployed
+        for payload in parked:
+            worker.process_payload(payload)
+        publish.assert_called_once_with(
+            {'application': 'sandbox', 'environment': 'adsws', 'version': None,
+             'priority': 1})
+
+        # payloads without a delivery id (manual triggers) are not delayed
+        publish.reset_mock()
+        worker.process_payload({'url': 'adsabs/adsws', 'tag': 'v1.0.1'})
+        worker.process_payload({'url': 'adsabs/adsws', 'tag': 'v1.0.1'})
+        self.assertEqual(publish.call_count, 2)
+        self.assertEqual(delay.call_count, 2)
+
+        # the redeliveries are forgotten after GITHUB_DELIVERY_TTL
+        app.config['GITHUB_DELIVERY_TTL'] = -1
+        self.assertFalse(worker.is_duplicate('d1', 'aaaa'))
+
+    @mock.patch('ADSDeploy.pipeline.deploy.GithubDeploy.publish_to_error_queue')
+    @mock.patch('ADSDeploy.pipeline.deploy.GithubDeploy.publish')
+    @mock.patch('ADSDeploy.pipeline.deploy.ProjectMapper.get',
+                side_effect=lambda url: [
+                    {'application': 'staging-us', 'environment': 'adsws'},
+                    {'application': 'staging-eu', 'environment': 'adsws'},
+                    {'application': 'sandbox', 'environment': 'adsws'}])
+    def test_github_deploy_fanout(self, mapper, publish, error):
+        """A push is deployed to every environment of the fan-out policy"""
+        app.config['DEPLOY_FANOUT'] = {'adsabs/adsws': ['staging-*.adsws']}
+        worker = GithubDeploy()
+
+        worker.process_payload({'url': 'adsabs/adsws', 'tag': 'v1.0.1'})
+        self.assertEqual(publish.call_count, 2)
+        published = [c[0][0] for c in publish.call_args_list]
+        self.assertEqual([p['application'] for p in published], ['staging-us', 'staging-eu'])
+        group_id = published[0]['group_id']
+        self.assertEqual(published[1]['group_id'], group_id)
+        self.assertEqual(published[0]['version'], 'v1.0.1')
+
+        with app.session_scope() as session:
+            status = groups.status(session, group_id)
+        self.assertEqual(status['status'], 'in progress')
+        self.assertEqual(status['url'], 'adsabs/adsws')
+        self.assertEqual(status['counts']['pending'], 2)
+
+        # an explicit application is deployed alone
+        publish.reset_mock()
+        worker.process_payload({'url': 'adsabs/adsws', 'tag': 'v1.0.1',
+                                'application': 'sandbox'})
+        publish.assert_called_once_with({'application': 'sandbox', 'environment': 'adsws',
+                                         'version': 'v1.0.1', 'priority': 1})
+
+        # too many targets
+        publish.reset_mock()
+        app.config['DEPLOY_FANOUT_MAX_TARGETS'] = 1
+        worker.process_payload({'url': 'adsabs/adsws', 'tag': 'v1.0.1'})
+        self.assertFalse(publish.called)
+        self.assertFalse(error.call_args[1]['retry'])
+
+    def test_known_good_versions(self):
+        """The tested versions come from the history, then from the cache"""
+        with app.session_scope() as session:
+            for version, deployed, tested in (('v1', False, True), ('v2', False, False),
+                                              ('v3', True, True)):
+                session.add(Deployment(application='sandbox', environment='adsws',
+                                       version=version, deployed=deployed, tested=tested))
+            session.add(Deployment(application='sandbox', environment='solr',
+                                   version='v9', deployed=True, tested=True))
+
+        with app.session_scope() as session:
+            self.assertEqual(known_good_versions(session, 'sandbox', 'adsws'), ['v3', 'v1'])
+            # the history is not queried again
+            session.query(Deployment).delete()
+            self.assertEqual(known_good_versions(session, 'sandbox', 'adsws'), ['v3', 'v1'])
+
+            app.config['ROLLBACK_KNOWN_GOOD_SIZE'] = 2
+            remember_known_good(session, 'sandbox', 'adsws', 'v4')
+            self.assertEqual(known_good_versions(session, 'sandbox', 'adsws'), ['v4', 'v3'])
+            remember_known_good(session, 'sandbox', 'adsws', 'v3')
+            self.assertEqual(known_good_versions(session, 'sandbox', 'adsws'), ['v3', 'v4'])
+
+    @mock.patch('ADSDeploy.pipeline.deploy.Rollback.publish_to_error_queue')
+    @mock.patch('ADSDeploy.pipeline.deploy.Rollback.publish')
+    @mock.patch('ADSDeploy.pipeline.deploy.create_executioner')
+    def test_rollback(self, executioner, publish, error):
+        """The last known good version is swapped in, without tests"""
+        executioner.return_value.cmd.return_value = Mock(retcode=0)
+        with app.session_scope() as session:
+            for version, deployed, tested in (('v1', False, True), ('v2', False, True),
+                                              ('v3', True, True)):
+                session.add(Deployment(application='sandbox', environment='adsws',
+                                       version=version, deployed=deployed, tested=tested))
+
+        worker = Rollback(params={'status': 'ads.deploy.status'})
+        worker.process_payload({'application': 'sandbox', 'environment': 'adsws',
+                                'action': 'rollback'})
+        executioner.return_value.cmd.assert_called_once_with(
+            'eb deploy adsws-sandbox --version adsws:v2')
+        payload = publish.call_args[0][0]
+        self.assertEqual(publish.call_args_list[-2], mock.call(payload))
+        self.assertEqual((payload['version'], payload['deployed'], payload['tested']),
+                         ('v2', True, True))
+
+        # an explicit, known good version
+        executioner.reset_mock()
+        worker.process_payload({'application': 'sandbox', 'environment': 'adsws',
+                                'action': 'rollback', 'version': 'v1'})
+        executioner.return_value.cmd.assert_called_once_with(
+            'eb deploy adsws-sandbox --version adsws:v1')
+
+        # a version that was never tested is deployed (and tested) normally
+        executioner.reset_mock()
+        publish.reset_mock()
+        worker.process_payload({'application': 'sandbox', 'environment': 'adsws',
+                                'action': 'rollback', 'version': 'v0'})
+        self.assertFalse(executioner.called)
+        self.assertEqual(publish.call_args_list[0][1], {'topic': 'ads.deploy.deploy'})
+        self.assertEqual(publish.call_args[0][0]['action'], 'deploy')
+
+        # nothing to roll back to
+        worker.process_payload({'application': 'sandbox', 'environment': 'solr',
+                                'action': 'rollback'})
+        self.assertFalse(executioner.called)
+        self.assertFalse(error.call_args[1]['retry'])
+
+        # eb fails
+        executioner.return_value.cmd.return_value = Mock(retcode=1, out='', err='no such version')
+        error.reset_mock()
+        worker.process_payload({'application': 'sandbox', 'environment': 'adsws',
+                                'action': 'rollback'})
+        self.assertTrue(error.called)
+        self.assertFalse(publish.call_args[0][0]['deployed'])
+
 
 if __name__ == '__main__':
     unittest.main()
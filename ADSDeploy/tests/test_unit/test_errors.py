@@ -0,0 +1,185 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the retries of the failed messages. There is no communication.
+"""
+
+import json
+import mock
+import unittest
+
+from ADSDeploy import app, codec
+from ADSDeploy.pipeline import errors, generic
+from ADSDeploy.pipeline.pstart import TaskMaster
+
+
+class FailingWorker(generic.RabbitMQWorker):
+
+    def process_payload(self, payload, **kwargs):
+        raise Exception('AWS throttling')
+
+
+class TestErrors(unittest.TestCase):
+    """
+    Test the error queue, the retries and the parking lot
+    """
+
+    def setUp(self):
+        app.init_app({
+            'SQLALCHEMY_URL': 'sqlite://',
+            'RETRY_MAX_ATTEMPTS': 2,
+            'RETRY_BASE_DELAY': 10,
+            'RETRY_BACKOFF_FACTOR': 3,
+            'QUEUE_MAX_PRIORITY': 10
+        })
+
+    def tearDown(self):
+        app.close_app()
+
+    def test_retry_delay(self):
+        self.assertEqual(errors.retry_queue('ads.deploy.deploy', 2),
+                         'ads.deploy.deploy.retry.2')
+        self.assertEqual([errors.retry_delay(a) for a in (1, 2, 3)], [10, 30, 90])
+
+    @mock.patch('ADSDeploy.pipeline.generic.RabbitMQWorker.publish')
+    def test_error_headers(self, publish):
+        """Messages that fail carry their origin and the attempt"""
+        worker = FailingWorker({'subscribe': 'ads.deploy.deploy', 'error': 'ads.deploy.error'})
+        worker.channel = mock.Mock()
+        properties = codec.get_properties(headers={'x-attempt': 1})
+        worker.on_message(worker.channel, mock.Mock(delivery_tag=1), properties,
+                          json.dumps({'application': 'sandbox'}))
+
+        publish.assert_called_once_with({'application': 'sandbox'},
+                                        topic='ads.deploy.error', headers=mock.ANY)
+        headers = publish.call_args[1]['headers']
+        self.assertEqual(headers['x-origin'], 'ads.deploy.deploy')
+        self.assertEqual(headers['x-worker'], 'FailingWorker')
+        self.assertEqual(headers['x-attempt'], 1)
+        self.assertEqual(headers['x-error'], 'AWS throttling')
+        self.assertTrue(headers['x-retry'])
+        worker.channel.basic_ack.assert_called_once_with(delivery_tag=1)
+
+    @mock.patch('ADSDeploy.pipeline.errors.ErrorHandler.publish')
+    def test_error_handler(self, publish):
+        """Messages are retried with backoff and parked at last"""
+        worker = errors.ErrorHandler({'subscribe': 'ads.deploy.error'})
+        message = {'application': 'sandbox'}
+
+        def handle(**headers):
+            publish.reset_mock()
+            worker.process_payload(message, header_frame=codec.get_properties(headers=headers))
+            return publish.call_args[1]['topic'], publish.call_args[1]['headers']
+
+        topic, headers = handle(**{'x-origin': 'ads.deploy.deploy', 'x-attempt': 0})
+        self.assertEqual(topic, 'ads.deploy.deploy.retry.1')
+        self.assertEqual(headers['x-attempt'], 1)
+
+        topic, headers = handle(**{'x-origin': 'ads.deploy.deploy', 'x-attempt': 1})
+        self.assertEqual(topic, 'ads.deploy.deploy.retry.2')
+        self.assertEqual(headers['x-attempt'], 2)
+
+        topic, headers = handle(**{'x-origin': 'ads.deploy.deploy', 'x-attempt': 2})
+        self.assertEqual(topic, 'ads.deploy.parking_lot')
+        self.assertEqual(headers['x-origin'], 'ads.deploy.deploy')
+
+        # not worth retrying, unknown origin
+        topic, headers = handle(**{'x-origin': 'ads.deploy.deploy', 'x-retry': False})
+        self.assertEqual(topic, 'ads.deploy.parking_lot')
+        topic, headers = handle()
+        self.assertEqual(topic, 'ads.deploy.parking_lot')
+
+    def test_replay(self):
+        """Parked messages return to their queue, with the retries reset"""
+        worker = mock.Mock()
+        channel = worker.connection.channel.return_value
+        parked = [
+            (mock.Mock(delivery_tag=1),
+             codec.get_properties(headers={'x-origin': 'ads.deploy.deploy',
+                                           'x-attempt': 2, 'x-error': 'boom'}),
+             '{"a": 1}'),
+            (mock.Mock(delivery_tag=2), codec.get_properties(), '{"b": 2}'),
+            (None, None, None)
+        ]
+        channel.basic_get.side_effect = parked
+        channel.basic_publish.return_value = True
+
+        self.assertEqual(errors.replay_parking_lot(worker), 1)
+        channel.basic_publish.assert_called_once_with(
+            exchange=app.config.get('EXCHANGE'), routing_key='ads.deploy.deploy',
+            body='{"a": 1}', properties=mock.ANY, mandatory=True)
+        properties = channel.basic_publish.call_args[1]['properties']
+        self.assertEqual(properties.headers, {'x-envelope': 1})
+        channel.basic_ack.assert_called_once_with(delivery_tag=1)
+        self.assertTrue(channel.close.called)
+
+    def test_replay_unconfirmed(self):
+        """A message that was not confirmed (nack, unroutable) stays parked"""
+        worker = mock.Mock()
+        channel = worker.connection.channel.return_value
+        channel.basic_get.side_effect = [
+            (mock.Mock(delivery_tag=tag),
+             codec.get_properties(headers={'x-origin': 'ads.deploy.gone'}),
+             '{"a": 1}') for tag in (1, 2)
+        ]
+        channel.basic_publish.return_value = False
+
+        self.assertEqual(errors.replay_parking_lot(worker), 0)
+        self.assertEqual(channel.basic_publish.call_count, 1)
+        channel.basic_nack.assert_called_once_with(delivery_tag=1, requeue=True)
+        self.assertFalse(channel.basic_ack.called)
+        self.assertTrue(channel.close.called)
+
+    def test_topology(self):
+        """The retry queues dead-letter back to the worker's queue"""
+        master = TaskMaster('amqp://localhost', 'ADSDeploy', {
+            'ads.deploy.example': {'routing_key': 'example', 'durable': True}
+        }, {
+            'deploy.Deploy': {'subscribe': 'ads.deploy.deploy',
+                              'error': 'ads.deploy.error'},
+            'errors.ErrorHandler': {'subscribe': 'ads.deploy.error'}
+        })
+        with mock.patch('ADSDeploy.pipeline.pstart.generic.RabbitMQWorker') as worker:
+            master.initialize_rabbitmq()
+        declared = dict((c[1]['queue'], c[1].get('arguments'))
+                        for c in worker.return_value.channel.queue_declare.call_args_list)
+
+        self.assertEqual(declared['ads.deploy.deploy.retry.1'], {
+            'x-message-ttl': 10000,
+            'x-dead-letter-exchange': 'ADSDeploy',
+            'x-dead-letter-routing-key': 'ads.deploy.deploy'
+        })
+        self.assertEqual(declared['ads.deploy.deploy.retry.2']['x-message-ttl'], 30000)
+        self.assertNotIn('ads.deploy.deploy.retry.3', declared)
+        self.assertNotIn('ads.deploy.error.retry.1', declared)
+        self.assertIn('ads.deploy.parking_lot', declared)
+
+        # the queues of the workers (and of the routes) are priority queues
+        self.assertEqual(declared['ads.deploy.deploy'], {'x-max-priority': 10})
+        self.assertEqual(declared['ads.deploy.example'], {'x-max-priority': 10})
+        bindings = [c[1] for c in worker.return_value.channel.queue_bind.call_args_list
+                    if c[1]['queue'] == 'ads.deploy.example']
+        self.assertEqual([b['routing_key'] for b in bindings], ['example'])
+
+    def test_topology_without_priorities(self):
+        """By default the queues are declared without x-max-priority, so the
+        existing ones can be re-declared"""
+        app.config['QUEUE_MAX_PRIORITY'] = None
+        master = TaskMaster('amqp://localhost', 'ADSDeploy', {
+            'ads.deploy.example': {'routing_key': 'example'}
+        }, {
+            'deploy.Deploy': {'subscribe': 'ads.deploy.deploy',
+                              'publish': 'ads.deploy.db_writer'}
+        })
+        with mock.patch('ADSDeploy.pipeline.pstart.generic.RabbitMQWorker') as worker:
+            master.initialize_rabbitmq()
+        declared = dict((c[1]['queue'], c[1].get('arguments'))
+                        for c in worker.return_value.channel.queue_declare.call_args_list)
+
+        for qname in ('ads.deploy.example', 'ads.deploy.deploy', 'ads.deploy.db_writer'):
+            self.assertIsNone(declared[qname])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the asynchronous worker engine; RabbitMQ is replaced by a
+fake SelectConnection.
+"""
+
+import json
+import mock
+import pika
+import time
+import threading
+import unittest
+
+from ADSDeploy import app, codec
+from ADSDeploy.pipeline import generic
+
+
+class FakeChannel(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.published = []
+        self.acked = []
+        self.rejected = []
+        self.consumer = None
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def basic_qos(self, callback, prefetch_count=0):
+        self.prefetch_count = prefetch_count
+        callback(None)
+
+    def basic_consume(self, callback, queue):
+        self.consumer = callback
+
+    def basic_publish(self, **kwargs):
+        self.connection.check_thread()
+        self.published.append(kwargs)
+
+    def basic_ack(self, delivery_tag):
+        self.connection.check_thread()
+        self.acked.append(delivery_tag)
+
+    def basic_reject(self, delivery_tag, requeue):
+        self.connection.check_thread()
+        self.rejected.append(delivery_tag)
+
+
+class FakeConnection(object):
+    """Runs the callbacks like the SelectConnection ioloop does"""
+
+    def __init__(self, parameters, on_open_callback, on_open_error_callback,
+                 stop_ioloop_on_close):
+        self.on_open_callback = on_open_callback
+        self.timeouts = []
+        self.deliveries = []
+        self.closed = False
+        self.ioloop = self
+        self.chan = FakeChannel(self)
+        self.wrong_thread = False
+
+    def check_thread(self):
+        if threading.current_thread() is not self.thread:
+            self.wrong_thread = True
+
+    def start(self):
+        self.thread = threading.current_thread()
+        self.on_open_callback(self)
+        while not self.closed:
+            while self.deliveries:
+                tag, body = self.deliveries.pop(0)
+                self.chan.consumer(self.chan, mock.Mock(delivery_tag=tag), None, body)
+            if self.timeouts:
+                self.timeouts.pop(0)()
+            time.sleep(0.001)
+
+    def channel(self, on_open_callback):
+        on_open_callback(self.chan)
+
+    def add_timeout(self, deadline, callback):
+        self.timeouts.append(callback)
+
+    def close(self):
+        self.closed = True
+
+
+class SlowWorker(generic.RabbitMQWorker):
+
+    def __init__(self, *args, **kwargs):
+        super(SlowWorker, self).__init__(*args, **kwargs)
+        self.running = 0
+        self.most = 0
+        self.lock = threading.Lock()
+
+    def process_payload(self, payload, **kwargs):
+        if payload.get('fail'):
+            raise Exception('failed')
+        with self.lock:
+            self.running += 1
+            self.most = max(self.most, self.running)
+        time.sleep(0.2)
+        with self.lock:
+            self.running -= 1
+        self.publish(payload)
+
+
+class TestAsyncWorker(unittest.TestCase):
+    """
+    Test the AsyncWorkerMixin
+    """
+
+    def setUp(self):
+        app.init_app({'SQLALCHEMY_URL': 'sqlite://'})
+
+    def tearDown(self):
+        app.close_app()
+
+    @mock.patch('ADSDeploy.pipeline.generic.pika.SelectConnection', FakeConnection)
+    def test_concurrent_processing(self):
+        """Messages are processed concurrently, the channel is only used by
+        the ioloop thread"""
+        worker = generic.make_async(SlowWorker)({
+            'RABBITMQ_URL': 'amqp://localhost', 'subscribe': 'in', 'publish': 'out',
+            'error': 'error', 'max_inflight': 4
+        })
+        self.assertEqual(worker.__class__.__name__, 'SlowWorker')
+        self.assertIs(generic.make_async(worker.__class__), worker.__class__)
+
+        thread = threading.Thread(target=worker.run)
+        thread.start()
+        try:
+            for _ in range(100):
+                if worker.connection and worker.connection.chan.consumer:
+                    break
+                time.sleep(0.01)
+            connection = worker.connection
+            for i in range(4):
+                connection.deliveries.append((i, json.dumps({'i': i})))
+            connection.deliveries.append((4, json.dumps({'fail': True})))
+            connection.deliveries.append((5, 'not json'))
+
+            start = time.time()
+            while len(connection.chan.acked) < 6 and time.time() - start < 5:
+                time.sleep(0.01)
+            time.sleep(0.1)
+        finally:
+            worker.stop()
+            thread.join(5)
+
+        channel = connection.chan
+        self.assertEqual(channel.prefetch_count, 4)
+        self.assertEqual(sorted(channel.acked), [0, 1, 2, 3, 4, 5])
+        self.assertEqual(channel.rejected, [])
+        self.assertGreater(worker.most, 1)
+        self.assertEqual(sorted(json.loads(p['body'])['i'] for p in channel.published
+                                if p['routing_key'] == 'out'), [0, 1, 2, 3])
+        self.assertEqual(len([p for p in channel.published if p['routing_key'] == 'error']), 1)
+        self.assertEqual([p['body'] for p in channel.published
+                          if p['routing_key'] == 'ads.deploy.parking_lot'], ['not json'])
+        self.assertFalse(connection.wrong_thread)
+        self.assertFalse(thread.is_alive())
+
+
+class PublishingWorker(generic.RabbitMQWorker):
+
+    def process_payload(self, payload, **kwargs):
+        self.publish(payload)
+
+
+class TestReconnect(unittest.TestCase):
+    """
+    Test the reconnection of the (blocking) RabbitMQWorker
+    """
+
+    def setUp(self):
+        app.init_app({'SQLALCHEMY_URL': 'sqlite://'})
+
+    def tearDown(self):
+        app.close_app()
+
+    def create_connection(self, consume):
+        """
+        :param consume: side effect of start_consuming(), gets the channel
+        :return: mock of pika.BlockingConnection
+        """
+        connection = mock.MagicMock()
+        connection.channels = []
+
+        def channel():
+            c = mock.MagicMock()
+            c.basic_publish.return_value = True
+            c.basic_consume.side_effect = lambda callback, **kwargs: \
+                setattr(c, 'callback', callback)
+            c.start_consuming.side_effect = lambda: consume(c)
+            connection.channels.append(c)
+            return c
+        connection.channel.side_effect = channel
+        return connection
+
+    @mock.patch('ADSDeploy.pipeline.generic.time.sleep')
+    def test_reconnect(self, sleep):
+        """Connection failures are retried with backoff, messages published
+        during an outage are buffered and published after the reconnection"""
+        lost = pika.exceptions.ConnectionClosed(320, 'CONNECTION_FORCED')
+
+        def broken(channel):
+            # the connection dies while the message is processed
+            channel.basic_publish.side_effect = lost
+            channel.basic_ack.side_effect = lost
+            channel.callback(channel, mock.Mock(delivery_tag=1), None,
+                             json.dumps({'foo': 'bar'}))
+            raise lost
+
+        first = self.create_connection(broken)
+        second = self.create_connection(lambda channel: None)
+
+        worker = PublishingWorker({
+            'RABBITMQ_URL': 'amqp://localhost', 'subscribe': 'in', 'publish': 'out'
+        })
+        with mock.patch('ADSDeploy.pipeline.generic.pika.BlockingConnection') as c:
+            c.side_effect = [pika.exceptions.AMQPConnectionError('refused'), first, second]
+            worker.run()
+
+        self.assertEqual(c.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertTrue(first.close.called)
+
+        # the message was buffered and published with confirms
+        self.assertEqual(len(worker._publish_buffer), 0)
+        consumer, confirmed = second.channels
+        self.assertTrue(confirmed.confirm_delivery.called)
+        self.assertFalse(consumer.basic_publish.called)
+        kwargs = confirmed.basic_publish.call_args[1]
+        self.assertEqual(kwargs['routing_key'], 'out')
+        self.assertEqual(json.loads(kwargs['body']), {'foo': 'bar'})
+
+    def test_publish_buffer(self):
+        """Refused messages stay in the buffer, the oldest are dropped when
+        it is full"""
+        app.config['PUBLISH_BUFFER_SIZE'] = 2
+        worker = PublishingWorker({'publish': 'out'})
+        worker.connection = mock.Mock()
+        worker.connection.channel.side_effect = pika.exceptions.ConnectionClosed()
+        worker.channel = mock.Mock()
+        worker.channel.basic_publish.side_effect = pika.exceptions.ConnectionClosed()
+
+        for i in range(3):
+            worker.publish({'i': i})
+        self.assertEqual([json.loads(m[2])['i'] for m in worker._publish_buffer], [1, 2])
+
+        # the broker refuses the first one
+        worker.connection = mock.Mock()
+        worker.connection.channel.return_value.basic_publish.side_effect = [False, True, True]
+        self.assertEqual(worker.flush_publish_buffer(), 0)
+        self.assertEqual(len(worker._publish_buffer), 2)
+
+        self.assertEqual(worker.flush_publish_buffer(), 2)
+        self.assertEqual(len(worker._publish_buffer), 0)
+
+    def test_undecodable_message(self):
+        """A message that cannot be decoded is parked and acknowledged,
+        it is not processed (nor redelivered)"""
+        worker = PublishingWorker({'publish': 'out', 'exchange': 'x'})
+        worker.channel = mock.Mock()
+        worker.process_payload = mock.Mock()
+        properties = codec.get_properties(content_encoding='br')
+
+        worker.on_message(worker.channel, mock.Mock(delivery_tag=1),
+                          properties, 'body')
+
+        self.assertFalse(worker.process_payload.called)
+        worker.channel.basic_publish.assert_called_once_with(
+            exchange='x', routing_key='ads.deploy.parking_lot',
+            body='body', properties=properties)
+        worker.channel.basic_ack.assert_called_once_with(delivery_tag=1)
+        self.assertFalse(worker.channel.basic_reject.called)
+
+    def test_async_calls_after_reconnect(self):
+        """Publishes of the handlers survive a reconnection, acks of
+        messages received on the old channel are dropped"""
+        worker = generic.make_async(PublishingWorker)({'publish': 'out'})
+        worker._calls = generic.Queue.Queue()
+        worker._ioloop_thread = None
+        worker._closing = True
+        old, new = mock.Mock(), mock.Mock()
+
+        generic._ChannelProxy(worker, old).basic_ack(delivery_tag=1)
+        generic._ChannelProxy(worker, old).basic_publish(exchange='x', routing_key='out', body='{}')
+        worker.channel = generic._ChannelProxy(worker, new)
+        worker.channel.basic_ack(delivery_tag=2)
+        worker._poll()
+
+        self.assertFalse(old.basic_ack.called)
+        self.assertFalse(old.basic_publish.called)
+        new.basic_publish.assert_called_once_with(exchange='x', routing_key='out', body='{}')
+        new.basic_ack.assert_called_once_with(delivery_tag=2)
+
+
+class TestPublishBatch(unittest.TestCase):
+    """
+    Test RabbitMQWorker.publish_batch()
+    """
+
+    def setUp(self):
+        app.init_app({'SQLALCHEMY_URL': 'sqlite://'})
+
+    def tearDown(self):
+        app.close_app()
+
+    def test_batch(self):
+        """The messages of a batch are sent in one transaction"""
+        worker = PublishingWorker({'publish': 'out', 'exchange': 'x'})
+        worker.connection = mock.Mock()
+        worker.channel = mock.Mock()
+        tx = worker.connection.channel.return_value
+
+        with worker.publish_batch():
+            worker.publish({'a': 1})
+            with worker.publish_batch():
+                worker.publish({'b': 2}, topic='status')
+            self.assertFalse(tx.basic_publish.called)
+
+        self.assertFalse(worker.channel.basic_publish.called)
+        self.assertEqual(tx.tx_select.call_count, 1)
+        self.assertEqual(tx.tx_commit.call_count, 1)
+        self.assertEqual([c[1]['routing_key'] for c in tx.basic_publish.call_args_list],
+                         ['out', 'status'])
+
+        # the channel is reused, and the messages are sent on an exception
+        try:
+            with worker.publish_batch():
+                worker.publish({'c': 3})
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(tx.tx_select.call_count, 1)
+        self.assertEqual(tx.tx_commit.call_count, 2)
+
+        # a failed transaction goes to the publish buffer
+        tx.tx_commit.side_effect = pika.exceptions.ConnectionClosed()
+        with worker.publish_batch():
+            worker.publish({'d': 4})
+            worker.publish({'e': 5})
+        self.assertEqual([json.loads(m[2]) for m in worker._publish_buffer],
+                         [{'d': 4}, {'e': 5}])
+
+
+if __name__ == '__main__':
+    unittest.main()
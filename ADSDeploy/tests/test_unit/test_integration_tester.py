@@ -9,7 +9,7 @@ are tested in this suite. There is no communication.
 import mock
 import unittest
 
-from ADSDeploy import app
+from ADSDeploy import app, storage
 from ADSDeploy.tests import test_base
 from ADSDeploy.models import Base
 from ADSDeploy.pipeline.deploy import Deploy, BeforeDeploy, AfterDeploy
@@ -256,5 +256,71 @@ class TestIntegrationWorker(unittest.TestCase):
 
         self.assertEqual(expected_text, actual_text)
 
+
+class TestResultCache(unittest.TestCase):
+    """
+    The verdicts of passed test runs are reused
+    """
+
+    def setUp(self):
+        app.init_app({
+            'SQLALCHEMY_URL': 'sqlite://',
+            'SQLALCHEMY_ECHO': False,
+            'TEST_RESULT_TTL': {'default': 60, 'production': 0}
+        })
+        Base.metadata.bind = app.session.get_bind()
+        Base.metadata.create_all()
+
+    def tearDown(self):
+        Base.metadata.drop_all()
+        app.close_app()
+
+    @mock.patch('ADSDeploy.pipeline.integration_tester.IntegrationTestWorker.adsrex_commit',
+                return_value='abc123')
+    @mock.patch('ADSDeploy.pipeline.integration_tester.IntegrationTestWorker.run_test')
+    @mock.patch('ADSDeploy.pipeline.integration_tester.IntegrationTestWorker.publish')
+    def test_cached_verdict(self, mocked_publish, mocked_run, mocked_commit):
+        """
+        A version that passed against the same adsrex commit is not tested
+        again, until the verdict expires
+        """
+        worker = IntegrationTestWorker(params={'status': 'ads.deploy.status'})
+        payload = {'application': 'sandbox', 'environment': 'adsws', 'version': 'v1'}
+
+        mocked_run.side_effect = lambda msg: dict(msg, tested=False)
+        worker.process_payload(payload)
+        mocked_run.side_effect = lambda msg: dict(msg, tested=True)
+        worker.process_payload(payload)
+        self.assertEqual(mocked_run.call_count, 2)
+
+        # passed: the next run is skipped
+        worker.process_payload(payload)
+        self.assertEqual(mocked_run.call_count, 2)
+        result = mocked_publish.call_args[0][0]
+        self.assertTrue(result['tested'])
+        self.assertIn('tests skipped', result['msg'])
+
+        # another adsrex commit, another application/version, or disabled
+        mocked_commit.return_value = 'def456'
+        worker.process_payload(payload)
+        worker.process_payload(dict(payload, application='production'))
+        worker.process_payload(dict(payload, version='v2'))
+        self.assertEqual(mocked_run.call_count, 5)
+
+        # the same version string of another service is another build
+        worker.process_payload(dict(payload, environment='bumblebee'))
+        self.assertEqual(mocked_run.call_count, 6)
+
+        # expired
+        with app.session_scope() as session:
+            key = worker.cache_key(payload)
+            storage.put(session, storage.TEST_RESULT_EXPIRY, key, 0)
+        worker.process_payload(payload)
+        self.assertEqual(mocked_run.call_count, 7)
+        with app.session_scope() as session:
+            self.assertEqual(storage.scan_below(session, storage.TEST_RESULT_EXPIRY, 1), {})
+            self.assertEqual(len(storage.scan_prefix(session, storage.TEST_RESULT, '')), 4)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,12 +15,15 @@ import json
 import re
 import os
 import math
+import time
+import shutil
+import tempfile
 import httpretty
 import mock
 from io import BytesIO
 
 from ADSDeploy.tests import test_base
-from ADSDeploy import app, utils
+from ADSDeploy import app, utils, osutils
 from ADSDeploy.models import Base, KeyValue
 
 class TestLibraries(test_base.TestUnit):
@@ -61,6 +64,69 @@ class TestLibraries(test_base.TestUnit):
         self.assertEqual(d3.isoformat(), '2009-09-03T20:56:35.450686+00:00')
 
 
+    def test_get_priority(self):
+        """Priorities by environment, by application and explicit"""
+        priorities = {'default': 5, 'sandbox': 1, 'production.adsws': 9}
+
+        get = lambda **payload: utils.get_priority(payload, priorities, 10)
+        self.assertEqual(get(application='production', environment='adsws'), 9)
+        self.assertEqual(get(application='production', environment='solr'), 5)
+        self.assertEqual(get(application='sandbox', environment='adsws'), 1)
+        self.assertEqual(get(application='sandbox', priority=8), 8)
+        self.assertEqual(get(application='sandbox', priority=80), 10)
+        self.assertEqual(utils.get_priority({'application': 'x'}, {}, 10), 0)
+        self.assertIsNone(utils.get_priority({'priority': 3}, priorities, 0))
+
+    def test_cmd_max_wait(self):
+        """A command that runs longer than max_wait is killed"""
+        start = time.time()
+        with self.assertRaises(osutils.CommandError) as e:
+            osutils.cmd('sleep 10', max_wait=0.2)
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(e.exception.result.timed_out)
+        r = osutils.cmd('echo ok', max_wait=5)
+        self.assertEqual(r.out, 'ok\n')
+        self.assertFalse(r.timed_out)
+
+    def test_load_config(self):
+        """The configuration is cached until the files change"""
+        home = tempfile.mkdtemp()
+        files = [os.path.join(home, 'config.py'), os.path.join(home, 'local_config.py')]
+        try:
+            with open(files[0], 'w') as f:
+                f.write("WORKERS = {'deploy.Deploy': {'subscribe': 'a', 'concurrency': 1}}\n")
+
+            with mock.patch.object(utils, '_config_files', return_value=(home, files)), \
+                    mock.patch.object(utils, 'load_module', wraps=utils.load_module) as load:
+                conf = utils.load_config()
+                self.assertEqual(conf['WORKERS']['deploy.Deploy']['subscribe'], 'a')
+                self.assertEqual(load.call_count, 2)
+
+                # the copies are independent, the files are not read again
+                conf['WORKERS']['deploy.Deploy']['subscribe'] = 'b'
+                self.assertEqual(utils.load_config()['WORKERS']['deploy.Deploy']['subscribe'], 'a')
+                self.assertEqual(load.call_count, 2)
+                self.assertFalse(utils.config_changed())
+
+                with open(files[1], 'w') as f:
+                    f.write("WORKERS = {'deploy.Deploy': {'subscribe': 'c'}}\n")
+                self.assertTrue(utils.config_changed())
+                self.assertEqual(utils.load_config()['WORKERS']['deploy.Deploy']['subscribe'], 'c')
+                self.assertEqual(load.call_count, 4)
+
+                # an invalid configuration is refused
+                with open(files[1], 'w') as f:
+                    f.write("WORKERS = {'deploy.Deploy': {'subcribe': 'c', 'concurrency': 0}}\n"
+                            "QUEUES = {'x': {'durable': 'yes'}}\n")
+                with self.assertRaises(ValueError) as e:
+                    utils.load_config()
+                for problem in ("unknown key 'subcribe'", "'concurrency' must be at least 1",
+                                "'durable' has a wrong type", "missing key 'routing_key'"):
+                    self.assertIn(problem, str(e.exception))
+        finally:
+            utils._snapshots.pop(home, None)
+            shutil.rmtree(home)
+
     def test_models(self):
         """Check serialization into JSON"""
         
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the load generator. There is no communication.
+"""
+
+import os
+import mock
+import time
+import shutil
+import tempfile
+import unittest
+
+from ADSDeploy import app, loadgen
+
+
+class TestLoadGenerator(unittest.TestCase):
+    """
+    Test the replay of the payloads, the pacing and the report
+    """
+
+    def setUp(self):
+        app.init_app({'SQLALCHEMY_URL': 'sqlite://'})
+        self.directory = tempfile.mkdtemp()
+        self.workers = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        app.close_app()
+
+    def make_worker(self, confirm_delivery=False):
+        worker = mock.Mock()
+        worker.encode.side_effect = lambda message: (message, None)
+        worker.channel.queue_declare.return_value.method.message_count = 7
+        self.workers.append(worker)
+        return worker
+
+    def published(self):
+        return [c[1]['body'] for w in self.workers
+                for c in w.channel.basic_publish.call_args_list]
+
+    def test_read_payloads(self):
+        path = os.path.join(self.directory, 'payloads.jsonl')
+        with open(path, 'w') as f:
+            f.write('{"application": "sandbox"}\n\n{"application": "bumblebee"}\n')
+        self.assertEqual(loadgen.read_payloads(path),
+                         [{'application': 'sandbox'}, {'application': 'bumblebee'}])
+
+        with open(path, 'a') as f:
+            f.write('{"application": \n')
+        with self.assertRaisesRegexp(ValueError, 'payloads.jsonl:4'):
+            loadgen.read_payloads(path)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(loadgen.percentile(values, 50), 50)
+        self.assertEqual(loadgen.percentile(values, 99), 99)
+        self.assertEqual(loadgen.percentile(values, 100), 100)
+        self.assertEqual(loadgen.percentile([3], 90), 3)
+        self.assertIsNone(loadgen.percentile([], 50))
+
+    def test_replay(self):
+        """Without a duration every payload is sent once"""
+        generator = loadgen.LoadGenerator(['a', 'b', 'c'], 'amqp://localhost',
+                                          'ads.deploy.github_deploy', exchange='ADSDeploy',
+                                          concurrency=2)
+        generator.make_worker = self.make_worker
+        report = generator.run()
+
+        self.assertEqual(sorted(self.published()), ['a', 'b', 'c'])
+        self.assertEqual(report['sent'], 3)
+        self.assertEqual(report['errors'], 0)
+        self.assertEqual(set(report['latency_ms']), set(['p50', 'p90', 'p99', 'max']))
+        self.assertEqual(report['queue_depth'][-1][1], 7)
+        # two publishers and the monitor, all closed
+        self.assertEqual(len(self.workers), 3)
+        for worker in self.workers:
+            self.assertTrue(worker.connection.close.called)
+
+    def test_rate(self):
+        """The publishers share the schedule, the payloads are repeated"""
+        generator = loadgen.LoadGenerator(['a', 'b'], 'amqp://localhost',
+                                          'ads.deploy.github_deploy',
+                                          rate=100, concurrency=3, duration=0.2)
+        generator.make_worker = self.make_worker
+        start = time.time()
+        report = generator.run()
+
+        self.assertGreaterEqual(time.time() - start, 0.18)
+        self.assertEqual(report['sent'], 20)
+        self.assertEqual(self.published().count('a'), 10)
+
+    def test_errors(self):
+        """Messages the broker did not confirm are counted as errors"""
+        generator = loadgen.LoadGenerator(['a'], 'amqp://localhost',
+                                          'ads.deploy.github_deploy', messages=4)
+
+        def make_worker(confirm_delivery=False):
+            worker = self.make_worker()
+            worker.channel.basic_publish.side_effect = [True, False, True, False]
+            return worker
+
+        generator.make_worker = make_worker
+        report = generator.run()
+        self.assertEqual(report['sent'], 2)
+        self.assertEqual(report['errors'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
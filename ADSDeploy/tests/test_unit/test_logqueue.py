@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the non-blocking logging
+"""
+
+import os
+import json
+import Queue
+import shutil
+import logging
+import tempfile
+import unittest
+
+from ADSDeploy import logqueue
+
+
+class TestLogQueue(unittest.TestCase):
+    """
+    Test the queue handler, the writer thread and the rate limit
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.queue = Queue.Queue()
+        self.listener = logqueue.QueueListener(
+            self.queue, logqueue.FileDispatcher(self.directory))
+        self.listener.start()
+
+        self.handler = logqueue.QueueHandler(self.queue)
+        self.handler.addFilter(logqueue.RateLimitFilter())
+        self.logger = logging.getLogger('test_logqueue')
+        self.logger.handlers = [self.handler]
+        self.logger.propagate = False
+        self.logger.setLevel(logging.DEBUG)
+        self.options = dict(logqueue.options)
+
+    def tearDown(self):
+        logqueue.options.update(self.options)
+        self.logger.handlers = []
+        self.listener.stop()
+        self.listener.handler.close()
+        shutil.rmtree(self.directory)
+
+    def read(self):
+        self.listener.stop()
+        with open(os.path.join(self.directory, 'test_logqueue.log')) as f:
+            return f.read().splitlines()
+
+    def test_text(self):
+        """The writer thread writes the records of the queue"""
+        self.logger.info('deployed %s to %s', 'sandbox', 'eb-deploy')
+        try:
+            raise ValueError('boom')
+        except ValueError:
+            self.logger.exception('failed')
+
+        lines = self.read()
+        self.assertIn('INFO', lines[0])
+        self.assertTrue(lines[0].endswith('deployed sandbox to eb-deploy'))
+        self.assertTrue(lines[1].endswith('failed'))
+        self.assertEqual(lines[-1], 'ValueError: boom')
+
+    def test_json(self):
+        """One JSON object per line"""
+        logqueue.configure(json_lines=True)
+        self.logger.warning('%d retries', 3)
+
+        line = json.loads(self.read()[0])
+        self.assertEqual(line['message'], '3 retries')
+        self.assertEqual(line['level'], 'WARNING')
+        self.assertEqual(line['logger'], 'test_logqueue')
+        self.assertEqual(line['pid'], os.getpid())
+
+    def test_rate_limit(self):
+        """Repetitive debug lines are dropped and counted"""
+        logqueue.configure(rate_limit=2)
+
+        def poll(i):
+            self.logger.debug('polling %d', i)
+            self.logger.info('processed %d', i)
+
+        for i in range(5):
+            poll(i)
+
+        # one second later
+        buckets = self.handler.filters[0].buckets
+        key, (tokens, updated, dropped) = buckets.items()[0]
+        buckets[key] = (tokens, updated - 1, dropped)
+        poll(5)
+
+        lines = self.read()
+        debug = [l for l in lines if l.startswith('DEBUG')]
+        self.assertEqual(len([l for l in lines if l.startswith('INFO')]), 6)
+        self.assertEqual(len(debug), 3)
+        self.assertTrue(debug[-1].endswith('polling 5 (3 similar messages suppressed)'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the sync of the deployments with Elastic Beanstalk. There is
+no communication.
+"""
+
+import mock
+import unittest
+
+from ADSDeploy import app, manage, statusdoc
+from ADSDeploy.models import Base, Deployment
+
+
+def environment(application, name, version, health='Green'):
+    return {
+        'ApplicationName': application,
+        'CNAME': '{0}-{1}.us-east-1.elasticbeanstalk.com'.format(name, application),
+        'VersionLabel': '{0}:{1}:{2}'.format(name, version, 'latest'),
+        'Health': health
+    }
+
+
+class TestManage(unittest.TestCase):
+    """
+    Test the bootstrap/sync of the environments
+    """
+
+    def setUp(self):
+        app.init_app({
+            'SQLALCHEMY_URL': 'sqlite://',
+            'SQLALCHEMY_ECHO': False,
+        })
+        Base.metadata.bind = app.session.get_bind()
+        Base.metadata.create_all()
+        self.client = mock.Mock()
+
+    def tearDown(self):
+        Base.metadata.drop_all()
+        app.close_app()
+
+    def describe(self, *environments):
+        """Two pages of environments"""
+        self.client.describe_environments.side_effect = [
+            {'Environments': list(environments[:1]), 'NextToken': 'page2'},
+            {'Environments': list(environments[1:])}
+        ]
+
+    def deployments(self):
+        with app.session_scope() as session:
+            return sorted((d.application, d.environment, d.version, d.deployed)
+                          for d in session.query(Deployment))
+
+    def test_pagination(self):
+        self.describe(environment('sandbox', 'adsws', 'v1'),
+                      environment('sandbox', 'solr', 'v2'))
+        self.assertEqual(len(manage.describe_environments(self.client)), 2)
+        self.assertEqual(self.client.describe_environments.call_args_list, [
+            mock.call(IncludeDeleted=False),
+            mock.call(IncludeDeleted=False, NextToken='page2')
+        ])
+
+    def test_sync(self):
+        """Only the changes are written, running it again changes nothing"""
+        self.describe(environment('sandbox', 'adsws', 'v1'),
+                      environment('sandbox', 'solr', 'v2', health='Red'))
+        self.assertEqual(manage.sync_environments(self.client), (2, 0))
+        self.assertEqual(self.deployments(), [
+            ('sandbox', 'adsws', 'v1:latest', True),
+            ('sandbox', 'solr', 'v2:latest', False)
+        ])
+
+        self.describe(environment('sandbox', 'adsws', 'v1'),
+                      environment('sandbox', 'solr', 'v2', health='Red'))
+        self.assertEqual(manage.sync_environments(self.client), (0, 0))
+        with app.session_scope() as session:
+            self.assertEqual(statusdoc.revision(session), 2)
+
+        # a new version (the previous one is no longer deployed), a health
+        # change and a new environment
+        self.describe(environment('sandbox', 'adsws', 'v3'),
+                      environment('sandbox', 'solr', 'v2'),
+                      environment('production', 'adsws', 'v1'))
+        self.assertEqual(manage.sync_environments(self.client), (2, 2))
+        self.assertEqual(self.deployments(), [
+            ('production', 'adsws', 'v1:latest', True),
+            ('sandbox', 'adsws', 'v1:latest', False),
+            ('sandbox', 'adsws', 'v3:latest', True),
+            ('sandbox', 'solr', 'v2:latest', True)
+        ])
+
+        with app.session_scope() as session:
+            deployment = session.query(Deployment).filter_by(version='v3:latest').one()
+            self.assertEqual(deployment.msg, 'AWS bootstrapped')
+            self.assertFalse(deployment.tested)
+            self.assertIsNotNone(deployment.date_created)
+            self.assertEqual([d['environment'] for d in statusdoc.changes_since(session, 2)],
+                             ['adsws', 'adsws', 'solr'])
+
+    def test_sync_after_rollback(self):
+        """An older version that runs again is updated, not duplicated"""
+        with app.session_scope() as session:
+            session.add(Deployment(application='sandbox', environment='adsws',
+                                   version='v1:latest', deployed=True, tested=True))
+            session.add(Deployment(application='sandbox', environment='adsws',
+                                   version='v2:latest', deployed=True, tested=True))
+
+        self.describe(environment('sandbox', 'adsws', 'v1'))
+        self.assertEqual(manage.sync_environments(self.client), (0, 1))
+        self.assertEqual(self.deployments(), [
+            ('sandbox', 'adsws', 'v1:latest', True),
+            ('sandbox', 'adsws', 'v2:latest', False)
+        ])
+
+        self.describe(environment('sandbox', 'adsws', 'v1'))
+        self.assertEqual(manage.sync_environments(self.client), (0, 0))
+
+        # v2 is back (but not healthy yet)
+        self.describe(environment('sandbox', 'adsws', 'v2', health='Red'))
+        self.assertEqual(manage.sync_environments(self.client), (0, 0))
+        self.describe(environment('sandbox', 'adsws', 'v2'))
+        self.assertEqual(manage.sync_environments(self.client), (0, 2))
+        self.assertEqual(self.deployments(), [
+            ('sandbox', 'adsws', 'v1:latest', False),
+            ('sandbox', 'adsws', 'v2:latest', True)
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
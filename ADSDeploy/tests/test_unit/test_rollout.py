@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the staged rollouts. There is no communication.
+"""
+
+import mock
+import pika
+import unittest
+
+from datetime import datetime, timedelta
+from ADSDeploy import app, rollout
+from ADSDeploy.models import Base, Deployment, Rollout
+from ADSDeploy.pipeline.pstart import TaskMaster
+
+
+class TestRollout(unittest.TestCase):
+    """
+    Test the state machine of the rollouts
+    """
+
+    def setUp(self):
+        app.init_app({
+            'SQLALCHEMY_URL': 'sqlite://',
+            'SQLALCHEMY_ECHO': False,
+            'ROLLOUT_WAVE_TIMEOUT': 600
+        })
+        Base.metadata.bind = app.session.get_bind()
+        Base.metadata.create_all()
+        self.published = []
+        self.unhealthy = set()
+
+        # the versions before the rollout
+        with app.session_scope() as session:
+            for target in ('sandbox.adsws', 'staging.adsws', 'production.adsws'):
+                application, environment = target.split('.')
+                session.add(Deployment(application=application, environment=environment,
+                                       version='v1', deployed=True, tested=True))
+
+    def tearDown(self):
+        Base.metadata.drop_all()
+        app.close_app()
+
+    def create(self, on_failure='rollback'):
+        with app.session_scope() as session:
+            return rollout.create(session, 'v2', [['sandbox.adsws'],
+                                                  ['staging.adsws', 'production.adsws']],
+                                  on_failure=on_failure).id
+
+    def tick(self):
+        return rollout.tick(self.published.append, probe=lambda t: t not in self.unhealthy)
+
+    def get(self, rollout_id):
+        with app.session_scope() as session:
+            return session.query(Rollout).get(rollout_id).toJSON()
+
+    def finish(self, deployed=True, tested=True, **filters):
+        """The pipeline reports the results of the published requests"""
+        waiting = []
+        with app.session_scope() as session:
+            for payload in self.published:
+                if any(payload.get(k) != v for k, v in filters.items()):
+                    waiting.append(payload)
+                    continue
+                session.add(Deployment(application=payload['application'],
+                                       environment=payload['environment'],
+                                       version=payload['version'],
+                                       group_id=payload['group_id'],
+                                       deployed=deployed, tested=tested))
+        self.published[:] = waiting
+
+    def test_create(self):
+        with app.session_scope() as session:
+            for waves in ([], [[]], [['adsws']], [['sandbox.adsws'], ['sandbox.adsws']]):
+                with self.assertRaises(ValueError):
+                    rollout.create(session, 'v2', waves)
+            with self.assertRaises(ValueError):
+                rollout.create(session, 'v2', [['sandbox.adsws']], on_failure='panic')
+
+    def test_waves(self):
+        """The waves are deployed one after the other"""
+        rollout_id = self.create()
+        self.assertEqual(self.tick(), [(rollout_id, 'running')])
+        self.assertEqual([(p['application'], p['version'], p['rollout_id'])
+                          for p in self.published], [('sandbox', 'v2', rollout_id)])
+
+        # nothing happens until the canary is deployed and tested
+        self.finish(tested=None)
+        self.assertEqual(self.tick(), [])
+        with app.session_scope() as session:
+            session.query(Deployment).filter_by(version='v2').update({'tested': True})
+
+        self.tick()
+        r = self.get(rollout_id)
+        self.assertEqual((r['state'], r['wave']), ('running', 1))
+        self.assertEqual(r['previous'], {'sandbox.adsws': 'v1', 'staging.adsws': 'v1',
+                                         'production.adsws': 'v1'})
+        self.assertEqual(sorted(p['application'] for p in self.published),
+                         ['production', 'staging'])
+        self.assertEqual(len(set(p['group_id'] for p in self.published)), 1)
+
+        self.finish()
+        self.tick()
+        r = self.get(rollout_id)
+        self.assertEqual(r['state'], 'succeeded')
+        self.assertEqual(self.tick(), [])
+
+    def test_rollback(self):
+        """A failed test rolls back the environments the rollout changed"""
+        rollout_id = self.create()
+        self.tick()
+        self.finish()
+        self.tick()
+        self.finish(application='staging')
+        self.finish(tested=False)
+        self.tick()
+
+        r = self.get(rollout_id)
+        self.assertEqual(r['state'], 'rolling back')
+        self.assertIn('production.adsws failed', r['msg'])
+        self.assertEqual(sorted((p['application'], p['version']) for p in self.published),
+                         [('production', 'v1'), ('sandbox', 'v1'), ('staging', 'v1')])
+
+        self.finish(tested=None)
+        self.tick()
+        self.assertEqual(self.get(rollout_id)['state'], 'rolled back')
+
+    def test_stop(self):
+        """Unhealthy environments stop the rollout"""
+        rollout_id = self.create(on_failure='stop')
+        self.tick()
+        self.unhealthy.add('sandbox.adsws')
+        self.finish()
+        self.tick()
+
+        r = self.get(rollout_id)
+        self.assertEqual(r['state'], 'failed')
+        self.assertEqual(r['msg'], 'Wave 0 is not healthy: sandbox.adsws')
+        self.assertEqual(self.published, [])
+
+    def test_one_probe_per_tick(self):
+        """The health of one wave is checked per tick"""
+        first, second = self.create(), self.create()
+        self.tick()
+        self.finish()
+        probed = []
+        tick = lambda: rollout.tick(self.published.append,
+                                    probe=lambda t: probed.append(t) or True)
+
+        tick()
+        self.assertEqual(probed, ['sandbox.adsws'])
+        self.assertEqual([self.get(r)['wave'] for r in (first, second)], [1, 0])
+        tick()
+        self.assertEqual(probed, ['sandbox.adsws'] * 2)
+        self.assertEqual([self.get(r)['wave'] for r in (first, second)], [1, 1])
+
+    @mock.patch('ADSDeploy.pipeline.pstart.generic.RabbitMQWorker')
+    def test_connection_lost(self, worker):
+        """A request that was not sent is sent again by the next tick"""
+        publisher = worker.return_value
+        publisher.encode.return_value = ('body', None)
+        publisher.channel.basic_publish.side_effect = [
+            pika.exceptions.AMQPConnectionError('lost'), False, True]
+        master = TaskMaster('amqp://localhost', 'ADSDeploy', {}, {})
+        rollout_id = self.create()
+
+        # the connection drops, then the broker does not confirm
+        for _ in range(2):
+            master.advance_rollouts()
+            r = self.get(rollout_id)
+            self.assertEqual((r['state'], r['group_id']), ('pending', None))
+        self.assertEqual(worker.call_count, 2)
+        publisher.connect.assert_called_with('amqp://localhost', confirm_delivery=True)
+
+        master.advance_rollouts()
+        self.assertEqual(self.get(rollout_id)['state'], 'running')
+        self.assertEqual(publisher.channel.basic_publish.call_args[1]['mandatory'], True)
+
+    def test_timeout_and_resume(self):
+        """The state is in the database; a slow wave fails"""
+        rollout_id = self.create(on_failure='stop')
+        self.tick()
+        self.assertEqual(self.tick(), [])
+
+        with app.session_scope() as session:
+            session.query(Rollout).get(rollout_id).wave_started = \
+                datetime.utcnow() - timedelta(seconds=601)
+        self.tick()
+        r = self.get(rollout_id)
+        self.assertEqual((r['state'], r['msg']), ('failed', 'Wave 0 timed out'))
+
+
+if __name__ == '__main__':
+    unittest.main()
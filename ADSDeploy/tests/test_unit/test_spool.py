@@ -0,0 +1,149 @@
+"""
+Test the webhook spool
+"""
+
+import os
+import json
+import mock
+import shutil
+import tempfile
+import unittest
+import threading
+
+from ADSDeploy.webapp.spool import Spool, Forwarder
+
+
+class TestSpool(unittest.TestCase):
+    """
+    Test appending to and draining the spool
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_append_and_drain(self):
+        """
+        Records are forwarded once, in order, and fully forwarded sealed
+        segments are removed
+        """
+        spool = Spool(self.directory, segment_bytes=10)
+        for i in range(5):
+            spool.append({'i': i, 'data': 'x' * 20})
+        self.assertEqual(spool.pending(), 5)
+        self.assertEqual(len([s for s in spool.segments() if s[1]]), 5)
+
+        published = []
+        self.assertEqual(spool.drain(published.extend, batch_size=2), 5)
+        self.assertEqual([r['i'] for r in published], range(5))
+        self.assertEqual(spool.pending(), 0)
+        self.assertEqual(spool.drain(published.extend), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_failed_publish_is_retried(self):
+        """
+        Only what was published is marked as forwarded; the open segment
+        is kept
+        """
+        spool = Spool(self.directory)
+        for i in range(3):
+            spool.append({'i': i})
+
+        published = []
+
+        def publish(records):
+            if records[0]['i'] == 1 and not published[1:]:
+                published.append(None)
+                raise Exception('broker down')
+            published.extend(records)
+
+        with self.assertRaises(Exception):
+            spool.drain(publish, batch_size=1)
+        self.assertEqual(spool.pending(), 2)
+
+        published = []
+        self.assertEqual(spool.drain(published.extend), 2)
+        self.assertEqual([r['i'] for r in published], [1, 2])
+
+        # still being written
+        self.assertEqual(len(spool.segments()), 1)
+        spool.append({'i': 3})
+        self.assertEqual(spool.drain(published.extend), 1)
+
+        spool.close()
+        self.assertEqual(spool.drain(published.extend), 0)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_partial_line(self):
+        """
+        An incomplete line is not forwarded until it is complete; segments
+        left behind by dead processes are forwarded and removed
+        """
+        path = os.path.join(self.directory, '0000000001.000000-999999999-000001.open')
+        with open(path, 'w') as f:
+            f.write(json.dumps({'i': 0}) + '\n{"i": ')
+
+        spool = Spool(self.directory)
+        published = []
+        with mock.patch('ADSDeploy.webapp.spool._pid_alive', return_value=True):
+            self.assertEqual(spool.drain(published.extend), 1)
+            with open(path, 'a') as f:
+                f.write('1}\n')
+            self.assertEqual(spool.drain(published.extend), 1)
+            self.assertTrue(os.path.exists(path))
+
+        with mock.patch('ADSDeploy.webapp.spool._pid_alive', return_value=False):
+            self.assertEqual(spool.drain(published.extend), 0)
+        self.assertEqual(published, [{'i': 0}, {'i': 1}])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_concurrent_appends(self):
+        """
+        Concurrent appends share the fsync calls
+        """
+        spool = Spool(self.directory)
+        fsync = os.fsync
+        with mock.patch('ADSDeploy.webapp.spool.os.fsync', side_effect=fsync) as mocked:
+            threads = [threading.Thread(target=spool.append, args=({'i': i},))
+                       for i in range(50)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertLessEqual(mocked.call_count, 50)
+
+        published = []
+        spool.drain(published.extend)
+        self.assertEqual(sorted(r['i'] for r in published), range(50))
+
+    def test_forwarder(self):
+        """
+        The forwarder drains the spool and retries after failures
+        """
+        spool = Spool(self.directory)
+        spool.append({'i': 0})
+        published = []
+        done = threading.Event()
+        calls = []
+
+        def publish(records):
+            calls.append(records)
+            if len(calls) == 1:
+                raise Exception('broker down')
+            published.extend(records)
+            done.set()
+
+        forwarder = Forwarder(spool, publish, poll_interval=0.01, max_backoff=0.01)
+        forwarder.start()
+        try:
+            self.assertTrue(done.wait(5))
+        finally:
+            forwarder.stop()
+            forwarder.join(5)
+        self.assertEqual(published, [{'i': 0}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests of the namespaced key/value storage. There is no communication.
+"""
+
+import unittest
+
+from ADSDeploy import app, storage
+from ADSDeploy.models import Base, KeyValue
+
+
+class TestStorage(unittest.TestCase):
+    """
+    Test the storage API
+    """
+    def create_app(self):
+        app.init_app({
+            'SQLALCHEMY_URL': 'sqlite://',
+            'SQLALCHEMY_ECHO': False,
+        })
+        Base.metadata.bind = app.session.get_bind()
+        Base.metadata.create_all()
+        return app
+
+    def setUp(self):
+        self.app = self.create_app()
+
+    def tearDown(self):
+        Base.metadata.drop_all()
+        app.close_app()
+
+    def test_typed_values(self):
+        """
+        Numbers go into their own column, the rest is JSON
+        """
+        with self.app.session_scope() as session:
+            storage.put(session, 'test', 'float', 1.5)
+            storage.put(session, 'test', 'int', 3)
+            storage.put(session, 'test', 'json', {'foo': [1, 2]})
+            storage.put(session, 'test', 'bool', True)
+            storage.put_raw(session, 'test', 'raw', '{"bar": 1}')
+
+        with self.app.session_scope() as session:
+            kv = session.query(KeyValue).filter_by(namespace='test', key='float').one()
+            self.assertEqual(kv.number, 1.5)
+            self.assertIsNone(kv.value)
+
+            self.assertEqual(storage.get(session, 'test', 'float'), 1.5)
+            self.assertEqual(storage.get(session, 'test', 'int'), 3.0)
+            self.assertEqual(storage.get(session, 'test', 'json'), {'foo': [1, 2]})
+            self.assertEqual(storage.get(session, 'test', 'bool'), True)
+            self.assertEqual(storage.get(session, 'test', 'raw'), {'bar': 1})
+            self.assertEqual(storage.get_raw(session, 'test', 'raw'), '{"bar": 1}')
+            self.assertEqual(storage.get(session, 'test', 'missing', 'x'), 'x')
+            self.assertEqual(storage.get(session, 'other', 'float'), None)
+
+    def test_upsert(self):
+        """
+        Putting an existing key updates it
+        """
+        with self.app.session_scope() as session:
+            storage.put(session, 'test', 'foo', 1)
+        with self.app.session_scope() as session:
+            storage.put(session, 'test', 'foo', {'a': 1})
+        with self.app.session_scope() as session:
+            self.assertEqual(session.query(KeyValue).count(), 1)
+            self.assertEqual(storage.get(session, 'test', 'foo'), {'a': 1})
+
+    def test_bulk_and_scans(self):
+        """
+        Bulk get/put, prefix and range scans stay within the namespace
+        """
+        with self.app.session_scope() as session:
+            storage.put(session, 'test', 'sandbox.adsws', 10)
+            storage.put_many(session, 'test', {
+                'sandbox.adsws': 1,
+                'sandbox.graphics': 20,
+                'sandboxes.x': 2,
+                'eb-deploy.adsws': 5
+            })
+            storage.put(session, 'other', 'sandbox.adsws', 0)
+
+        with self.app.session_scope() as session:
+            self.assertEqual(
+                storage.get_many(session, 'test', ['sandbox.adsws', 'eb-deploy.adsws', 'no']),
+                {'sandbox.adsws': 1, 'eb-deploy.adsws': 5}
+            )
+            self.assertEqual(
+                storage.scan_prefix(session, 'test', 'sandbox.'),
+                {'sandbox.adsws': 1, 'sandbox.graphics': 20}
+            )
+            self.assertEqual(
+                storage.scan_below(session, 'test', 5),
+                {'sandbox.adsws': 1, 'sandboxes.x': 2}
+            )
+            self.assertEqual(
+                storage.scan_above(session, 'test', 5),
+                {'sandbox.graphics': 20}
+            )
+            self.assertEqual(
+                storage.delete(session, 'test', ['sandbox.adsws', 'no']), 1
+            )
+        with self.app.session_scope() as session:
+            self.assertEqual(storage.get(session, 'other', 'sandbox.adsws'), 0)
+            self.assertEqual(session.query(KeyValue).count(), 4)
+
+    def test_increment(self):
+        """
+        Counters start at 0
+        """
+        with self.app.session_scope() as session:
+            self.assertEqual(storage.increment(session, 'test', 'counter'), 1)
+            self.assertEqual(storage.increment(session, 'test', 'counter', 2), 3)
+        with self.app.session_scope() as session:
+            self.assertEqual(storage.get(session, 'test', 'counter'), 3)
+
+    def test_lock(self):
+        """
+        A lock is held until it is released or expires
+        """
+        with self.app.session_scope() as session:
+            token = storage.acquire(session, 'lock', 'sandbox.adsws', 60)
+        self.assertIsNotNone(token)
+        with self.app.session_scope() as session:
+            self.assertIsNone(storage.acquire(session, 'lock', 'sandbox.adsws', 60))
+            self.assertIsNotNone(storage.acquire(session, 'lock', 'sandbox.solr', 60))
+        with self.app.session_scope() as session:
+            self.assertFalse(storage.release(session, 'lock', 'sandbox.adsws', token + 1))
+            self.assertTrue(storage.release(session, 'lock', 'sandbox.adsws', token))
+        with self.app.session_scope() as session:
+            expired = storage.acquire(session, 'lock', 'sandbox.adsws', -1)
+        with self.app.session_scope() as session:
+            token = storage.acquire(session, 'lock', 'sandbox.adsws', 60)
+            self.assertGreater(token, expired)
+        with self.app.session_scope() as session:
+            # the holder of the expired lock does not free the new one
+            self.assertFalse(storage.release(session, 'lock', 'sandbox.adsws', expired))
+
+
+if __name__ == '__main__':
+    unittest.main()
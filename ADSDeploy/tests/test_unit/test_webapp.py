@@ -9,11 +9,11 @@ import hashlib
 import unittest
 
 from flask.ext.testing import TestCase
-from ADSDeploy.webapp import app
+from ADSDeploy.webapp import app, green
 from ADSDeploy.webapp.models import db, Deployment
 from ADSDeploy.webapp.views import GithubListener
 from stub_data.stub_webapp import github_payload, payload_tag
-from ADSDeploy.webapp.utils import get_boto_session
+from ADSDeploy.webapp.utils import get_boto_session, LRUCache, merge_patch
 from ADSDeploy.webapp.exceptions import NoSignatureInfo, InvalidSignature
 from collections import OrderedDict
 
@@ -58,6 +58,51 @@ class TestUtilities(unittest.TestCase):
             region_name="unittest-region",
         )
 
+    def test_lru_cache(self):
+        """
+        The least recently used entry is evicted, expired entries are misses
+        """
+        cache = LRUCache(size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        cache.invalidate('a')
+        self.assertEqual(cache.get('a', 'missing'), 'missing')
+        self.assertEqual(len(cache), 1)
+
+        cache = LRUCache(size=2, ttl=10)
+        with mock.patch('ADSDeploy.webapp.utils.time.time', return_value=100):
+            cache.set('a', 1)
+        with mock.patch('ADSDeploy.webapp.utils.time.time', return_value=105):
+            self.assertEqual(cache.get('a'), 1)
+        with mock.patch('ADSDeploy.webapp.utils.time.time', return_value=111):
+            self.assertEqual(cache.get('a'), None)
+
+    def test_merge_patch(self):
+        """
+        Examples of RFC 7396
+        """
+        self.assertEqual(merge_patch({'a': 'b'}, {'a': 'c'}), {'a': 'c'})
+        self.assertEqual(merge_patch({'a': 'b'}, {'b': 'c'}), {'a': 'b', 'b': 'c'})
+        self.assertEqual(merge_patch({'a': 'b'}, {'a': None}), {})
+        self.assertEqual(merge_patch({'a': 'b', 'b': 'c'}, {'a': None}), {'b': 'c'})
+        self.assertEqual(merge_patch({'a': ['b']}, {'a': 'c'}), {'a': 'c'})
+        self.assertEqual(merge_patch({'a': {'b': 'c'}}, {'a': {'b': 'd', 'c': None}}),
+                         {'a': {'b': 'd'}})
+        self.assertEqual(merge_patch({'a': [{'b': 'c'}]}, {'a': [1]}), {'a': [1]})
+        self.assertEqual(merge_patch(['a', 'b'], ['c', 'd']), ['c', 'd'])
+        self.assertEqual(merge_patch({'a': 'b'}, ['c']), ['c'])
+        self.assertEqual(merge_patch({'a': 'foo'}, None), None)
+        self.assertEqual(merge_patch({}, {'a': {'bb': {'ccc': None}}}),
+                         {'a': {'bb': {}}})
+        original = {'a': {'b': 1}}
+        merge_patch(original, {'a': {'b': 2}})
+        self.assertEqual(original, {'a': {'b': 1}})
+
 
 class TestStaticMethodUtilities(TestCase):
     """
@@ -72,6 +117,7 @@ class TestStaticMethodUtilities(TestCase):
         app_.config['SQLALCHEMY_DATABASE_URI'] = "sqlite://"
         app_.config['GITHUB_SECRET'] = 'unittest-secret'
         app_.config['RABBITMQ_URL'] = 'rabbitmq'
+        app_.config['WEBHOOK_SPOOL_DIR'] = None
         return app_
 
     def setUp(self):
@@ -200,5 +246,38 @@ class TestStaticMethodUtilities(TestCase):
         self.assertTrue(mocked_rabbit.called)
 
         instance_rabbit.publish.assert_has_calls(
-            [mock.call(payload=json.dumps(payload), exchange='test', route='test')]
+            [mock.call(payload=json.dumps(payload), exchange='test', route='test',
+                       priority=None)]
+        )
+
+
+class TestGreen(unittest.TestCase):
+    """
+    Test the helpers for the async serving mode
+    """
+
+    def test_get_mode(self):
+        """
+        The async library is derived from the gunicorn worker class
+        """
+        self.assertEqual(green.get_mode('eventlet'), 'eventlet')
+        self.assertEqual(green.get_mode('gevent'), 'gevent')
+        self.assertEqual(
+            green.get_mode('geventwebsocket.gunicorn.workers.GeventWebSocketWorker'),
+            'gevent'
         )
+        self.assertIsNone(green.get_mode('sync'))
+        self.assertIsNone(green.get_mode(None))
+
+    def test_patch_psycopg_sync(self):
+        """
+        Nothing is patched for the sync worker
+        """
+        self.assertFalse(green.patch_psycopg(None))
+
+    def test_monkey_patch_unknown_mode(self):
+        """
+        Only the supported async libraries can patch the standard library
+        """
+        with self.assertRaises(ValueError):
+            green.monkey_patch('sync')
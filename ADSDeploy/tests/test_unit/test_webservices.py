@@ -4,8 +4,11 @@ Test webservices
 
 import json
 import mock
+import shutil
+import tempfile
 import unittest
 
+from ADSDeploy import blobs, groups, statusdoc
 from ADSDeploy.webapp import app
 from ADSDeploy.webapp.models import db, Deployment
 from ADSDeploy.webapp.views import socketio
@@ -28,6 +31,8 @@ class TestEndpoints(TestCase):
         app_.config['DEPLOY_LOGGING'] = {}
         app_.config['WEBAPP_EXCHANGE'] = 'unit-test-exchange'
         app_.config['WEBAPP_ROUTE'] = 'unit-test-route'
+        app_.config['WEBHOOK_SPOOL_DIR'] = None
+        app_.config['QUEUE_MAX_PRIORITY'] = 10
         return app_
 
     def setUp(self):
@@ -67,6 +72,54 @@ class TestEndpoints(TestCase):
         self.assertStatus(r, 200)
         self.assertEqual(r.json, {u'foo': u'bar'})
 
+    def test_storage_endpoint_caching(self):
+        """
+        Polls are served from the cache, writes are conditional and can be
+        partial
+        """
+        url = url_for('serversidestorage', key='foo')
+
+        r = self.client.post(url, data=json.dumps({'a': 1, 'b': {'c': 2}}),
+                             content_type='application/json')
+        self.assertStatus(r, 200)
+        etag = r.headers['ETag']
+
+        with mock.patch('ADSDeploy.webapp.views.storage.get') as mocked:
+            r = self.client.get(url)
+            self.assertStatus(r, 200)
+            self.assertEqual(r.json, {'a': 1, 'b': {'c': 2}})
+            self.assertEqual(r.headers['ETag'], etag)
+
+            r = self.client.get(url, headers={'If-None-Match': etag})
+            self.assertStatus(r, 304)
+            self.assertFalse(mocked.called)
+
+        # partial update, based on the current version
+        r = self.client.open(url, method='PATCH',
+                             data=json.dumps({'a': None, 'b': {'d': 3}}),
+                             content_type='application/json',
+                             headers={'If-Match': etag})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json, {'b': {'c': 2, 'd': 3}})
+        self.assertNotEqual(r.headers['ETag'], etag)
+        new_etag = r.headers['ETag']
+
+        # a write based on the old version is rejected
+        r = self.client.post(url, data=json.dumps({'x': 1}),
+                             content_type='application/json',
+                             headers={'If-Match': etag})
+        self.assertStatus(r, 412)
+
+        r = self.client.get(url, headers={'If-None-Match': etag})
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json, {'b': {'c': 2, 'd': 3}})
+        self.assertEqual(r.headers['ETag'], new_etag)
+
+        # the database has the same version as the cache
+        self.app.extensions['storage_cache'].clear()
+        r = self.client.get(url, headers={'If-None-Match': new_etag})
+        self.assertStatus(r, 304)
+
     @mock.patch('ADSDeploy.webapp.views.GithubListener.push_rabbitmq')
     @mock.patch('ADSDeploy.webapp.views.GithubListener.verify_github_signature')
     def test_githublistener_forwards_message(self, mocked_gh, mocked_rabbit):
@@ -99,6 +152,64 @@ class TestEndpoints(TestCase):
             [mock.call(expected_packet, exchange='unit-test-exchange', route='unit-test-route')]
         )
 
+    def test_output_endpoint(self):
+        """
+        The output of the commands is streamed from the blob store
+        """
+        self.app.config['BLOB_STORE_PATH'] = tempfile.mkdtemp()
+        try:
+            digest = blobs.put(self.app.config['BLOB_STORE_PATH'], 'x' * 100000)
+
+            r = self.client.get(url_for('outputview', digest=digest))
+            self.assertStatus(r, 200)
+            self.assertEqual(r.data, 'x' * 100000)
+            self.assertEqual(r.headers['Content-Type'], 'text/plain; charset=utf-8')
+            self.assertEqual(r.headers['ETag'], '"{}"'.format(digest))
+
+            r = self.client.get(url_for('outputview', digest=digest),
+                                headers={'If-None-Match': '"{}"'.format(digest)})
+            self.assertStatus(r, 304)
+
+            r = self.client.get(url_for('outputview', digest='0' * 64))
+            self.assertStatus(r, 404)
+            r = self.client.get(url_for('outputview', digest='foo'))
+            self.assertStatus(r, 400)
+        finally:
+            shutil.rmtree(self.app.config['BLOB_STORE_PATH'])
+
+    @mock.patch('ADSDeploy.webapp.app.start_forwarder')
+    @mock.patch('ADSDeploy.webapp.views.GithubListener.push_rabbitmq')
+    @mock.patch('ADSDeploy.webapp.views.GithubListener.verify_github_signature')
+    def test_githublistener_spools_message(self, mocked_gh, mocked_rabbit, mocked_fw):
+        """
+        With a spool, the message is stored locally and accepted (202); it is
+        published by the forwarder
+        """
+        mocked_gh.return_value = True
+        self.app.config['WEBHOOK_SPOOL_DIR'] = tempfile.mkdtemp()
+        try:
+            r = self.client.post(url_for('githublistener'), data=github_payload,
+                                 headers={'X-GitHub-Delivery': 'unit-test-delivery'})
+            self.assertStatus(r, 202)
+            self.assertFalse(mocked_rabbit.called)
+
+            published = []
+            spool = self.app.extensions['webhook_spool']
+            self.assertEqual(spool.drain(published.extend), 1)
+            self.assertEqual(published, [{
+                'exchange': 'unit-test-exchange',
+                'route': 'unit-test-route',
+                'payload': {
+                    'url': 'https://github.com/adsabs/adsws',
+                    'commit': 'bcdf7771aa10d78d865c61e5336145e335e30427',
+                    'author': 'vsudilov',
+                    'tag': None,
+                    'delivery': 'unit-test-delivery'
+                }
+            }])
+        finally:
+            shutil.rmtree(self.app.config['WEBHOOK_SPOOL_DIR'])
+
     @mock.patch('ADSDeploy.webapp.views.GithubListener')
     def test_command_forwards_message_deploy(self, mocked_gh):
         """
@@ -125,12 +236,63 @@ class TestEndpoints(TestCase):
         self.assertEqual(r.json['msg'], 'success')
 
         params['commit'] = params['version']
+        params['priority'] = 5
         mocked_gh.push_rabbitmq.assert_has_calls([mock.call(
             params,
             exchange='unit-test-exchange',
             route='unit-test-route'
         )])
 
+    @mock.patch('ADSDeploy.webapp.views.GithubListener')
+    def test_command_priority(self, mocked_gh):
+        """
+        The priority comes from DEPLOY_PRIORITIES unless it is given
+        """
+        params = {
+            'application': 'sandbox',
+            'version': '23d3f',
+            'environment': 'adsws',
+            'action': 'restart-hard'
+        }
+
+        r = self.client.get(url_for('commandview', **params))
+        self.assertStatus(r, 200)
+        self.assertEqual(mocked_gh.push_rabbitmq.call_args[0][0]['priority'], 1)
+
+        r = self.client.get(url_for('commandview', priority=10, **params))
+        self.assertStatus(r, 200)
+        self.assertEqual(mocked_gh.push_rabbitmq.call_args[0][0]['priority'], 10)
+
+        for priority in (11, -1, 'high'):
+            r = self.client.get(url_for('commandview', priority=priority, **params))
+            self.assertStatus(r, 400)
+        self.assertEqual(mocked_gh.push_rabbitmq.call_count, 2)
+
+    @mock.patch('ADSDeploy.webapp.views.GithubListener')
+    def test_command_rollback(self, mocked_gh):
+        """
+        A rollback does not need a version (the last known good one is used)
+        """
+        params = {
+            'application': 'sandbox',
+            'environment': 'adsws',
+            'action': 'rollback'
+        }
+
+        r = self.client.get(url_for('commandview', **params))
+        self.assertStatus(r, 200)
+        payload = mocked_gh.push_rabbitmq.call_args[0][0]
+        self.assertNotIn('version', payload)
+        self.assertEqual(payload['action'], 'rollback')
+
+        r = self.client.get(url_for('commandview', version='v1', **params))
+        self.assertStatus(r, 200)
+        self.assertEqual(mocked_gh.push_rabbitmq.call_args[0][0]['commit'], 'v1')
+
+        params['action'] = 'deploy'
+        r = self.client.get(url_for('commandview', **params))
+        self.assertStatus(r, 400)
+
     @mock.patch('ADSDeploy.webapp.views.GithubListener')
     def test_commandview_missing_payload(self, mocked_gh):
         """
@@ -262,6 +424,184 @@ class TestEndpoints(TestCase):
             self.assertFalse(env_entry[0].tested)
 
 
+    @mock.patch('ADSDeploy.webapp.views.boto3.client')
+    def test_status_endpoint_filters(self, mocked_eb):
+        """
+        The status can be filtered by application/environment, the number of
+        previous versions is limited, and only the requested fields returned
+        """
+        mocked_instance = mocked_eb.return_value
+        mocked_instance.describe_applications.return_value = eb_stub
+        mocked_instance.describe_environments.return_value = eb_stub_2
+
+        db.session.add_all([
+            Deployment(
+                environment='graphics',
+                application='sandbox',
+                version='commit-{}'.format(i),
+                deployed=False,
+                tested=True
+            ) for i in range(5)
+        ])
+        db.session.commit()
+
+        url = url_for('statusview', application='sandbox',
+                      environment='graphics,adsws', limit=2,
+                      fields='previous_versions,history_cursor')
+        r = self.client.get(url)
+        self.assertStatus(r, 200)
+
+        self.assertEqual(
+            sorted([x['environment'] for x in r.json]),
+            ['adsws', 'graphics']
+        )
+        graphics = [x for x in r.json if x['environment'] == 'graphics'][0]
+        self.assertEqual(
+            sorted(graphics.keys()),
+            ['application', 'environment', 'history_cursor', 'previous_versions']
+        )
+        self.assertEqual(graphics['previous_versions'], ['commit-3', 'commit-4'])
+
+        # the rest of the history is one page away
+        url = url_for('historyview', application='sandbox',
+                      environment='graphics', cursor=graphics['history_cursor'])
+        r = self.client.get(url)
+        self.assertStatus(r, 200)
+        self.assertEqual(
+            [x['version'] for x in r.json['history']],
+            ['commit-2', 'commit-1', 'commit-0']
+        )
+        self.assertIsNone(r.json['next_cursor'])
+
+        # without a limit the whole history is returned
+        self.app.config['STATUS_HISTORY_LIMIT'] = 2
+        r = self.client.get(url_for('statusview', environment='graphics'))
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json[0]['previous_versions'],
+                         ['commit-{}'.format(i) for i in range(5)])
+        self.assertIsNone(r.json[0]['history_cursor'])
+
+        r = self.client.get(url_for('statusview', limit='many'))
+        self.assertStatus(r, 400)
+
+    def test_status_documents_endpoint(self):
+        """
+        The precomputed documents, all of them or the changes since a revision
+        """
+        for environment in ('adsws', 'graphics'):
+            db.session.add(Deployment(application='sandbox', environment=environment,
+                                      version='v1', deployed=True, tested=True))
+            db.session.flush()
+            statusdoc.refresh(db.session, 'sandbox', environment)
+        db.session.commit()
+
+        r = self.client.get(url_for('statusdocumentsview'))
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['revision'], 2)
+        self.assertEqual([d['environment'] for d in r.json['documents']],
+                         ['adsws', 'graphics'])
+        self.assertEqual(r.json['documents'][0]['version'], 'v1')
+
+        r = self.client.get(url_for('statusdocumentsview', since=1, fields='version'))
+        self.assertEqual(r.json['documents'], [
+            {'application': 'sandbox', 'environment': 'graphics', 'version': 'v1'}])
+
+        r = self.client.get(url_for('statusdocumentsview', environment='adsws'))
+        self.assertEqual(len(r.json['documents']), 1)
+
+        r = self.client.get(url_for('statusdocumentsview', since='x'))
+        self.assertStatus(r, 400)
+
+    def test_history_endpoint(self):
+        """
+        The history is paginated, newest first
+        """
+        db.session.add_all([
+            Deployment(
+                environment='adsws',
+                application='sandbox',
+                version='commit-{}'.format(i)
+            ) for i in range(5)
+        ] + [Deployment(environment='adsws', application='eb-deploy',
+                        version='other')])
+        db.session.commit()
+
+        url = url_for('historyview', application='sandbox',
+                      environment='adsws', limit=3, fields='version')
+        r = self.client.get(url)
+        self.assertStatus(r, 200)
+        self.assertEqual(
+            r.json['history'],
+            [{'version': 'commit-4'}, {'version': 'commit-3'},
+             {'version': 'commit-2'}]
+        )
+        self.assertIsNotNone(r.json['next_cursor'])
+
+        url = url_for('historyview', application='sandbox',
+                      environment='adsws', limit=3,
+                      cursor=r.json['next_cursor'])
+        r = self.client.get(url)
+        self.assertStatus(r, 200)
+        self.assertEqual(
+            [x['version'] for x in r.json['history']],
+            ['commit-1', 'commit-0']
+        )
+        self.assertIsNone(r.json['next_cursor'])
+
+    def test_group_endpoint(self):
+        """
+        The status of a fan-out deploy is aggregated from its deployments
+        """
+        r = self.client.get(url_for('groupview', group_id='nope'))
+        self.assertStatus(r, 404)
+
+        targets = [{'application': 'staging-us', 'environment': 'adsws'},
+                   {'application': 'staging-eu', 'environment': 'adsws'}]
+        groups.create(db.session, 'g1', targets, url='adsabs/adsws', version='v1')
+        db.session.add(Deployment(application='staging-us', environment='adsws',
+                                  version='v1', deployed=True, group_id='g1'))
+        db.session.commit()
+
+        r = self.client.get(url_for('groupview', group_id='g1'))
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['status'], 'in progress')
+        self.assertEqual(r.json['version'], 'v1')
+        self.assertEqual([(e['target'], e['state']) for e in r.json['environments']],
+                         [('staging-us.adsws', 'deployed'), ('staging-eu.adsws', 'pending')])
+
+        db.session.add(Deployment(application='staging-eu', environment='adsws',
+                                  version='v1', deployed=False, group_id='g1'))
+        db.session.commit()
+        r = self.client.get(url_for('groupview', group_id='g1'))
+        self.assertEqual(r.json['status'], 'failed')
+        self.assertEqual(r.json['counts']['failed'], 1)
+
+    def test_rollout_endpoint(self):
+        """
+        Rollouts are created for the TaskMaster to carry out
+        """
+        url = url_for('rolloutview')
+        r = self.client.post(url, data=json.dumps({'version': 'v2', 'waves': [['adsws']]}))
+        self.assertStatus(r, 400)
+
+        r = self.client.post(url, data=json.dumps({
+            'version': 'v2',
+            'waves': [['sandbox.adsws'], ['staging.adsws', 'production.adsws']],
+            'on_failure': 'stop'
+        }))
+        self.assertStatus(r, 201)
+        self.assertEqual(r.json['state'], 'pending')
+
+        r = self.client.get(url_for('rolloutview', rollout_id=r.json['id']))
+        self.assertStatus(r, 200)
+        self.assertEqual(r.json['on_failure'], 'stop')
+        self.assertEqual(r.json['waves'][1], ['staging.adsws', 'production.adsws'])
+        self.assertIsNone(r.json['group'])
+
+        r = self.client.get(url_for('rolloutview', rollout_id='nope'))
+        self.assertStatus(r, 404)
+
+
 class TestSocketIONameSpaces(TestCase):
     """
     Test the WebSockets that are available from the application
@@ -273,6 +613,7 @@ class TestSocketIONameSpaces(TestCase):
         app_ = app.create_app()
         app_.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
         app_.config['DEPLOY_LOGGING'] = {}
+        app_.config['WEBHOOK_SPOOL_DIR'] = None
         return app_
 
     def setUp(self):
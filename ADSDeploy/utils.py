@@ -6,13 +6,14 @@ project, and so do not belong to anything specific.
 
 
 import os
+import copy
 import logging
-import imp
+import types
 import sys
 from dateutil import parser, tz
 from datetime import datetime
 
-from cloghandler import ConcurrentRotatingFileHandler
+from . import logqueue
 local_zone = tz.tzlocal()
 utc_zone = tz.tzutc()
 
@@ -69,22 +70,131 @@ def get_date(timestr=None):
     return date
 
 
+# validated configuration of this process: PROJ_HOME -> (stat of the files, dict)
+_snapshots = {}
+
+# allowed keys of a worker in WORKERS, and their types (None is always allowed)
+WORKER_SCHEMA = {
+    'concurrency': (int, long),
+    'subscribe': basestring,
+    'publish': basestring,
+    'status': basestring,
+    'error': basestring,
+    'delay': basestring,
+    'durable': bool,
+    'engine': basestring,
+    'max_inflight': (int, long),
+    'poll_interval': (int, long, float),
+    'forwarding': dict
+}
+
+# allowed keys of a queue in QUEUES, and their types (None is always allowed)
+QUEUE_SCHEMA = {
+    'routing_key': basestring,
+    'durable': bool
+}
+
+
+def _config_files():
+    project_home = os.path.abspath(os.path.join(os.path.dirname(__file__), './'))
+    return project_home, [os.path.join(project_home, 'config.py'),
+                          os.path.join(project_home, 'local_config.py')]
+
+
+def _stat(filename):
+    try:
+        st = os.stat(filename)
+        return st.st_mtime, st.st_size
+    except OSError:
+        return None
+
+
 def load_config():
     """
     Loads configuration from config.py and also from local_config.py
+
+    The files are executed (and the result validated, see validate_config)
+    once per process; later calls return a copy of that snapshot until the
+    mtime or the size of one of the files changes.
     
     :return dictionary
     """
-    conf = {}
-    PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), './'))
+    PROJECT_HOME, files = _config_files()
     if PROJECT_HOME not in sys.path:
         sys.path.append(PROJECT_HOME)
-    conf['PROJ_HOME'] = PROJECT_HOME
-    
-    conf.update(load_module(os.path.join(PROJECT_HOME, 'config.py')))
-    conf.update(load_module(os.path.join(PROJECT_HOME, 'local_config.py')))
+
+    stats = [_stat(f) for f in files]
+    snapshot = _snapshots.get(PROJECT_HOME)
+    if snapshot is None or snapshot[0] != stats:
+        conf = {}
+        conf['PROJ_HOME'] = PROJECT_HOME
+        for f in files:
+            conf.update(load_module(f))
+        validate_config(conf)
+        snapshot = _snapshots[PROJECT_HOME] = (stats, conf)
     
-    return conf
+    return copy.deepcopy(snapshot[1])
+
+
+def config_changed():
+    """
+    :return: True if config.py or local_config.py changed since they were
+        last loaded by load_config()
+    """
+    PROJECT_HOME, files = _config_files()
+    snapshot = _snapshots.get(PROJECT_HOME)
+    return snapshot is None or snapshot[0] != [_stat(f) for f in files]
+
+
+def validate_config(conf):
+    """
+    Checks the WORKERS and QUEUES of the configuration
+
+    :param conf: dictionary
+    :return: no return, raises ValueError describing all of the problems
+    """
+    errors = []
+
+    def check(where, values, schema):
+        if not isinstance(values, dict):
+            errors.append('{0}: must be a dictionary'.format(where))
+            return False
+        for key, value in values.items():
+            if key not in schema:
+                errors.append('{0}: unknown key {1!r}'.format(where, key))
+            elif value is not None and not isinstance(value, schema[key]):
+                errors.append('{0}: {1!r} has a wrong type: {2!r}'.format(where, key, value))
+        return True
+
+    workers = conf.get('WORKERS') or {}
+    if not isinstance(workers, dict):
+        errors.append('WORKERS: must be a dictionary')
+        workers = {}
+    for name, worker in workers.items():
+        where = 'WORKERS[{0!r}]'.format(name)
+        if len(name.split('.')) != 2:
+            errors.append('{0}: the name must be <module>.<class>'.format(where))
+        if not check(where, worker, WORKER_SCHEMA):
+            continue
+        for key in ('concurrency', 'max_inflight'):
+            if isinstance(worker.get(key), (int, long)) and worker[key] < 1:
+                errors.append('{0}: {1!r} must be at least 1'.format(where, key))
+        if worker.get('engine') not in (None, 'blocking', 'async'):
+            errors.append('{0}: unknown engine {1!r}'.format(where, worker['engine']))
+        if worker.get('delay') and not worker.get('subscribe'):
+            errors.append('{0}: a delay queue needs a subscribe queue'.format(where))
+
+    queues = conf.get('QUEUES') or {}
+    if not isinstance(queues, dict):
+        errors.append('QUEUES: must be a dictionary')
+        queues = {}
+    for name, queue in queues.items():
+        where = 'QUEUES[{0!r}]'.format(name)
+        if check(where, queue, QUEUE_SCHEMA) and 'routing_key' not in queue:
+            errors.append('{0}: missing key \'routing_key\''.format(where))
+
+    if errors:
+        raise ValueError('Invalid configuration:\n  ' + '\n  '.join(sorted(errors)))
 
 
 def load_module(filename):
@@ -95,7 +205,7 @@ def load_module(filename):
     """
     
     filename = os.path.join(filename)
-    d = imp.new_module('config')
+    d = types.ModuleType('config')
     d.__file__ = filename
     try:
         with open(filename) as config_file:
@@ -109,7 +219,8 @@ def load_module(filename):
 
 def setup_logging(file_, name_, level='DEBUG'):
     """
-    Sets up generic logging to file with rotating files on disk
+    Sets up generic logging to file with rotating files on disk; the records
+    are written by a background thread (see ADSDeploy/logqueue.py)
 
     :param file_: the __file__ doc of python module that called the logging
     :param name_: the name of the file that called the logging
@@ -119,22 +230,10 @@ def setup_logging(file_, name_, level='DEBUG'):
 
     level = getattr(logging, level)
 
-    logfmt = '%(levelname)s\t%(process)d [%(asctime)s]:\t%(message)s'
-    datefmt = '%m/%d/%Y %H:%M:%S'
-    formatter = logging.Formatter(fmt=logfmt, datefmt=datefmt)
     logging_instance = logging.getLogger(name_)
     fn_path = os.path.join(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')), 'logs')
-    if not os.path.exists(fn_path):
-        os.makedirs(fn_path)
-    fn = os.path.join(fn_path, '{0}.log'.format(name_))
-    rfh = ConcurrentRotatingFileHandler(filename=fn,
-                                        maxBytes=2097152,
-                                        backupCount=5,
-                                        mode='a',
-                                        encoding='UTF-8')  # 2MB file
-    rfh.setFormatter(formatter)
     logging_instance.handlers = []
-    logging_instance.addHandler(rfh)
+    logging_instance.addHandler(logqueue.get_handler(fn_path))
     logging_instance.setLevel(level)
 
     return logging_instance
@@ -172,3 +271,31 @@ def overrides(interface_class):
 
     return overrider
 
+
+
+def get_priority(payload, priorities, max_priority):
+    """
+    Priority of the messages of a deployment
+
+    :param payload: dict with the 'application' and 'environment'; an
+        explicit 'priority' wins
+    :param priorities: DEPLOY_PRIORITIES, i.e. priority by
+        '<application>.<environment>', by '<application>' and 'default'
+    :param max_priority: QUEUE_MAX_PRIORITY
+    :return: int between 0 and max_priority, or None if priorities are
+        disabled (max_priority is 0 or None)
+    """
+    if not max_priority:
+        return None
+
+    priority = payload.get('priority')
+    if priority is None:
+        application = payload.get('application')
+        for key in ('{0}.{1}'.format(application, payload.get('environment')),
+                    application, 'default'):
+            if key in priorities:
+                priority = priorities[key]
+                break
+        else:
+            priority = 0
+    return max(0, min(int(priority), max_priority))
@@ -9,9 +9,11 @@ from flask import Flask, send_from_directory
 from flask.ext.restful import Api
 from flask.ext.cors import CORS
 from .views import GithubListener, CommandView, socketio, \
-    after_insert, after_update, RabbitMQ, StatusView, \
-    ServerSideStorage
+    after_insert, after_update, RabbitMQ, StatusView, StatusDocumentsView, \
+    ServerSideStorage, HistoryView, OutputView, GroupView, RolloutView
 from .models import db, Deployment
+from .utils import LRUCache
+from .spool import start_forwarder
 
 
 def create_app(name='ADSDeploy'):
@@ -27,6 +29,8 @@ def create_app(name='ADSDeploy'):
 
     # Load config and logging
     load_config(app)
+    if not os.path.isdir(app.config['LOG_PATH']):
+        os.makedirs(app.config['LOG_PATH'])
     logging.config.dictConfig(
         app.config['DEPLOY_LOGGING']
     )
@@ -38,6 +42,7 @@ def create_app(name='ADSDeploy'):
             r'/*': {'origins': app.config['CORS_ORIGINS']},
         },
         allow_headers=app.config['CORS_HEADERS'],
+        expose_headers=['ETag'],
         supports_credentials=True
     )
 
@@ -47,7 +52,13 @@ def create_app(name='ADSDeploy'):
     api.add_resource(CommandView, '/command', methods=['GET'])
     api.add_resource(RabbitMQ, '/rabbitmq', methods=['POST'])
     api.add_resource(StatusView, '/status', methods=['GET'])
-    api.add_resource(ServerSideStorage, '/store/<string:key>', methods=['GET', 'POST'])
+    api.add_resource(StatusDocumentsView, '/status/documents', methods=['GET'])
+    api.add_resource(HistoryView, '/history/<string:application>/<string:environment>', methods=['GET'])
+    api.add_resource(OutputView, '/output/<string:digest>', methods=['GET'])
+    api.add_resource(GroupView, '/group/<string:group_id>', methods=['GET'])
+    api.add_resource(RolloutView, '/rollout', '/rollout/<string:rollout_id>',
+                     methods=['GET', 'POST'])
+    api.add_resource(ServerSideStorage, '/store/<string:key>', methods=['GET', 'POST', 'PATCH'])
     @app.route('/static/<path:path>')
     def root(path):
         static_folder = app.config.get('STATIC_FOLDER', 'static')
@@ -55,8 +66,9 @@ def create_app(name='ADSDeploy'):
             static_folder = os.path.join(app.root_path, static_folder)
         return send_from_directory(static_folder, path)
 
-    # Register any WebSockets
-    socketio.init_app(app)
+    # Register any WebSockets; with an eventlet/gevent async mode the
+    # websocket transport is served natively
+    socketio.init_app(app, async_mode=app.config.get('WEBAPP_ASYNC_MODE'))
 
     # Initialise the database
     db.init_app(app)
@@ -64,6 +76,15 @@ def create_app(name='ADSDeploy'):
     db.event.listen(Deployment, 'after_insert', after_insert)
     db.event.listen(Deployment, 'after_update', after_update)
 
+    # Cache of ServerSideStorage
+    app.extensions['storage_cache'] = LRUCache(
+        size=app.config.get('STORAGE_CACHE_SIZE', 256),
+        ttl=app.config.get('STORAGE_CACHE_TTL', 60)
+    )
+
+    # Forward the spooled webhooks (WEBHOOK_SPOOL_DIR) from the serving process
+    app.before_first_request(lambda: start_forwarder(app))
+
     return app
 
 
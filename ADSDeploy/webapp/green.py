@@ -0,0 +1,75 @@
+"""
+Cooperative (green) I/O for the web application
+
+When the webapp is served by an eventlet/gevent worker, every blocking call
+(boto3 requests to AWS, pika publishes to RabbitMQ, psycopg2 queries) has to
+yield to the event loop, otherwise one slow request stalls all the others.
+Sockets, select and time are monkey patched by the gunicorn worker itself;
+psycopg2 is a C extension and needs an explicit wait callback.
+"""
+
+ASYNC_MODES = ('eventlet', 'gevent')
+
+
+def get_mode(worker_class):
+    """
+    Maps a gunicorn worker class onto the async library it runs on
+
+    :param worker_class: gunicorn worker class, e.g. 'eventlet' or
+        'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+    :type worker_class: str
+
+    :return: 'eventlet', 'gevent' or None
+    """
+    worker_class = (worker_class or '').lower()
+    for mode in ASYNC_MODES:
+        if mode in worker_class:
+            return mode
+    return None
+
+
+def monkey_patch(mode):
+    """
+    Patches the standard library for the given async library; only needed
+    when the application is not started by a gunicorn async worker (e.g.
+    when running wsgi.py directly)
+
+    :param mode: 'eventlet' or 'gevent'
+    :type mode: str
+    """
+    if mode == 'eventlet':
+        import eventlet
+        eventlet.monkey_patch()
+    elif mode == 'gevent':
+        from gevent import monkey
+        monkey.patch_all()
+    else:
+        raise ValueError('Unknown async mode: {}'.format(mode))
+
+    patch_psycopg(mode)
+
+
+def patch_psycopg(mode):
+    """
+    Installs a wait callback into psycopg2, so that queries to postgres
+    yield to the event loop. It is a no-op if psycogreen is not installed
+    (e.g. when running against sqlite).
+
+    :param mode: 'eventlet' or 'gevent'
+    :type mode: str
+
+    :return: True if psycopg2 was patched
+    """
+    if mode not in ASYNC_MODES:
+        return False
+
+    try:
+        if mode == 'eventlet':
+            from psycogreen.eventlet import patch_psycopg as _patch
+        else:
+            from psycogreen.gevent import patch_psycopg as _patch
+    except ImportError:
+        return False
+
+    _patch()
+    return True
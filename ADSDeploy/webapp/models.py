@@ -2,7 +2,7 @@
 Database models
 """
 
-from ADSDeploy.models import Base, Deployment, KeyValue
+from ADSDeploy.models import Base, Deployment, KeyValue, Rollout
 from flask.ext.sqlalchemy import SQLAlchemy
 
 db = SQLAlchemy(metadata=Base.metadata)
@@ -0,0 +1,369 @@
+"""
+On-disk spool for the GitHub webhooks
+
+The webhook endpoint appends the verified payloads to a local spool and
+returns right away; a background thread (the forwarder) publishes them to
+RabbitMQ, retrying for as long as the broker is unavailable. GitHub only
+waits for the local disk and no delivery is lost during a broker outage.
+
+The spool is a directory of segment files with one JSON record per line:
+
+    <time>-<pid>-<n>.open     segment being written by process <pid>
+    <time>-<pid>-<n>.jsonl    sealed segment (it reached segment_bytes)
+    <time>-<pid>-<n>.offset   number of bytes of the segment already forwarded
+
+Every process writes its own segment. Appends are made durable with a group
+fsync: concurrent requests wait for the same fsync() rather than doing one
+each. Only one process forwards at a time (an flock on forwarder.lock), and
+a segment is deleted once it is sealed (or its writer died) and forwarded
+completely. Records are forwarded at least once.
+"""
+
+import os
+import json
+import time
+import errno
+import fcntl
+import random
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+OPEN = '.open'
+SEALED = '.jsonl'
+OFFSET = '.offset'
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Spool(object):
+    """
+    Append only, fsync batched spool of JSON records
+    """
+
+    def __init__(self, directory, segment_bytes=4*1024*1024):
+        """
+        :param directory: where the segment files are kept
+        :param segment_bytes: size after which a segment is sealed
+        """
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._pid = None
+        self._fd = None
+        self._path = None
+        self._size = 0
+        self._segments = 0
+        self._written = 0
+        self._durable = 0
+        self._syncing = False
+
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _open(self):
+        """Starts a new segment; called with the lock held"""
+        self._pid = os.getpid()
+        self._segments += 1
+        self._path = os.path.join(self.directory, '{0:017.6f}-{1}-{2:06d}{3}'.format(
+            time.time(), self._pid, self._segments, OPEN))
+        self._fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._size = 0
+
+    def _seal(self):
+        """Closes the current segment; called with the lock held and no
+        fsync in progress"""
+        os.fsync(self._fd)
+        os.close(self._fd)
+        os.rename(self._path, self._path[:-len(OPEN)] + SEALED)
+        self._fd = None
+        self._path = None
+
+    def append(self, record):
+        """
+        Appends the record and waits until it is on disk
+
+        :param record: anything that can be serialised to JSON
+        """
+        line = json.dumps(record) + '\n'
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # forked: the segment belongs to the parent
+                self._fd = None
+                self._written = self._durable = 0
+                self._syncing = False
+            if self._fd is None:
+                self._open()
+
+            os.write(self._fd, line)
+            self._size += len(line)
+            self._written += 1
+            seq = self._written
+
+            while self._durable < seq:
+                if self._syncing:
+                    self._synced.wait()
+                    continue
+
+                # sync on behalf of everybody who has written so far
+                self._syncing = True
+                target = self._written
+                fd = self._fd
+                self._lock.release()
+                try:
+                    os.fsync(fd)
+                finally:
+                    self._lock.acquire()
+                    self._syncing = False
+                    self._synced.notify_all()
+                self._durable = max(self._durable, target)
+
+            if self._size >= self.segment_bytes and not self._syncing:
+                self._seal()
+
+    def close(self):
+        """
+        Seals the current segment
+        """
+        with self._lock:
+            while self._syncing:
+                self._synced.wait()
+            if self._fd is not None and self._pid == os.getpid():
+                self._seal()
+
+    def segments(self):
+        """
+        :return: list of (path, sealed) of the segments, oldest first
+        """
+        out = []
+        for name in sorted(os.listdir(self.directory)):
+            path = os.path.join(self.directory, name)
+            if name.endswith(SEALED):
+                out.append((path, True))
+            elif name.endswith(OPEN):
+                pid = int(name[:-len(OPEN)].rsplit('-', 2)[1])
+                writing = (pid == os.getpid() and path == self._path) \
+                    or (pid != os.getpid() and _pid_alive(pid))
+                out.append((path, not writing))
+        return out
+
+    @staticmethod
+    def _offset_path(path):
+        # the same for the open and the sealed name of a segment
+        return os.path.splitext(path)[0] + OFFSET
+
+    @classmethod
+    def _read_offset(cls, path):
+        try:
+            with open(cls._offset_path(path)) as f:
+                return int(f.read().strip() or 0)
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return 0
+
+    @classmethod
+    def _write_offset(cls, path, offset):
+        tmp = cls._offset_path(path) + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(str(offset))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, cls._offset_path(path))
+
+    @classmethod
+    def _remove(cls, path):
+        for p in (path, cls._offset_path(path)):
+            try:
+                os.remove(p)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def pending(self):
+        """
+        :return: number of records that were not forwarded yet
+        """
+        n = 0
+        for path, sealed in self.segments():
+            n += self._read(path).count('\n')
+        return n
+
+    def _read(self, path):
+        """
+        :return: the data of the segment that was not forwarded yet (empty
+            if it was just sealed, i.e. renamed)
+        """
+        try:
+            with open(path) as f:
+                f.seek(self._read_offset(path))
+                return f.read()
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return ''
+
+    def drain(self, publish, batch_size=100):
+        """
+        Hands the records that were not forwarded yet to publish(), in the
+        order they were appended, and records the progress after every
+        successful call
+
+        :param publish: callable that takes a list of records and raises
+            if they could not be delivered
+        :param batch_size: maximum number of records per call
+        :return: number of forwarded records
+        """
+        forwarded = 0
+        for path, sealed in self.segments():
+            offset = self._read_offset(path)
+            data = self._read(path)
+            # an incomplete last line is still being written
+            data = data[:data.rfind('\n') + 1]
+
+            lines = data.splitlines(True)
+            for i in range(0, len(lines), batch_size):
+                chunk = lines[i:i + batch_size]
+                records = []
+                for line in chunk:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        logger.error('Dropping a corrupt record in {0}: {1!r}'
+                                     .format(path, line))
+                if records:
+                    publish(records)
+                offset += sum(len(line) for line in chunk)
+                self._write_offset(path, offset)
+                forwarded += len(records)
+
+            if sealed:
+                self._remove(path)
+
+        return forwarded
+
+
+class Forwarder(threading.Thread):
+    """
+    Drains the spool in the background, backing off while publishing fails
+    """
+
+    def __init__(self, spool, publish, poll_interval=0.5, max_backoff=60):
+        """
+        :param spool: Spool instance
+        :param publish: see Spool.drain()
+        :param poll_interval: seconds between looks at an empty spool
+        :param max_backoff: maximum seconds between retries
+        """
+        super(Forwarder, self).__init__(name='webhook-spool-forwarder')
+        self.daemon = True
+        self.spool = spool
+        self.publish = publish
+        self.poll_interval = poll_interval
+        self.max_backoff = max_backoff
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        lock = open(os.path.join(self.spool.directory, 'forwarder.lock'), 'a')
+        try:
+            # only one process forwards, the others are on standby
+            while not self._stop_event.is_set():
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except IOError:
+                    self._stop_event.wait(self.poll_interval * 10)
+
+            backoff = 0
+            while not self._stop_event.is_set():
+                try:
+                    n = self.spool.drain(self.publish)
+                    backoff = 0
+                except Exception as e:
+                    backoff = min(max(backoff * 2, 1), self.max_backoff)
+                    logger.warning('Cannot forward the webhooks, retrying in '
+                                   '{0}s: {1}'.format(backoff, e))
+                    self._stop_event.wait(backoff * random.uniform(0.5, 1))
+                    continue
+                if not n:
+                    self._stop_event.wait(self.poll_interval)
+        finally:
+            lock.close()
+
+
+def rabbitmq_publisher(url):
+    """
+    :param url: RabbitMQ URL
+    :return: publish callable for Spool.drain(); every call publishes its
+        records with publisher confirms over one connection
+    """
+    def publish(records):
+        from .views import MiniRabbit
+        with MiniRabbit(url) as w:
+            for record in records:
+                w.publish(
+                    exchange=record['exchange'],
+                    route=record['route'],
+                    payload=json.dumps(record['payload'])
+                )
+    return publish
+
+
+def get_spool(app):
+    """
+    :param app: flask.Flask application
+    :return: the Spool of the application (created on first use), or None
+        if WEBHOOK_SPOOL_DIR is not set
+    """
+    if not app.config.get('WEBHOOK_SPOOL_DIR'):
+        return None
+    spool = app.extensions.get('webhook_spool')
+    if spool is None:
+        spool = app.extensions['webhook_spool'] = Spool(
+            app.config['WEBHOOK_SPOOL_DIR'],
+            segment_bytes=app.config.get('WEBHOOK_SPOOL_SEGMENT_BYTES', 4*1024*1024)
+        )
+    return spool
+
+
+def start_forwarder(app):
+    """
+    Starts the forwarder of the application's spool in this process (once)
+
+    :param app: flask.Flask application
+    :return: Forwarder or None if the spool is not enabled
+    """
+    spool = get_spool(app)
+    if spool is None:
+        return None
+
+    forwarder = app.extensions.get('webhook_forwarder')
+    if forwarder is not None and forwarder.is_alive() \
+            and forwarder.pid == os.getpid():
+        return forwarder
+
+    forwarder = Forwarder(
+        spool,
+        rabbitmq_publisher(app.config['RABBITMQ_URL']),
+        poll_interval=app.config.get('WEBHOOK_SPOOL_POLL_INTERVAL', 0.5),
+        max_backoff=app.config.get('WEBHOOK_SPOOL_MAX_BACKOFF', 60)
+    )
+    forwarder.pid = os.getpid()
+    forwarder.start()
+    app.extensions['webhook_forwarder'] = forwarder
+    return forwarder
@@ -3,6 +3,9 @@ Generic utilities
 """
 
 
+import time
+import threading
+from collections import OrderedDict
 from boto3.session import Session
 from flask import current_app
 
@@ -18,3 +21,81 @@ def get_boto_session():
         aws_secret_access_key=current_app.config.get('AWS_SECRET_KEY'),
         region_name=current_app.config.get('AWS_REGION')
     )
+
+
+class LRUCache(object):
+    """
+    Thread-safe, process-local least recently used cache with an optional
+    time to live (the entries can be changed by another process, the ttl
+    bounds how long a stale entry can be served)
+    """
+
+    def __init__(self, size=256, ttl=None):
+        """
+        :param size: maximum number of entries
+        :param ttl: seconds an entry is valid for, None for ever
+        """
+        self.size = size
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        :return: the cached value or default (if missing or expired)
+        """
+        with self._lock:
+            try:
+                expires, value = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            self._data[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        """
+        Caches the value, evicting the least recently used entry if full
+        """
+        if self.size <= 0:
+            return
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (expires, value)
+            while len(self._data) > self.size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def merge_patch(target, patch):
+    """
+    Applies a JSON merge patch (RFC 7396): objects are merged recursively,
+    null removes a member and anything else replaces the target
+
+    :param target: decoded JSON document
+    :param patch: decoded JSON merge patch
+    :return: the patched document (target is not modified)
+    """
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    result = dict(target)
+    for name, value in patch.items():
+        if value is None:
+            result.pop(name, None)
+        else:
+            result[name] = merge_patch(result.get(name), value)
+    return result
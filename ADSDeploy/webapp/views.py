@@ -3,6 +3,8 @@ Views
 """
 
 
+import os
+import sys
 import hmac
 import json
 import pika
@@ -12,8 +14,13 @@ import hashlib
 from flask import current_app, request, abort
 from flask.ext.restful import Resource
 from flask.ext.socketio import SocketIO, emit
+from werkzeug.http import quote_etag
 
-from .models import db, Deployment, KeyValue
+from .models import db, Deployment, KeyValue, Rollout
+from .utils import merge_patch
+from .spool import get_spool
+from .. import storage, codec, blobs, groups, rollout, statusdoc
+from ..utils import get_priority
 from .exceptions import NoSignatureInfo, InvalidSignature
 
 socketio = SocketIO()
@@ -43,7 +50,7 @@ class MiniRabbit(object):
     def __exit__(self, type, value, traceback):
         self.connection.close()
 
-    def publish(self, payload, exchange, route):
+    def publish(self, payload, exchange, route, priority=None):
         """
         Publish to a queue, on an exchange, with a specific route
 
@@ -55,8 +62,14 @@ class MiniRabbit(object):
 
         :param route: rabbitmq route
         :type route: str
+
+        :param priority: priority of the message
+        :type priority: int or None
         """
-        self.channel.basic_publish(exchange, route, payload)
+        properties = None
+        if priority is not None:
+            properties = pika.BasicProperties(priority=priority)
+        self.channel.basic_publish(exchange, route, payload, properties)
 
     def message_count(self, queue):
         """
@@ -84,7 +97,7 @@ class MiniRabbit(object):
         """
         packet = self.channel.basic_get(queue=queue, no_ack=True)
         try:
-            packet = json.loads(packet[2])
+            packet = codec.decode(packet[2], packet[1])
         except:
             pass
 
@@ -143,6 +156,55 @@ class MiniRabbit(object):
         )
 
 
+def get_limit(name, default, maximum):
+    """
+    Reads a non-negative integer query parameter, capped at maximum
+
+    :param name: name of the query parameter
+    :param default: value used when the parameter is missing
+    :param maximum: largest value allowed
+
+    :return: int
+    """
+    value = request.args.get(name, default)
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        abort(400, 'Parameter "{}" must be an integer'.format(name))
+    if value < 0:
+        abort(400, 'Parameter "{}" must not be negative'.format(name))
+    return min(value, maximum)
+
+
+def get_list(name):
+    """
+    Reads a comma separated query parameter (it can also be repeated)
+
+    :param name: name of the query parameter
+    :return: list of str, or None if it was not given
+    """
+    values = []
+    for value in request.args.getlist(name):
+        values.extend([v.strip() for v in value.split(',') if v.strip()])
+    return values or None
+
+
+def select_fields(entry, fields, always=('application', 'environment')):
+    """
+    Sparse field selection: keeps only the requested keys of an entry (and
+    the keys that identify it)
+
+    :param entry: dictionary to filter
+    :param fields: list of keys, or None to keep everything
+    :param always: keys that are always returned
+
+    :return: dict
+    """
+    if not fields:
+        return entry
+    return {k: v for k, v in entry.iteritems() if k in fields or k in always}
+
+
 class StatusView(Resource):
     """
     Status view
@@ -152,21 +214,40 @@ class StatusView(Resource):
         """
         Return the list of active services. There should only be on active
         environment+application, with deployment.deployed == True. Deployments
-        with deployment.deployed == False, are added to the 'previous_commits'
+        with deployment.deployed == False, are added to the 'previous_versions'
         key. Multiple active deployments is worrying, and any active deployments
         are included to the 'active' list. If there is more than 1, it means
         there is duplication, or an issue soemwhere.
+
+        Query parameters (all optional):
+
+            application, environment: only return these (comma separated)
+            limit: number of previous versions per environment (newest ones,
+                   default: all of them); if there are more, 'history_cursor'
+                   can be passed to the /history end point to get the rest
+            fields: only return these keys (comma separated)
         """
 
+        applications_filter = get_list('application')
+        environments_filter = get_list('environment')
+        fields = get_list('fields')
+        limit = None
+        if 'limit' in request.args:
+            limit = get_limit(
+                'limit',
+                None,
+                current_app.config.get('HISTORY_MAX_PAGE_SIZE', 100)
+            )
+
         client = boto3.client('elasticbeanstalk')
 
         aws_bootstrap = {}
-        aws_identifiers = []
 
         applications = client.describe_applications()
         for application in applications['Applications']:
             app_name = application['ApplicationName']
-            aws_bootstrap[app_name] = {}
+            if applications_filter and app_name not in applications_filter:
+                continue
 
             environments = client.describe_environments(ApplicationName=app_name)
             for environment in environments['Environments']:
@@ -176,159 +257,368 @@ class StatusView(Resource):
                 version = ':'.join(environment['VersionLabel'].split(':')[1:])
                 deployed = environment.get('Health', '') == 'Green'
 
-                aws_bootstrap[app_name][name] = {
+                aws_bootstrap.setdefault(app, {})[name] = {
                     'version': version,
                     'deployed': deployed
                 }
 
-                aws_identifiers.append('{}@{}'.format(name, app))
+        query = db.session.query(Deployment.application, Deployment.environment)
+        if applications_filter:
+            query = query.filter(Deployment.application.in_(applications_filter))
+        if environments_filter:
+            query = query.filter(Deployment.environment.in_(environments_filter))
+
+        identifiers = set(query.distinct().all())
+        for app, environments in aws_bootstrap.iteritems():
+            identifiers.update([(app, env) for env in environments])
+
+        active = []
+        for app, env in sorted(identifiers):
+            if environments_filter and env not in environments_filter:
+                continue
+            if applications_filter and app not in applications_filter:
+                continue
+
+            aws = aws_bootstrap.get(app, {}).get(env)
+
+            # newest first; one extra row for the active version and one to
+            # know if there is more history than we return
+            query = db.session.query(Deployment).filter(
+                Deployment.application == app,
+                Deployment.environment == env
+            ).order_by(Deployment.id.desc())
+            if limit is not None:
+                query = query.limit(limit + 2)
+            deployments = query.all()
+
+            if not deployments:
+                if aws is None:
+                    continue
+                deployments = [self.bootstrap(app, env, aws)]
+
+            entry = {
+                'application': app,
+                'environment': env,
+                'previous_versions': [],
+                'active': [],
+                'version': None,
+                'deployed': False,
+                'tested': False,
+                'status': None,
+                'history_cursor': None
+            }
+
+            current = None
+            if aws is not None and aws['deployed']:
+                current = next(
+                    (d for d in deployments if d.version == aws['version']),
+                    None
+                )
+                if current is None:
+                    current = db.session.query(Deployment).filter(
+                        Deployment.application == app,
+                        Deployment.environment == env,
+                        Deployment.version == aws['version']
+                    ).first() or self.bootstrap(app, env, aws)
+
+                entry.update(current.toJSON())
+                entry['active'].append(current.version)
+
+            previous = [d for d in deployments if d is not current]
+            if limit is not None and len(previous) > limit:
+                previous = previous[:limit]
+                if previous:
+                    entry['history_cursor'] = previous[-1].id
+                else:
+                    entry['history_cursor'] = deployments[0].id + 1
 
-        deployments = db.session.query(Deployment).all()
+            entry['previous_versions'] = [d.version for d in reversed(previous)]
 
-        # This is a bit more verbose, but it is more legible if some one else
-        # were to read this code, rather than the optimised version that would
-        # do a single request to the database
+            active.append(select_fields(entry, fields))
 
-        identifiers = ['{}@{}'.format(
-            deployment.environment, deployment.application
-        ) for deployment in deployments]
-        identifiers.extend(aws_identifiers)
-        identifiers = list(set(identifiers))
+        return active, 200
 
-        active = {}
+    @staticmethod
+    def bootstrap(application, environment, aws):
+        """
+        Creates a database entry for an environment that we only know from AWS
 
-        for identifier in identifiers:
-            env, app = identifier.split('@')
-            deployments = db.session.query(Deployment).filter(
-                Deployment.environment == env,
-                Deployment.application == app
-            ).all()
+        :param application: name of the application
+        :param environment: name of the environment
+        :param aws: dictionary with the 'version' and 'deployed' state in AWS
 
-            print 'trying', env, app
+        :return: models.Deployment
+        """
+        deployment = Deployment(
+            application=application,
+            environment=environment,
+            deployed=aws['deployed'],
+            tested=False,
+            msg='AWS bootstrapped',
+            version=aws['version']
+        )
+        db.session.add(deployment)
+        statusdoc.refresh(db.session, application, environment)
+        db.session.commit()
+        return deployment
 
-            if len(deployments) > 0:
-                active[identifier] = {}
-                active[identifier]['application'] = app
-                active[identifier]['environment'] = env
-                active[identifier]['previous_versions'] = []
-                active[identifier]['active'] = []
-                active[identifier]['version'] = None
-                active[identifier]['deployed'] = False
-                active[identifier]['tested'] = False
-                active[identifier]['status'] = None
 
-            else:
-                if app not in aws_bootstrap or env not in aws_bootstrap[app]:
-                    continue
+class StatusDocumentsView(Resource):
+    """
+    Precomputed status of the environments (see ADSDeploy/statusdoc.py)
+    """
 
-                deployments = [Deployment(
-                    application=app,
-                    environment=env,
-                    deployed=aws_bootstrap[app][env]['deployed'],
-                    tested=False,
-                    msg='AWS bootstrapped',
-                    version=aws_bootstrap[app][env]['version']
-                )]
-
-                db.session.add(deployments[0])
-                db.session.commit()
-
-                active[identifier] = {}
-                active[identifier]['application'] = app
-                active[identifier]['environment'] = env
-                active[identifier]['previous_versions'] = []
-                active[identifier]['active'] = []
-                active[identifier]['version'] = None
-                active[identifier]['deployed'] = False
-                active[identifier]['tested'] = False
-                active[identifier]['status'] = None
-
-            for deployment in deployments:
-
-                if deployment.environment in aws_bootstrap[deployment.application] \
-                  and deployment.version == aws_bootstrap[deployment.application][deployment.environment]['version'] \
-                  and aws_bootstrap[deployment.application][deployment.environment]['deployed']:
-
-                    active[identifier].update(deployment.toJSON())
-                    active[identifier]['active'].append(deployment.version)
-                else:
-                    active[identifier]['previous_versions']\
-                        .append(deployment.version)
-
-            if not active[identifier]['active'] \
-                    and env in aws_bootstrap[app] \
-                    and aws_bootstrap[app][env]['deployed']:
-
-                deployment = Deployment(
-                    application=app,
-                    environment=env,
-                    deployed=aws_bootstrap[app][env]['deployed'],
-                    tested=False,
-                    msg='AWS bootstrapped',
-                    version=aws_bootstrap[app][env]['version']
-                )
+    def get(self):
+        """
+        Returns the status documents that the DatabaseWriterWorker keeps for
+        every environment; unlike /status it does not ask AWS and does not
+        read the history.
+
+        Query parameters (all optional):
+
+            since: 'revision' of a previous response, to only get the
+                   documents that changed after it
+            application, environment: only return these (comma separated)
+            fields: only return these keys (comma separated)
+        """
+        applications_filter = get_list('application')
+        environments_filter = get_list('environment')
+        fields = get_list('fields')
+        since = get_limit('since', 0, sys.maxint)
+
+        revision = statusdoc.revision(db.session)
+        documents = [
+            select_fields(doc, fields)
+            for doc in statusdoc.changes_since(db.session, since)
+            if (not applications_filter or doc['application'] in applications_filter) and
+            (not environments_filter or doc['environment'] in environments_filter)
+        ]
+        return {'revision': revision, 'documents': documents}, 200
+
+
+class HistoryView(Resource):
+    """
+    Deployment history of one environment
+    """
+
+    def get(self, application, environment):
+        """
+        Returns the deployments of the environment, newest first, a page at a
+        time (keyset pagination on the primary key, which is indexed together
+        with the application and environment)
+
+        Query parameters (all optional):
+
+            limit: size of the page
+            cursor: value of 'next_cursor' from the previous page
+            fields: only return these keys (comma separated)
+        """
 
-                db.session.add(deployment)
-                db.session.commit()
-
-                active[identifier].update(deployment.toJSON())
-                active[identifier]['active'].append(aws_bootstrap[app][env]['version'])
-
-            print active[identifier], '\n'
-
-        # Less verbose, a little more thought required to understand
-        # active = {}
-        # for deployment in deployments:
-        #
-        #     identifier = '{}-{}'.format(
-        #         deployment.environment, deployment.application
-        #     )
-        #
-        #     if deployment.deployed:
-        #
-        #         active.setdefault(identifier, {}).update(deployment.toJSON())
-        #
-        #         active[identifier].setdefault('active', [])\
-        #             .append(deployment.commit)
-        #
-        #         continue
-        #
-        #     active.setdefault(identifier, {})\
-        #         .setdefault('previous_versions', [])\
-        #         .append(deployment.commit)
-
-        return active.values(), 200
+        fields = get_list('fields')
+        limit = get_limit(
+            'limit',
+            current_app.config.get('HISTORY_PAGE_SIZE', 20),
+            current_app.config.get('HISTORY_MAX_PAGE_SIZE', 100)
+        )
+        cursor = request.args.get('cursor')
+
+        query = db.session.query(Deployment).filter(
+            Deployment.application == application,
+            Deployment.environment == environment
+        )
+        if cursor:
+            try:
+                query = query.filter(Deployment.id < int(cursor))
+            except ValueError:
+                abort(400, 'Parameter "cursor" must be an integer')
+
+        deployments = query.order_by(Deployment.id.desc()).limit(limit + 1).all()
+
+        next_cursor = None
+        if len(deployments) > limit:
+            deployments = deployments[:limit]
+            next_cursor = deployments[-1].id if deployments else None
+
+        return {
+            'application': application,
+            'environment': environment,
+            'history': [select_fields(d.toJSON(), fields, always=())
+                        for d in deployments],
+            'next_cursor': next_cursor
+        }, 200
+
+
+class GroupView(Resource):
+    """
+    Status of a fan-out deploy (see ADSDeploy/groups.py)
+    """
+
+    def get(self, group_id):
+        """
+        :param group_id: 'group_id' of the deployments of the group
+        """
+        status = groups.status(db.session, group_id)
+        if status is None:
+            abort(404, 'No such group')
+        return status, 200
+
+
+class RolloutView(Resource):
+    """
+    Staged rollouts of a version to waves of environments (see
+    ADSDeploy/rollout.py); the pipeline's TaskMaster carries them out
+    """
+
+    def post(self):
+        """
+        Creates a rollout from the JSON body:
+
+            {"version": "v1.0.2",
+             "waves": [["sandbox.adsws"], ["staging.adsws", "production.adsws"]],
+             "on_failure": "rollback"}
+
+        on_failure ('stop' or 'rollback') is optional
+        """
+        payload = request.get_json(force=True, silent=True) or {}
+        try:
+            r = rollout.create(db.session, payload.get('version'), payload.get('waves'),
+                               on_failure=payload.get('on_failure') or
+                               current_app.config.get('ROLLOUT_ON_FAILURE'))
+        except ValueError as e:
+            abort(400, str(e))
+        db.session.commit()
+        return r.toJSON(), 201
+
+    def get(self, rollout_id):
+        """
+        :param rollout_id: 'id' returned by POST
+        :return: the rollout, with the status of its current wave
+        """
+        r = db.session.query(Rollout).get(rollout_id)
+        if r is None:
+            abort(404, 'No such rollout')
+        out = r.toJSON()
+        out['group'] = groups.status(db.session, r.group_id) if r.group_id else None
+        return out, 200
 
 
 class ServerSideStorage(Resource):
     """
     For whatever the widget wants to store in the KeyValue store
+
+    The decoded values are cached by the process (invalidated by every
+    write), so that polling costs no database round-trip. Every response
+    carries an ETag: GET honours If-None-Match (304 Not Modified), POST and
+    PATCH honour If-Match (412 Precondition Failed when the value was changed
+    by somebody else). PATCH takes a JSON merge patch (RFC 7396).
     """
-    
+
+    @staticmethod
+    def get_etag(value):
+        """
+        :param value: decoded value
+        :return: (unquoted) strong entity tag of the value
+        """
+        return hashlib.md5(json.dumps(value, sort_keys=True)).hexdigest()
+
+    @staticmethod
+    def cache():
+        return current_app.extensions['storage_cache']
+
+    def load(self, key):
+        """
+        :return: (value, etag) of the key, from the cache if possible
+        """
+        cached = self.cache().get(key)
+        if cached is None:
+            value = storage.get(db.session, storage.UI, key, {})
+            cached = (value, self.get_etag(value))
+            self.cache().set(key, cached)
+        return cached
+
+    def save(self, key, update):
+        """
+        Reads the current value (bypassing the cache, with the row locked where
+        the database supports it), checks the If-Match precondition and stores
+        update(current value)
+
+        :return: (value, etag) that was stored
+        """
+        kv = db.session.query(KeyValue)\
+            .filter_by(namespace=storage.UI, key=key)\
+            .with_for_update().first()
+        current = storage.decode(kv, {})
+        if request.if_match and not request.if_match.contains(self.get_etag(current)):
+            db.session.rollback()
+            self.cache().invalidate(key)
+            abort(412, 'The value of "{}" was modified'.format(key))
+
+        value = update(current)
+        storage.put(db.session, storage.UI, key, value)
+        db.session.commit()
+
+        stored = (value, self.get_etag(value))
+        self.cache().set(key, stored)
+        return stored
+
     def get(self, key):
         """
         Retrieves the key as stored in the database
         """
-        key = 'ui:{0}'.format(key)
-        kv = db.session.query(KeyValue).filter_by(key=key).first()
-        if kv is None:
-            return {}, 200
-        else:
-            v = kv.value and kv.value or '{}'
-            return json.loads(v), 200
-        
+        value, etag = self.load(key)
+        if request.if_none_match.contains(etag):
+            return current_app.response_class(
+                status=304, headers={'ETag': quote_etag(etag)})
+        return value, 200, {'ETag': quote_etag(etag)}
+
     def post(self, key):
         """Saves the data in the storage"""
-        key = 'ui:{0}'.format(key)
         payload = request.get_json(force=True)
-        out = None
-        u = db.session.query(KeyValue).filter_by(key=key).first()
-        if u is None:
-            u = KeyValue(key=key, value=json.dumps(payload))
-        db.session.add(u)
-        db.session.commit()
-        out = json.loads(u.value)
-        return out, 200
+        value, etag = self.save(key, lambda current: payload)
+        return value, 200, {'ETag': quote_etag(etag)}
+
+    def patch(self, key):
+        """Merges the JSON merge patch into the stored data"""
+        patch = request.get_json(force=True)
+        value, etag = self.save(key, lambda current: merge_patch(current, patch))
+        return value, 200, {'ETag': quote_etag(etag)}
+
+
+class OutputView(Resource):
+    """
+    Streams the full output of a command from the blob store (the messages
+    and the deployment history only carry its digest and tail)
+    """
+
+    def get(self, digest):
+        """
+        :param digest: sha256 of the output ('output' of a deployment)
+        """
+        try:
+            f = blobs.open_blob(current_app.config.get('BLOB_STORE_PATH'), digest)
+        except ValueError:
+            abort(400, 'Invalid digest')
+        except IOError:
+            abort(404, 'No such output')
+
+        headers = {
+            'ETag': quote_etag(digest),
+            'Cache-Control': 'public, max-age=31536000',
+            'Content-Length': str(os.fstat(f.fileno()).st_size)
+        }
+        if request.if_none_match.contains(digest):
+            f.close()
+            headers.pop('Content-Length')
+            return current_app.response_class(status=304, headers=headers)
+
+        def generate():
+            with f:
+                for chunk in iter(lambda: f.read(64 * 1024), ''):
+                    yield chunk
+
+        return current_app.response_class(
+            generate(), mimetype='text/plain', headers=headers,
+            direct_passthrough=True)
 
 
 class RabbitMQ(Resource):
@@ -364,7 +654,8 @@ class CommandView(Resource):
         """
         A proxy end point that forwards commands from the UI to the worker that
         makes the correct decision. It does minor checks on the keywords passed
-        to the end point.
+        to the end point. A 'rollback' without a version returns to the last
+        known good version of the environment.
         """
 
         required_keywords = [
@@ -373,7 +664,11 @@ class CommandView(Resource):
             'version',
             'action'
         ]
+        if request.args.get('action') == 'rollback':
+            required_keywords.remove('version')
         args = {k: request.args[k] for k in required_keywords}
+        if request.args.get('version'):
+            args['version'] = request.args['version']
 
         for key in required_keywords:
             if key not in args.keys():
@@ -382,7 +677,21 @@ class CommandView(Resource):
                 abort(400, 'Missing keyword: {}'.format(key))
 
         # Currently, version is a synonym to commit
-        args['commit'] = args['version']
+        if 'version' in args:
+            args['commit'] = args['version']
+
+        # explicit priority, e.g. for an urgent restart-hard
+        max_priority = current_app.config.get('QUEUE_MAX_PRIORITY')
+        if request.args.get('priority') is not None:
+            try:
+                priority = int(request.args['priority'])
+            except ValueError:
+                priority = -1
+            if not 0 <= priority <= (max_priority or 0):
+                abort(400, 'Invalid priority: {}'.format(request.args['priority']))
+            args['priority'] = priority
+        args['priority'] = get_priority(
+            args, current_app.config.get('DEPLOY_PRIORITIES', {}), max_priority)
 
         GithubListener.push_rabbitmq(
             args,
@@ -451,7 +760,8 @@ class GithubListener(Resource):
             w.publish(
                 exchange=exchange,
                 route=route,
-                payload=json.dumps(payload)
+                payload=json.dumps(payload),
+                priority=payload.get('priority')
             )
 
     @staticmethod
@@ -484,6 +794,9 @@ class GithubListener(Resource):
         Parse the incoming commit message, save to the backend database, and
         submit a build to the queue workers.
 
+        With a spool (WEBHOOK_SPOOL_DIR) the message is only made durable
+        locally and 202 is returned; the spool's forwarder publishes it.
+
         This endpoint should be contacted by a GitHub webhook.
         """
 
@@ -499,16 +812,32 @@ class GithubListener(Resource):
         except Exception as error:
             return {'Exception: "{}"'.format(error)}, 400
 
-        # Submit to RabbitMQ worker
+        # lets the pipeline recognise GitHub's redeliveries
+        delivery = request.headers.get('X-GitHub-Delivery')
+        if delivery:
+            payload['delivery'] = delivery
+
+        received = {'received': '{}@{}:{}'.format(payload['url'],
+                                                  payload['commit'],
+                                                  payload['tag'])}
+
+        # Spool it for the forwarder, or submit to RabbitMQ worker directly
+        spool = get_spool(current_app)
+        if spool is not None:
+            spool.append({
+                'exchange': current_app.config.get('WEBAPP_EXCHANGE'),
+                'route': current_app.config.get('WEBAPP_ROUTE'),
+                'payload': payload
+            })
+            return received, 202
+
         GithubListener.push_rabbitmq(
             payload,
             exchange=current_app.config.get('WEBAPP_EXCHANGE'),
             route=current_app.config.get('WEBAPP_ROUTE')
         )
 
-        return {'received': '{}@{}:{}'.format(payload['url'],
-                                              payload['commit'],
-                                              payload['tag'])}
+        return received
 
 
 def after_insert(mapper, connection, target):
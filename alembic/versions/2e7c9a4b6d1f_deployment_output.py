@@ -0,0 +1,25 @@
+"""deployment output
+
+Revision ID: 2e7c9a4b6d1f
+Revises: 5d2b8e4f1a3c
+Create Date: 2016-04-26 09:41:12.702541
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '2e7c9a4b6d1f'
+down_revision = '5d2b8e4f1a3c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('deployment', sa.Column('output', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('deployment') as t:
+        t.drop_column('output')
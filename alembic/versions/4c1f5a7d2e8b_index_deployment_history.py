@@ -0,0 +1,25 @@
+"""index deployment history
+
+Revision ID: 4c1f5a7d2e8b
+Revises: 33d955d7196f
+Create Date: 2016-04-12 10:21:07.512304
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '4c1f5a7d2e8b'
+down_revision = '33d955d7196f'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_index('ix_deployment_application_environment_id', 'deployment',
+                    ['application', 'environment', 'id'])
+
+
+def downgrade():
+    op.drop_index('ix_deployment_application_environment_id', 'deployment')
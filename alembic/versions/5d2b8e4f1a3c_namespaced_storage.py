@@ -0,0 +1,77 @@
+"""namespaced storage
+
+Revision ID: 5d2b8e4f1a3c
+Revises: 4c1f5a7d2e8b
+Create Date: 2016-04-19 14:02:51.118240
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5d2b8e4f1a3c'
+down_revision = '4c1f5a7d2e8b'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+storage = sa.table('storage',
+                   sa.column('namespace', sa.String),
+                   sa.column('key', sa.String),
+                   sa.column('value', sa.Text),
+                   sa.column('number', sa.Float))
+
+
+def _set_primary_key(columns):
+    if op.get_bind().dialect.name == 'sqlite':
+        with op.batch_alter_table('storage', recreate='always') as batch_op:
+            batch_op.create_primary_key('storage_pkey', columns)
+    else:
+        op.drop_constraint('storage_pkey', 'storage', type_='primary')
+        op.create_primary_key('storage_pkey', 'storage', columns)
+
+
+def upgrade():
+    op.add_column('storage', sa.Column('namespace', sa.String(length=64),
+                                       nullable=False, server_default=''))
+    op.add_column('storage', sa.Column('number', sa.Float(), nullable=True))
+
+    # 'ui:<key>' -> ('ui', <key>)
+    # '<application>.<environment>.last-used' -> ('last-used', '<application>.<environment>')
+    conn = op.get_bind()
+    for key, value in conn.execute(sa.select([storage.c.key, storage.c.value])).fetchall():
+        if key.startswith('ui:'):
+            values = {'namespace': 'ui', 'key': key[3:]}
+        elif key.endswith('.last-used'):
+            try:
+                number = float(value)
+            except (TypeError, ValueError):
+                continue
+            values = {'namespace': 'last-used', 'key': key[:-len('.last-used')],
+                      'value': None, 'number': number}
+        else:
+            continue
+        conn.execute(storage.update().where(storage.c.key == key).values(**values))
+
+    _set_primary_key(['namespace', 'key'])
+    op.create_index('ix_storage_namespace_number', 'storage', ['namespace', 'number'])
+
+
+def downgrade():
+    op.drop_index('ix_storage_namespace_number', 'storage')
+
+    conn = op.get_bind()
+    rows = conn.execute(sa.select([storage.c.namespace, storage.c.key,
+                                   storage.c.number])).fetchall()
+    for namespace, key, number in rows:
+        where = sa.and_(storage.c.namespace == namespace, storage.c.key == key)
+        if namespace == 'ui':
+            conn.execute(storage.update().where(where).values(key='ui:' + key))
+        elif namespace == 'last-used':
+            conn.execute(storage.update().where(where).values(
+                key=key + '.last-used', value=repr(number)))
+
+    _set_primary_key(['key'])
+    with op.batch_alter_table('storage') as batch_op:
+        batch_op.drop_column('number')
+        batch_op.drop_column('namespace')
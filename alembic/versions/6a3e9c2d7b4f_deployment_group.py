@@ -0,0 +1,27 @@
+"""deployment group
+
+Revision ID: 6a3e9c2d7b4f
+Revises: 2e7c9a4b6d1f
+Create Date: 2016-05-09 14:12:37.318260
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '6a3e9c2d7b4f'
+down_revision = '2e7c9a4b6d1f'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('deployment', sa.Column('group_id', sa.String(length=32), nullable=True))
+    op.create_index('ix_deployment_group_id', 'deployment', ['group_id'])
+
+
+def downgrade():
+    op.drop_index('ix_deployment_group_id', 'deployment')
+    with op.batch_alter_table('deployment') as t:
+        t.drop_column('group_id')
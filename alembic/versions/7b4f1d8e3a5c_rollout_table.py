@@ -0,0 +1,40 @@
+"""rollout table
+
+Revision ID: 7b4f1d8e3a5c
+Revises: 6a3e9c2d7b4f
+Create Date: 2016-05-16 10:05:48.210934
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '7b4f1d8e3a5c'
+down_revision = '6a3e9c2d7b4f'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.create_table('rollout',
+        sa.Column('id', sa.String(length=32), nullable=False),
+        sa.Column('version', sa.String(), nullable=True),
+        sa.Column('waves', sa.Text(), nullable=True),
+        sa.Column('wave', sa.Integer(), nullable=False),
+        sa.Column('state', sa.String(length=16), nullable=False),
+        sa.Column('on_failure', sa.String(length=16), nullable=True),
+        sa.Column('group_id', sa.String(length=32), nullable=True),
+        sa.Column('previous', sa.Text(), nullable=True),
+        sa.Column('msg', sa.String(), nullable=True),
+        sa.Column('wave_started', sa.DateTime(), nullable=True),
+        sa.Column('date_created', sa.DateTime(), nullable=False),
+        sa.Column('date_last_modified', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_rollout_state', 'rollout', ['state'])
+
+
+def downgrade():
+    op.drop_index('ix_rollout_state', 'rollout')
+    op.drop_table('rollout')
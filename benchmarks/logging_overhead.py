@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Cost of a log call in a worker
+
+Measures the time a logger call takes in the calling thread, at DEBUG and at
+INFO: with the queue handler of ADSDeploy/logqueue.py (the file is written
+by a background thread), with the queue handler and the DEBUG rate limit,
+and with a ConcurrentRotatingFileHandler writing to the file directly (the
+previous setup of utils.setup_logging).
+
+    python benchmarks/logging_overhead.py --messages 20000
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from ADSDeploy import logqueue
+
+
+def direct_handler(directory):
+    handler = logqueue.RotatingFileHandler(
+        filename=os.path.join(directory, 'direct.log'),
+        maxBytes=2097152, backupCount=5, mode='a', encoding='UTF-8')
+    handler.setFormatter(logging.Formatter(fmt=logqueue.LOGFMT, datefmt=logqueue.DATEFMT))
+    return handler
+
+
+def measure(handler, level, messages):
+    """
+    :return: microseconds per message, in the calling thread
+    """
+    logger = logging.getLogger('benchmark')
+    logger.handlers = [handler]
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    log = getattr(logger, level)
+
+    start = time.time()
+    for i in xrange(messages):
+        log('processed message %d of %s', i, 'ads.deploy.deploy')
+    return round((time.time() - start) / messages * 1e6, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--rate-limit', dest='rate_limit', type=int, default=20)
+    parser.add_argument('--json', action='store_true', help='Print JSON')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        for level in ('debug', 'info'):
+            handler = direct_handler(directory)
+            results['direct_{0}_us'.format(level)] = measure(handler, level, args.messages)
+            handler.close()
+
+            logqueue.configure(rate_limit=0)
+            results['queue_{0}_us'.format(level)] = measure(
+                logqueue.get_handler(directory), level, args.messages)
+
+            logqueue.configure(rate_limit=args.rate_limit)
+            results['queue_rate_limited_{0}_us'.format(level)] = measure(
+                logqueue.get_handler(directory), level, args.messages)
+        logqueue.stop()
+    finally:
+        shutil.rmtree(directory)
+
+    if args.json:
+        print json.dumps(results)
+    else:
+        for name, value in sorted(results.items()):
+            print '{0:>28}: {1:>9} us'.format(name, value)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Encode/decode cost and wire size of the pipeline messages
+
+Runs the codecs of ADSDeploy.codec (stdlib json and ujson, with and without
+zlib) over payloads shaped like the real ones: a GitHub webhook, a status
+update and a failed deployment whose 'msg' carries the whole eb-deploy
+output.
+
+    python benchmarks/message_codec.py --repeat 2000
+"""
+
+import os
+import sys
+import json
+import zlib
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from ADSDeploy import codec
+
+
+def make_payloads():
+    """
+    :return: list of (name, payload)
+    """
+    github = {
+        'url': 'https://github.com/adsabs/adsws',
+        'commit': 'bcdf7771aa10d78d865c61e5336145e335e30427',
+        'author': 'vsudilov',
+        'tag': None,
+        'delivery': '72d3162e-cc78-11e3-81ab-4c9367dc0958'
+    }
+    status = {
+        'application': 'sandbox',
+        'environment': 'adsws',
+        'version': 'v1.0.2-17-g1b31375',
+        'request_id': 'f3b0c44298fc1c149afbf4c8996fb924',
+        'init_timestamp': time.time(),
+        'msg': 'OK to deploy'
+    }
+    output = '\n'.join(
+        '2016-04-12 10:{0:02d}:{1:02d} INFO: Environment health has transitioned '
+        'from Ok to Info. Command is executing on {2} out of 2 instances '
+        '(i-0a1b2c3d, i-4e5f6a7b).'.format(i // 60 % 60, i % 60, i % 3)
+        for i in range(400))
+    failed = dict(status,
+                  err='deployment failed',
+                  deployed=False,
+                  msg='deployment failed; command: ./safe-deploy.sh adsws, '
+                      'reason: timeout, stdout: {0}'.format(output))
+    return [('github', github), ('status', status), ('failed-deploy', failed)]
+
+
+def measure(payload, library, compress, repeat):
+    """
+    :return: dict with the bytes on the wire and microseconds per encode
+        and per decode
+    """
+    codec.ujson = library
+    threshold = 1 if compress else 0
+
+    start = time.time()
+    for _ in xrange(repeat):
+        body, properties = codec.encode(payload, compress_threshold=threshold)
+    encode = (time.time() - start) / repeat
+
+    start = time.time()
+    for _ in xrange(repeat):
+        codec.decode(body, properties)
+    decode = (time.time() - start) / repeat
+
+    return {'bytes': len(body),
+            'encode_us': round(encode * 1e6, 1),
+            'decode_us': round(decode * 1e6, 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=2000)
+    parser.add_argument('--json', action='store_true', help='Print JSON lines')
+    args = parser.parse_args()
+
+    ujson = codec.ujson
+    libraries = [('json', None)]
+    if ujson is not None:
+        libraries.append(('ujson', ujson))
+    else:
+        print >> sys.stderr, 'ujson is not installed, measuring stdlib json only'
+
+    try:
+        for name, payload in make_payloads():
+            for library_name, library in libraries:
+                for compress in (False, True):
+                    r = measure(payload, library, compress, args.repeat)
+                    r.update(payload=name, codec=library_name + ('+zlib' if compress else ''))
+                    if args.json:
+                        print json.dumps(r)
+                    else:
+                        print '{payload:>14} {codec:>10}: {bytes:>7} bytes, ' \
+                              'encode {encode_us:>8} us, decode {decode_us:>8} us'.format(**r)
+    finally:
+        codec.ujson = ujson
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+Concurrent request capacity of the webapp: sync vs async gunicorn workers
+
+The real application is served by gunicorn (one worker, as in production)
+with boto3 replaced by a stub that sleeps for --latency seconds on every
+Elastic Beanstalk call, i.e. /status behaves like it does when AWS is slow.
+Then --requests requests are fired at /status from --concurrency client
+threads and the throughput and latency percentiles are reported.
+
+    python benchmarks/webapp_concurrency.py --worker-class sync eventlet \\
+        --concurrency 50 --requests 200 --latency 0.5
+"""
+
+import os
+import sys
+import time
+import json
+import socket
+import urllib2
+import argparse
+import tempfile
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+PROJECT_HOME = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+class _FakeEB(object):
+    """Elastic Beanstalk client that only waits"""
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def describe_applications(self):
+        time.sleep(self.latency)
+        return {'Applications': [{'ApplicationName': 'sandbox'}]}
+
+    def describe_environments(self, **kwargs):
+        return {'Environments': []}
+
+
+class _FakeBoto(object):
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def client(self, name, *args, **kwargs):
+        return _FakeEB(self.latency)
+
+
+def make_application():
+    """
+    Application factory used by the gunicorn workers started below; the
+    latency and the database come from the environment.
+    """
+    from ADSDeploy.webapp import app, views
+    from ADSDeploy.webapp.models import db
+
+    views.boto3 = _FakeBoto(float(os.environ.get('BENCH_LATENCY', 0.5)))
+    application = app.create_app()
+    application.config['SQLALCHEMY_DATABASE_URI'] = os.environ['BENCH_DATABASE']
+    with application.app_context():
+        db.create_all()
+    return application
+
+
+def percentile(values, p):
+    """
+    Nearest-rank percentile
+
+    :param values: sorted list of numbers
+    :param p: percentile, 0-100
+    """
+    if not values:
+        return float('nan')
+    k = max(0, min(len(values) - 1, int(round(p / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+
+def _free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def _wait_for(port, timeout=30):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise Exception('gunicorn did not start on port {0}'.format(port))
+
+
+def _fetch(url):
+    start = time.time()
+    try:
+        urllib2.urlopen(url, timeout=120).read()
+        return time.time() - start, None
+    except Exception as e:
+        return time.time() - start, str(e)
+
+
+def run(worker_class, concurrency, requests, latency):
+    """
+    Starts gunicorn with the given worker class and measures /status
+
+    :return: dict with the results
+    """
+    port = _free_port()
+    dbfile = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    dbfile.close()
+
+    env = dict(os.environ,
+               BENCH_LATENCY=str(latency),
+               BENCH_DATABASE='sqlite:///{0}'.format(dbfile.name),
+               PYTHONPATH=PROJECT_HOME)
+    gunicorn = os.path.join(os.path.dirname(sys.executable), 'gunicorn')
+    if not os.path.exists(gunicorn):
+        gunicorn = 'gunicorn'
+
+    proc = subprocess.Popen(
+        [gunicorn, '-k', worker_class, '-w', '1',
+         '--worker-connections', str(max(1000, concurrency)),
+         '-t', '600', '-b', '127.0.0.1:{0}'.format(port),
+         'benchmarks.webapp_concurrency:make_application()'],
+        cwd=PROJECT_HOME, env=env,
+        stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    try:
+        _wait_for(port)
+        url = 'http://127.0.0.1:{0}/status'.format(port)
+        _fetch(url)  # warm up
+
+        pool = ThreadPool(concurrency)
+        start = time.time()
+        results = pool.map(_fetch, [url] * requests)
+        elapsed = time.time() - start
+        pool.close()
+    finally:
+        proc.terminate()
+        proc.wait()
+        os.remove(dbfile.name)
+
+    timings = sorted(r[0] for r in results)
+    return {
+        'worker_class': worker_class,
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': len([r for r in results if r[1]]),
+        'elapsed': round(elapsed, 3),
+        'req_per_sec': round(requests / elapsed, 2),
+        'p50': round(percentile(timings, 50), 3),
+        'p95': round(percentile(timings, 95), 3),
+        'p99': round(percentile(timings, 99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--worker-class', nargs='+', default=['sync', 'eventlet'])
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.5,
+                        help='Simulated AWS latency per /status request (s)')
+    parser.add_argument('--json', action='store_true', help='Print JSON lines')
+    args = parser.parse_args()
+
+    for worker_class in args.worker_class:
+        r = run(worker_class, args.concurrency, args.requests, args.latency)
+        if args.json:
+            print json.dumps(r)
+        else:
+            print '{worker_class:>10}: {requests} requests, concurrency ' \
+                  '{concurrency}, errors {errors}, {elapsed}s, {req_per_sec} ' \
+                  'req/s, p50 {p50}s, p95 {p95}s, p99 {p99}s'.format(**r)
+
+
+if __name__ == '__main__':
+    main()
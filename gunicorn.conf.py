@@ -1,16 +1,27 @@
 import multiprocessing,os
- 
+
 APP_NAME = 'ADSDeploy'
 LOG_DIR = 'logs'
 PORT = 9000
 
+# 'sync' (default) serves one request at a time; 'eventlet' or 'gevent' serve
+# many concurrent requests from one process with cooperative I/O (the extra
+# packages are listed in async-web-requirements.txt). For gevent, use
+# 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker' to get websockets.
+WORKER_CLASS = os.environ.get('WEBAPP_WORKER_CLASS', 'sync')
+ASYNC = WORKER_CLASS != 'sync'
+
 if not os.path.isdir(LOG_DIR):
   os.makedirs(LOG_DIR)
 
 bind = "0.0.0.0:{}".format(PORT)
 workers = 1
-max_requests = 200
-preload_app = True
+worker_class = WORKER_CLASS
+worker_connections = int(os.environ.get('WEBAPP_WORKER_CONNECTIONS', 1000))
+# recycling an async worker drops every open websocket, so do not do it by default
+max_requests = int(os.environ.get('WEBAPP_MAX_REQUESTS', 0 if ASYNC else 200))
+# the app must be imported after the worker monkey patched the stdlib
+preload_app = not ASYNC
 chdir = os.path.dirname(__file__)
 daemon = False
 debug = False
@@ -18,3 +29,10 @@ errorlog = '{}/{}.error.log'.format(LOG_DIR, APP_NAME)
 accesslog = '{}/{}.access.log'.format(LOG_DIR, APP_NAME)
 pidfile = '{}/{}.pid'.format(LOG_DIR, APP_NAME)
 loglevel="info"
+
+
+def post_fork(server, worker):
+  """Make the database driver cooperative inside async workers"""
+  if ASYNC:
+    from ADSDeploy.webapp import green
+    green.patch_psycopg(green.get_mode(WORKER_CLASS))
@@ -17,8 +17,9 @@ import time
 import pika
 import argparse
 import json
-from ADSDeploy import app
+from ADSDeploy import app, loadgen
 from ADSDeploy.pipeline.example import ExampleWorker
+from ADSDeploy.pipeline import errors
 from ADSDeploy.pipeline import generic
 from ADSDeploy.pipeline import pstart
 from ADSDeploy.utils import setup_logging
@@ -73,6 +74,70 @@ def run_example(claims_file, queue='example', **kwargs):
     logger.info('Done processing {0} claims.'.format(i))
 
 
+def inspect_parking_lot(limit=None):
+    """
+    Prints the messages in the parking lot (one JSON object per line), they
+    stay in the queue
+
+    :param limit: maximum number of messages
+    :return: no return
+    """
+    worker = generic.RabbitMQWorker()
+    worker.connect(app.config.get('RABBITMQ_URL'))
+    try:
+        for headers, message in errors.inspect_parking_lot(worker, limit):
+            print json.dumps({'headers': headers, 'message': message})
+    finally:
+        worker.connection.close()
+
+
+def replay_parking_lot(limit=None):
+    """
+    Sends the messages in the parking lot back to the queues they failed in
+
+    :param limit: maximum number of messages
+    :return: no return
+    """
+    worker = generic.RabbitMQWorker()
+    worker.connect(app.config.get('RABBITMQ_URL'))
+    try:
+        n = errors.replay_parking_lot(worker, limit)
+    finally:
+        worker.connection.close()
+    logger.info('Replayed {0} messages from the parking lot'.format(n))
+
+
+def load_test(payloads_file, routing_key, rate=0, concurrency=1,
+              duration=None, messages=None):
+    """
+    Replays the payloads of a file into the pipeline and prints the
+    throughput, the publish latencies and the queue depth (see
+    ADSDeploy/loadgen.py)
+
+    :param payloads_file: JSON lines file, one message per line
+    :param routing_key: queue the messages are sent to
+    :param rate: messages per second, 0 for as fast as possible
+    :param concurrency: number of publishing connections
+    :param duration: seconds to publish for
+    :param messages: number of messages to publish
+    :return: no return
+    """
+    payloads = loadgen.read_payloads(payloads_file)
+    logger.info('Load test of {0} with {1} payloads from {2}'.format(
+        routing_key, len(payloads), payloads_file))
+    generator = loadgen.LoadGenerator(payloads,
+                                      url=app.config.get('RABBITMQ_URL'),
+                                      routing_key=routing_key,
+                                      exchange=app.config.get('EXCHANGE'),
+                                      rate=rate,
+                                      concurrency=concurrency,
+                                      duration=duration,
+                                      messages=messages)
+    report = generator.run()
+    logger.info('Load test: {0}'.format(json.dumps(report)))
+    print json.dumps(report, indent=2, sort_keys=True)
+
+
 def start_pipeline():
     """Starts the workers and let them do their job"""
     pstart.start_pipeline({}, app)
@@ -103,6 +168,69 @@ if __name__ == '__main__':
                         action='store_true',
                         help='Start the pipeline')
     
+    parser.add_argument('--inspect-parking-lot',
+                        dest='inspect_parking_lot',
+                        action='store_true',
+                        help='Print the messages that failed all their retries')
+
+    parser.add_argument('--replay-parking-lot',
+                        dest='replay_parking_lot',
+                        action='store_true',
+                        help='Send the messages that failed all their retries '
+                             'back to their queues')
+
+    parser.add_argument('--limit',
+                        dest='limit',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Maximum number of messages to inspect/replay')
+
+    parser.add_argument('--load-test',
+                        dest='load_test',
+                        action='store',
+                        type=str,
+                        help='Path to a JSON lines file of payloads to replay '
+                             'into the pipeline, reports the throughput, the '
+                             'publish latencies and the queue depth')
+
+    parser.add_argument('--routing-key',
+                        dest='routing_key',
+                        action='store',
+                        type=str,
+                        default='ads.deploy.github_deploy',
+                        help='Queue the load test sends the payloads to')
+
+    parser.add_argument('--rate',
+                        dest='rate',
+                        action='store',
+                        type=float,
+                        default=0,
+                        help='Messages per second of the load test (0: as '
+                             'fast as possible)')
+
+    parser.add_argument('--concurrency',
+                        dest='concurrency',
+                        action='store',
+                        type=int,
+                        default=1,
+                        help='Number of connections publishing the load test')
+
+    parser.add_argument('--duration',
+                        dest='duration',
+                        action='store',
+                        type=float,
+                        default=None,
+                        help='Seconds the load test runs for (the payloads '
+                             'are repeated); by default each is sent once')
+
+    parser.add_argument('--messages',
+                        dest='messages',
+                        action='store',
+                        type=int,
+                        default=None,
+                        help='Number of messages of the load test')
+    
     parser.set_defaults(purge_queues=False)
     parser.set_defaults(start_pipeline=False)
     args = parser.parse_args()
@@ -114,13 +242,27 @@ if __name__ == '__main__':
         purge_queues(app.config.get('WORKERS'))
         sys.exit(0)
 
+    if args.inspect_parking_lot:
+        inspect_parking_lot(args.limit)
+        sys.exit(0)
+
+    if args.replay_parking_lot:
+        replay_parking_lot(args.limit)
+        sys.exit(0)
+
     if args.start_pipeline:
         start_pipeline()
         work_done = True
         
-    if args.import_claims:
+    if args.run_example:
         # Send the files to be put on the queue
-        run_example(args.import_claims)
+        run_example(args.run_example)
+        work_done = True
+
+    if args.load_test:
+        load_test(args.load_test, args.routing_key, rate=args.rate,
+                  concurrency=args.concurrency, duration=args.duration,
+                  messages=args.messages)
         work_done = True
         
     if not work_done:
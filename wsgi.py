@@ -6,6 +6,17 @@
     entrypoint wsgi script
 """
 
+import os
+from ADSDeploy.webapp import green
+
+if __name__ == "__main__":
+    # gunicorn's async workers patch the stdlib themselves; when this script
+    # serves the app, it must be done before the app (and boto3, pika...)
+    # is imported
+    mode = green.get_mode(os.environ.get('WEBAPP_WORKER_CLASS'))
+    if mode:
+        green.monkey_patch(mode)
+
 from werkzeug.serving import run_simple
 from ADSDeploy.webapp import app
 